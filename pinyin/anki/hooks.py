@@ -5,7 +5,13 @@ from aqt.qt import *
 from aqt.utils import showInfo
 from anki.find import Finder
 
+import os
+
+import pinyin
 import pinyin.anki.keys
+import pinyin.bulkfill
+import pinyin.db
+import pinyin.dictionary
 import pinyin.factproxy
 import pinyin.media
 import pinyin.transformations
@@ -67,6 +73,7 @@ class FocusHook(Hook):
 
         pinyin.utils.suppressexceptions(
             lambda: updater.updatefact(factproxy, fieldValue))
+        self.mediamanager.flushimports()
 
         noteChanged = (savedNoteValues != note.values())
 
@@ -236,6 +243,21 @@ def openPreferences(mw, config, notifier, mediamanager):
         config.settings = controller.model.settings
         saveconfig()
 
+# How many notes the bulk fill loads at a time
+bulkfillchunksize = 200
+
+# Everything apart from the note itself that the result of filling it depends on
+def bulkfilldependencies(config, updater):
+    dictionarystamps = [pinyin.utils.filestamp(path) for path in [pinyin.db.dbpath] + [pinyin.utils.toolkitdir("pinyin", "dictionaries", name) for name in ["dict-userdict.txt", "pinyin_toolkit_sydict.u8"]]]
+    dependencies = [pinyin.__version__, sorted(config.settings.items()), dictionarystamps]
+    
+    # Audio can only be generated from the sounds we have got
+    mediamanager = getattr(updater, "mediamanager", None)
+    if mediamanager is not None:
+        dependencies.append([(mediapack.packpath, len(mediapack.media)) for mediapack in mediamanager.discovermediapacks()])
+    
+    return dependencies
+
 def runBulkFill(mw, config, notifier, updaters, field, updatehow, notification):
     if mw.web.key == "deckBrowser":
         return showInfo(u"No deck selected 同志!")
@@ -246,23 +268,69 @@ def runBulkFill(mw, config, notifier, updaters, field, updatehow, notification):
     for tag in config.getmodeltagslist():
         queryStr += " or note:*" + tag + "* "
     notes = Finder(mw.col).findNotes(queryStr)
-
-    for noteId in notes:
-        note = mw.col.getNote(noteId)
-        # Need a fact proxy because the updater works on dictionary-like objects
-        factproxy = pinyin.factproxy.FactProxy(config.candidateFieldNamesByKey, note)
-        if field not in factproxy:
-            continue
+    
+    def load(noteIds):
+        loaded = []
+        for noteId in noteIds:
+            # Need a fact proxy to find the fields the updater knows about
+            factproxy = pinyin.factproxy.FactProxy(config.candidateFieldNamesByKey, mw.col.getNote(noteId))
+            if field not in factproxy:
+                continue
+            
+            # The updater only gets to see a copy of the fields, so it never has to touch the note itself
+            loaded.append((noteId, factproxy, dict([(key, factproxy[key]) for key in factproxy.fieldnames])))
         
-        getattr(updaters[field], updatehow)(factproxy, factproxy[field])
+        return loaded
+    
+    def compute(fields):
+        getattr(updaters[field], updatehow)(fields, fields[field])
+    
+    def store(changes):
+        for factproxy, changedfields in changes:
+            for key, value in changedfields.items():
+                factproxy[key] = value
+            
+            # NB: very important to mark the fact as modified (see #105) because otherwise
+            # the HTML etc won't be regenerated by Anki, so users may not e.g. get working
+            # sounds that have just been filled in by the updater.
+            factproxy.fact.flush()
         
-        # NB: very important to mark the fact as modified (see #105) because otherwise
-        # the HTML etc won't be regenerated by Anki, so users may not e.g. get working
-        # sounds that have just been filled in by the updater.
-        note.flush()
+        # Remember what the chunk imported once it is in the notes
+        if mediamanager is not None:
+            mediamanager.flushimports()
+    
+    # Only the updaters that generate audio import media
+    mediamanager = getattr(updaters[field], "mediamanager", None)
+    
+    # Notes we have already filled are skipped unless they or something the fill depends on has changed since.
+    # The fingerprints live next to the collection, so they go wherever it goes.
+    fingerprintstore = pinyin.bulkfill.openfingerprintstore(os.path.splitext(mw.col.path)[0] + ".pinyintoolkit.db")
+    fingerprinter = None
+    if fingerprintstore is not None:
+        fingerprinter = pinyin.bulkfill.Fingerprinter(fingerprintstore, field + "." + updatehow, bulkfilldependencies(config, updaters[field]))
+    
+    # Google Translate only fills in the meanings the dictionaries lack while we are online, so a note left without
+    # a meaning may yet get one and has to be filled again next time
+    fillable = []
+    if field == "expression" and config.meaninggeneration and config.fallbackongoogletranslate:
+        fillable.append("meaning")
+    
+    bulkfill = pinyin.bulkfill.BulkFill(load, compute, store, chunksize=bulkfillchunksize, progress=lambda done: mw.progress.update(value=done), fingerprinter=fingerprinter, fillable=fillable)
+    mw.progress.start(max=len(notes), label="Filling in missing information...")
+    try:
+        bulkfill.run(notes)
+    finally:
+        mw.progress.finish()
+        if fingerprintstore is not None:
+            fingerprintstore.close()
     
     # For good measure, mark the deck as modified as well (see #105)
     mw.col.setMod()
+    
+    log.info("Bulk fill statistics for notes sharing their fields: %s", bulkfill.cachestatistics())
+    log.info("Dictionary headword filter statistics after the fill: %s", pinyin.dictionary.filterstatistics())
+    if field == 'expression':
+        log.info("Dictionary cache statistics after the fill: %s", updaters[field].dictionary.cachestatistics())
 
     # DEBUG consider future feature to add missing measure words cards after doing so (not now)
     notifier.info(notification)
@@ -11,8 +11,10 @@ from aqt.qt import QDialog
 
 from pinyin.db import *
 import pinyin.db.builder
+import pinyin.db.readingtable
 import pinyin.forms.builddb
 import pinyin.forms.builddbcontroller
+import pinyin.model
 import pinyin.updater
 
 import hooks
@@ -125,6 +127,16 @@ class PinyinToolkit(object):
             if builddb.exec_() == QDialog.Accepted:
                 # Successful completion of the build process: replace the existing database, if any
                 shutil.copyfile(dbbuilder.builtdatabasepath, dbpath)
+                # NB: copy this after the database, or it will look older than the database and get rebuilt
+                pinyin.db.readingtable.install(dbbuilder.builtreadingtablepath)
+                
+                # The syllables we parse pinyin with are frozen from the database too, and have already been imported
+                syllablespath = pinyin.utils.toolkitdir("pinyin", "db", "syllables.py")
+                shutil.copyfile(dbbuilder.builtsyllablespath, syllablespath)
+                if os.path.exists(syllablespath + "c"):
+                    # Don't let a compiled copy from the same second as the new module shadow it
+                    os.remove(syllablespath + "c")
+                pinyin.model.Pinyin.reloadsyllables()
             elif compulsory:
                 # Eeek! The dialog was "rejected" despite being compulsory. This can only happen if there
                 # was an error while building the database. Better give up now!
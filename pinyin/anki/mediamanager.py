@@ -7,27 +7,27 @@ import pinyin.utils
 class AnkiMediaManager(object):
     def __init__(self, mw):
         self.mw = mw
+        self.discoverer = pinyin.media.MediaPackDiscoverer()
+        self.importcache = None
     
     def mediadir(self):
         return self.mw.col.media.dir()
 
     def discovermediapacks(self):
-        packs = []
+        return self.discoverer.discover(self.mediadir())
+    
+    def refreshmediapacks(self):
+        self.discoverer.refresh()
+    
+    def importtocurrentdeck(self, file):
+        # The collection might have changed since we last imported anything
         themediadir = self.mediadir()
-        for packname in os.listdir(themediadir):
-            # Skip the download cache directory
-            if packname.lower() == "downloads":
-                continue
-            
-            # Only try and process directories as packs:
-            packpath = os.path.join(themediadir, packname)
-            if os.path.isdir(packpath):
-                log.info("Considering %s as a media pack", packname)
-                packs.append(pinyin.media.MediaPack.frompath(packpath))
-            else:
-                log.info("Ignoring the file %s in the media directory", packname)
+        if self.importcache is None or self.importcache.mediadir != themediadir:
+            self.flushimports()
+            self.importcache = pinyin.media.MediaImportCache.forcollection(themediadir)
         
-        return packs
+        return self.importcache.importfile(file, self.mw.col.media.addFile)
     
-    def importtocurrentdeck(self, file):
-        return self.mw.col.media.addFile(file)
+    def flushimports(self):
+        if self.importcache is not None:
+            self.importcache.flush()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sqlite3
+
+from logger import log
+import utils
+
+
+"""
+Updates many notes as a pipeline. The notes are fed through in chunks: each chunk is loaded, has its
+updates computed and then has the changes stored, so nothing ever has to hold every note at once.
+
+The updates are computed on plain dictionaries of fields rather than on the notes themselves, so
+the updaters never need to know anything about how the notes are loaded or saved.
+
+Given a fingerprinter, notes whose fields are just as we left them after the last fill are not
+updated again at all. Notes whose fields are exactly the same as those of another note (e.g. the
+same expression in a vocabulary and a sentence deck) share the updates computed for the first one.
+"""
+class BulkFill(object):
+    # How many distinct sets of fields we remember the updates for
+    resultcachesize = 10000
+    
+    def __init__(self, load, compute, store, chunksize=100, progress=None, fingerprinter=None, fillable=[]):
+        # Turns a list of ids into a list of (id, item, fields) triples, where the item is whatever store wants back
+        self.load = load
+
+        # Updates a dictionary of fields in place
+        self.compute = compute
+
+        # Given a list of (item, changedfields) pairs, saves the changes
+        self.store = store
+
+        self.chunksize = chunksize
+
+        # Told how many ids we have got through after each chunk
+        self.progress = progress
+        
+        self.fingerprinter = fingerprinter
+        
+        # Fields that the fill might not manage to fill every time, such as meanings from Google Translate while we
+        # are offline. Notes where any of these are still empty afterwards are not remembered as filled.
+        self.fillable = fillable
+        
+        self.results = utils.LRUCache(BulkFill.resultcachesize)
+
+    """
+    Runs the fill over the ids, returning the number of items that changed.
+    """
+    def run(self, ids):
+        log.info("Bulk filling %d notes in chunks of %d", len(ids), self.chunksize)
+
+        done, changed = 0, 0
+        for chunk in utils.chunked(ids, self.chunksize):
+            changes, fingerprints = self.computechanges(self.changedsincelastfill(self.load(chunk)))
+            if len(changes) > 0:
+                self.store(changes)
+            
+            # Only remember the notes once they really are as we say they are
+            if self.fingerprinter is not None:
+                self.fingerprinter.remember(fingerprints)
+            
+            done, changed = done + len(chunk), changed + len(changes)
+            if self.progress is not None:
+                self.progress(done)
+
+        log.info("Bulk fill changed %d of %d notes", changed, done)
+        return changed
+    
+    """
+    Reports how often notes could reuse the updates computed for another note with the same fields.
+    """
+    def cachestatistics(self):
+        return self.results.statistics()
+
+    def changedsincelastfill(self, loaded):
+        if self.fingerprinter is None:
+            return loaded
+        
+        fingerprints = self.fingerprinter.lookup([id for id, _item, _fields in loaded])
+        return [(id, item, fields) for id, item, fields in loaded if fingerprints.get(id) != self.fingerprinter.fingerprint(fields)]
+    
+    def computechanges(self, loaded):
+        changes, fingerprints = [], []
+        for id, item, fields in loaded:
+            # The update depends on nothing but the fields, so notes with the same fields get the same one
+            key = tuple(sorted(fields.items()))
+            updated = self.results.get(key)
+            if updated is None:
+                updated = dict(fields)
+                self.compute(updated)
+                self.results.put(key, updated)
+
+            # Only hand back what actually changed, so that untouched notes needn't be saved at all
+            changedfields = dict([(key, value) for key, value in updated.items() if key not in fields or fields[key] != value])
+            if len(changedfields) > 0:
+                changes.append((item, changedfields))
+            
+            if self.fingerprinter is not None and not(self.leftunfilled(updated)):
+                fingerprints.append((id, self.fingerprinter.fingerprint(updated)))
+
+        return changes, fingerprints
+    
+    def leftunfilled(self, fields):
+        return len([key for key in self.fillable if key in fields and fields[key].strip() == u""]) > 0
+
+"""
+Fingerprints the fields of notes for one kind of fill, so that we can tell whether a note has changed since
+we last filled it. The fingerprint also covers whatever else the fill depends on, such as the settings and
+dictionaries, so changing any of those makes every note look changed.
+"""
+class Fingerprinter(object):
+    def __init__(self, store, fill, dependencies):
+        self.store = store
+        self.fill = fill
+        
+        # NB: it doesn't matter if this isn't quite canonical: at worst we update a few notes we didn't need to
+        self.dependencies = repr(dependencies)
+    
+    def fingerprint(self, fields):
+        return utils.md5(self.dependencies + repr(sorted(fields.items())))
+    
+    def lookup(self, ids):
+        return self.store.lookup(self.fill, ids)
+    
+    def remember(self, fingerprints):
+        self.store.remember(self.fill, fingerprints)
+
+"""
+The fingerprints of the notes as they were after each kind of fill, kept in an SQLite database.
+"""
+class FingerprintStore(object):
+    # Lookups are split up so we stay well clear of SQLite's limit on query parameters
+    maxqueryids = 400
+    
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS Fingerprints (Fill TEXT NOT NULL, NoteId INTEGER NOT NULL, Fingerprint TEXT NOT NULL, PRIMARY KEY (Fill, NoteId))")
+        self.connection.commit()
+    
+    def lookup(self, fill, ids):
+        fingerprints = {}
+        for chunk in utils.chunked(ids, FingerprintStore.maxqueryids):
+            query = "SELECT NoteId, Fingerprint FROM Fingerprints WHERE Fill = ? AND NoteId IN (%s)" % ", ".join(["?"] * len(chunk))
+            fingerprints.update(self.connection.execute(query, [fill] + list(chunk)).fetchall())
+        
+        return fingerprints
+    
+    def remember(self, fill, fingerprints):
+        self.connection.executemany("INSERT OR REPLACE INTO Fingerprints (Fill, NoteId, Fingerprint) VALUES (?, ?, ?)", [(fill, id, fingerprint) for id, fingerprint in fingerprints])
+        self.connection.commit()
+    
+    def close(self):
+        self.connection.close()
+
+"""
+Opens the fingerprint store at the path, or returns None if we can't, in which case fills just have to update every note.
+"""
+def openfingerprintstore(path):
+    try:
+        return FingerprintStore(path)
+    except sqlite3.Error, e:
+        log.warn("Could not open the bulk fill fingerprints at %s, so every note will be updated: %s", path, e)
+        return None
@@ -25,6 +25,14 @@ defaultsettings = {
     "version" : 1,
 
     "dictlanguage" : "en",
+    
+    # How many megabytes the dictionary database may occupy once loaded into memory, which makes
+    # lookups much faster than querying the database every time. CEDICT needs about 100, so this is
+    # off (None) by default and the database is always used.
+    "dictionarymemorylimit" : None,
+    
+    # How many recently looked up words to remember the dictionary entries for, for each dictionary.
+    "dictionarycachesize" : 5000,
 
     "colorizedpinyingeneration"    : True, # Should we try and write readings and measure words that include colorized pinyin?
     "colorizedcharactergeneration" : True, # Should we try and fill out a field called Color with a colored version of the character?
@@ -345,6 +353,7 @@ class Config(object):
     needmeanings = property(lambda self: self.meaninggeneration or self.detectmeasurewords or self.mwaudiogeneration)
     meaningnumberingstrings = property(lambda self: meaningnumberingstringss[self.meaningnumbering])
     meaningseperatorstring = property(lambda self: meaningseperatorstrings.get(self.meaningseperator) or self.custommeaningseperator)
+    dictionarymemorylimitbytes = property(lambda self: self.dictionarymemorylimit and self.dictionarymemorylimit * 1024 * 1024 or None)
     
     def meaningnumber(self, n):
         if self.meaningnumberingstrings is None:
@@ -7,4 +7,11 @@ from pinyin.logger import log
 
 dbpath = pinyin.utils.toolkitdir("pinyin", "db", "cjklib.db")
 
+"""
+The name of the table holding the definitions of a dictionary table, already split up by
+pinyin.meanings.compiledefinition when the database was built.
+"""
+def compiledtablename(tablename):
+    return tablename + "Compiled"
+
 database = pinyin.utils.Thunk(lambda: cjklib.dbconnector.getDBConnector({ "url" : sqlalchemy.engine.url.URL("sqlite", database=dbpath) }))
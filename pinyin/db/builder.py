@@ -6,7 +6,10 @@ import tempfile
 import os
 import zipfile
 
+from pinyin.db import compiledtablename
 from pinyin.logger import log
+import pinyin.db.readingtable
+import pinyin.meanings
 import pinyin.utils
 
 import sqlalchemy
@@ -24,10 +27,15 @@ class DBBuilder(object):
         #'LocaleCharacterVariant', 'StrokeCount', 'ComponentLookup',
         #'CharacterVariant', 'ZVariants'
       ]
+    
+    # The tables whose definitions we split up at build time
+    dictionarytables = ['CEDICT', 'CFDICT', 'HanDeDict']
 
     cjkdatapath = pinyin.utils.toolkitdir("pinyin", "vendor", "cjklib", "cjklib", "data")
 
     builtdatabasepath = property(lambda self: os.path.join(self.dictionarydatapath, "cjklib.db"))
+    builtreadingtablepath = property(lambda self: os.path.join(self.dictionarydatapath, "readings.tbl"))
+    builtsyllablespath = property(lambda self: os.path.join(self.dictionarydatapath, "syllables.py"))
 
     def __init__(self, satisfiers):
         self.satisfiers = satisfiers
@@ -42,12 +50,12 @@ class DBBuilder(object):
             pass
     
     def build(self):
-        # [1/4]: copy and extract necessary files into a location cjklib can deal with
+        # [1/7]: copy and extract necessary files into a location cjklib can deal with
         log.info("Copying in dictionary data")
         for requirement, satisfier in self.satisfiers:
             satisfier(os.path.join(self.dictionarydatapath, requirement))
         
-        # [2/4]: setup the database builder with a standard set of requirements
+        # [2/7]: setup the database builder with a standard set of requirements
         log.info("Initializing builder")
         database = cjklib.dbconnector.getDBConnector({ "url" : sqlalchemy.engine.url.URL("sqlite", database=self.builtdatabasepath) })
         self.cjkdbbuilder = cjklib.build.DatabaseBuilder(
@@ -60,17 +68,73 @@ class DBBuilder(object):
                     'CombinedCharacterResidualStrokeCountBuilder',
                     'HanDeDictFulltextSearchBuilder', 'UnihanBMPBuilder'])
         
-        # [3/4]: build the database
+        # [3/7]: build the database
         log.info("Building the cjklib database: the target file is %s", self.builtdatabasepath)
         self.cjkdbbuilder.build(DBBuilder.wantgroups)
         
-        # [4/4]: clean up, so that we don't get errors if (when) the temporary database is deleted
+        # [4/7]: split up all the dictionary definitions now, rather than every time we look them up
+        for tablename in DBBuilder.dictionarytables:
+            compiledefinitions(database, tablename)
+        
+        # [5/7]: lay the character readings out so they can be found without going to the database
+        pinyin.db.readingtable.build(database, self.builtreadingtablepath)
+        
+        # [6/7]: freeze the pinyin syllables, so that parsing pinyin doesn't need the database at all
+        writesyllables(database, self.builtsyllablespath)
+        
+        # [7/7]: clean up, so that we don't get errors if (when) the temporary database is deleted
         database.connection.close()
         del database.connection
         database.engine.dispose()
         del database.engine
 
 
+"""
+Adds a table alongside the given dictionary table holding the definition in each row already
+split up by pinyin.meanings.compiledefinition, keyed by the rowid of the dictionary table.
+"""
+def compiledefinitions(database, tablename):
+    if not(database.hasTable(tablename)):
+        log.info("Not compiling the definitions in %s because the table is missing", tablename)
+        return
+    
+    log.info("Compiling the definitions in %s", tablename)
+    dicttable = sqlalchemy.Table(tablename, database.metadata, autoload=True)
+    compiledtable = sqlalchemy.Table(compiledtablename(tablename), database.metadata,
+        sqlalchemy.Column("RowId", sqlalchemy.Integer, primary_key=True, autoincrement=False),
+        sqlalchemy.Column("Definition", sqlalchemy.Text, nullable=False),
+        useexisting=True)
+    compiledtable.drop(bind=database.connection, checkfirst=True)
+    compiledtable.create(bind=database.connection)
+    
+    # Empty definitions are treated as missing anyway, so don't bother compiling them. NB: use the same
+    # test as parsing the raw translation does, so that both give the same answer for blank ones.
+    rows = [{ "RowId" : rowid, "Definition" : pinyin.meanings.compiledefinition(translation) }
+            for rowid, translation in database.selectRows(sqlalchemy.select([sqlalchemy.literal_column("rowid"), dicttable.c.Translation]))
+            if pinyin.utils.zapempty(translation) is not None]
+    if len(rows) > 0:
+        database.execute(compiledtable.insert(), rows)
+
+"""
+Writes out the pinyin.db.syllables module, holding the contents of the PinyinSyllables table.
+"""
+def writesyllables(database, path):
+    log.info("Writing the pinyin syllables to %s", path)
+    syllablestable = sqlalchemy.Table("PinyinSyllables", database.metadata, autoload=True)
+    syllables = database.selectScalars(sqlalchemy.select([syllablestable.c.Pinyin]).order_by(syllablestable.c.Pinyin))
+    
+    file = open(path, "w")
+    try:
+        file.write("#!/usr/bin/env python\n")
+        file.write("# -*- coding: utf-8 -*-\n\n")
+        file.write("# NB: this file is generated from the PinyinSyllables table by pinyin.db.builder - don't edit it by hand!\n\n")
+        file.write("pinyinsyllables = [\n")
+        for syllable in syllables:
+            file.write("    %s,\n" % repr(syllable))
+        file.write("  ]\n")
+    finally:
+        file.close()
+
 def getSatisfiers():
     dictionarydir = lambda *components: pinyin.utils.toolkitdir("pinyin", "dictionaries", *components)
     
@@ -206,3 +270,5 @@ if __name__ == "__main__":
     builder = DBBuilder(getSatisfiers()[1])
     builder.build()
     shutil.copyfile(builder.builtdatabasepath, pinyin.utils.toolkitdir("pinyin", "db", "cjklib.db"))
+    pinyin.db.readingtable.install(builder.builtreadingtablepath)
+    shutil.copyfile(builder.builtsyllablespath, pinyin.utils.toolkitdir("pinyin", "db", "syllables.py"))
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import mmap
+import os
+import shutil
+import struct
+import weakref
+
+import sqlalchemy
+
+from pinyin.logger import log
+import pinyin.utils
+
+
+"""
+The readings of every character in the CharacterPinyin table, laid out in a file so that we can
+find the readings of a character just by reading at an offset computed from its codepoint.
+
+The file consists of:
+ * A header: the magic string, then the number of pages and the number of bytes of readings
+ * For every page (a block of 256 codepoints sharing their high bits) with any readings in it, the
+   codepoint the page starts at. The pages are in ascending order.
+ * For every codepoint on those pages, the offset of its readings in the readings area, followed
+   by one final offset marking the end of the readings area. A codepoint has readings iff its
+   offset is different from the next one.
+ * The readings area, where the readings of each character are encoded as UTF-8 and seperated by spaces.
+"""
+
+magic = "PTKREAD1"
+headerformat = "<8sII"
+pagebits = 8
+pagesize = 1 << pagebits
+
+readingtablepath = pinyin.utils.toolkitdir("pinyin", "db", "readings.tbl")
+
+# Every table that is open and still in use. Windows won't let us replace a file that is mapped,
+# and truncating one elsewhere would crash anyone reading the old mapping, so these get closed first.
+opentables = weakref.WeakSet()
+
+def codepoint(character):
+    if len(character) == 1:
+        return ord(character)
+    elif len(character) == 2 and u"\ud800" <= character[0] <= u"\udbff" and u"\udc00" <= character[1] <= u"\udfff":
+        # Narrow Python builds store characters outside the BMP as surrogate pairs
+        return 0x10000 + ((ord(character[0]) - 0xd800) << 10) + (ord(character[1]) - 0xdc00)
+    else:
+        return None
+
+def character(codepoint):
+    try:
+        return unichr(codepoint)
+    except ValueError:
+        # Narrow Python builds again
+        codepoint -= 0x10000
+        return unichr(0xd800 + (codepoint >> 10)) + unichr(0xdc00 + (codepoint & 0x3ff))
+
+"""
+Writes the reading table for the CharacterPinyin table of the given database to the path.
+"""
+def build(database, path):
+    log.info("Building the character reading table at %s", path)
+
+    # Keep the readings of each character in the same order as the database gives them us
+    readingtable = sqlalchemy.Table("CharacterPinyin", database.metadata, autoload=True)
+    readingss = {}
+    for char, reading in database.selectRows(sqlalchemy.select([readingtable.c.ChineseCharacter, readingtable.c.Reading])
+                                                       .order_by(readingtable.c.ChineseCharacter, readingtable.c.Reading)):
+        if codepoint(char) is None:
+            log.warn("Not putting the readings of %r into the reading table because it isn't a single character", char)
+            continue
+
+        readingss.setdefault(codepoint(char), []).append(reading)
+
+    pages = sorted(set([point >> pagebits for point in readingss]))
+
+    offsets, readingsdata = [], []
+    readingsdatalength = 0
+    for page in pages:
+        for point in range(page << pagebits, (page + 1) << pagebits):
+            offsets.append(readingsdatalength)
+            if point in readingss:
+                encoded = u" ".join(readingss[point]).encode("utf-8")
+                readingsdata.append(encoded)
+                readingsdatalength += len(encoded)
+
+    offsets.append(readingsdatalength)
+
+    # Write to a temporary file first so nobody ever sees a half-written table
+    temppath = path + ".tmp"
+    file = open(temppath, "wb")
+    try:
+        file.write(struct.pack(headerformat, magic, len(pages), readingsdatalength))
+        file.write(struct.pack("<%dI" % len(pages), *[page << pagebits for page in pages]))
+        file.write(struct.pack("<%dI" % len(offsets), *offsets))
+        file.write("".join(readingsdata))
+    finally:
+        file.close()
+
+    replace(temppath, path)
+
+"""
+Puts a reading table built elsewhere in place at the path.
+"""
+def install(builtpath, path=readingtablepath):
+    # Copy next to the destination first, so that the table itself is only ever replaced by a rename
+    temppath = path + ".tmp"
+    shutil.copyfile(builtpath, temppath)
+    replace(temppath, path)
+
+def replace(temppath, path):
+    # Anything still using the old table will get the new one when it notices the database has changed
+    for table in list(opentables):
+        if table.path == path:
+            table.close()
+
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(temppath, path)
+
+"""
+A memory-mapped view of a reading table file.
+"""
+class ReadingTable(object):
+    def __init__(self, path):
+        self.path = path
+        
+        file = open(path, "rb")
+        try:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            # The mapping stays valid after we close the file
+            file.close()
+
+        filemagic, pagecount, readingsdatalength = struct.unpack_from(headerformat, self.map, 0)
+        if filemagic != magic:
+            raise IOError("The file at %s is not a reading table" % path)
+
+        pagestart = struct.calcsize(headerformat)
+        self.pages = dict([(start >> pagebits, n) for n, start in enumerate(struct.unpack_from("<%dI" % pagecount, self.map, pagestart))])
+        self.offsetsstart = pagestart + 4 * pagecount
+        self.readingsstart = self.offsetsstart + 4 * (pagecount * pagesize + 1)
+        
+        # A table that wasn't completely written would otherwise only fail when we came to look something up
+        if len(self.map) != self.readingsstart + readingsdatalength:
+            self.map.close()
+            raise IOError("The reading table at %s is %d bytes long, but its header says it should be %d" % (path, len(self.map), self.readingsstart + readingsdatalength))
+        
+        opentables.add(self)
+
+    """
+    Unmaps the table. Nothing can be looked up in it afterwards.
+    """
+    def close(self):
+        opentables.discard(self)
+        self.map.close()
+
+    def offsets(self, point):
+        page = self.pages.get(point >> pagebits)
+        if page is None:
+            return None, None
+
+        return struct.unpack_from("<II", self.map, self.offsetsstart + 4 * ((page << pagebits) + (point & (pagesize - 1))))
+
+    """
+    Returns the readings of the character, in the same order as the database would give them.
+    """
+    def readings(self, char):
+        point = codepoint(char)
+        if point is None:
+            return []
+
+        start, end = self.offsets(point)
+        if start == end:
+            return []
+
+        return self.map[self.readingsstart + start:self.readingsstart + end].decode("utf-8").split(u" ")
+
+    """
+    Returns every character that has some readings.
+    """
+    def characters(self):
+        characters = []
+        for page in sorted(self.pages.keys()):
+            for point in range(page << pagebits, (page + 1) << pagebits):
+                start, end = self.offsets(point)
+                if start != end:
+                    characters.append(character(point))
+
+        return characters
+
+"""
+Opens the reading table for the database, first building it if it doesn't exist or the database is
+newer than it. Returns None if we couldn't do that, in which case the database should be used instead.
+"""
+def load(database, dbpath, path=readingtablepath):
+    try:
+        if not(os.path.exists(path)) or os.path.getmtime(path) < os.path.getmtime(dbpath):
+            build(database, path)
+
+        return ReadingTable(path)
+    except (IOError, OSError, EnvironmentError, struct.error, ValueError), e:
+        # NB: mmap raises ValueError for an empty file
+        log.warn("Could not use the character reading table at %s, so falling back on the database: %s", path, e)
+        return None
@@ -2,8 +2,11 @@
 # -*- coding: utf-8 -*-
 
 import codecs
+import marshal
 import os
 import re
+import struct
+import sys
 import meanings
 
 import sqlalchemy
@@ -12,7 +15,8 @@ from sqlalchemy.schema import Table
 from model import *
 from utils import *
 
-from db import database
+from db import compiledtablename, database, dbpath
+import db.readingtable
 
 from logger import log
 
@@ -24,6 +28,12 @@ def parseMeaning(meaning, simptradindex):
     
     return lambda prefersimptrad, tonedcharscallback: meanings.MeaningFormatter(simptradindex, prefersimptrad).parsedefinition(meaning, tonedcharscallback)
 
+def parseCompiledMeaning(compiledmeaning, simptradindex):
+    if compiledmeaning is None:
+        return None
+    
+    return lambda prefersimptrad, tonedcharscallback: meanings.MeaningFormatter(simptradindex, prefersimptrad).parsecompileddefinition(compiledmeaning, tonedcharscallback)
+
 def fileSource(dictname):
     filename = toolkitdir("pinyin", "dictionaries", dictname)
     
@@ -32,11 +42,20 @@ def fileSource(dictname):
         log.warn("Skipping missing dictionary at %s", filename)
         return None
     
+    # Parsing a big dictionary line by line is slow, so we keep the result around in a compiled form
+    readingsmeanings = loadFileSourceCache(filename)
+    if readingsmeanings is None:
+        readingsmeanings = parseFileSource(filename)
+        saveFileSourceCache(filename, readingsmeanings)
+    
+    lookup = lambda word: [(reading, parseMeaning(meaning, 0)) for reading, meaning in readingsmeanings.get(word, [])]
+    return readingsmeanings.keys(), lookup, lookupeach(lookup)
+
+def parseFileSource(filename):
     log.info("Loading file-based dictionary from %s", filename)
     file = codecs.open(filename, "r", encoding='utf-8')
     try:
-        readingsmeanings = FactoryDict(lambda _: [])
-        maxcharacterlen = 0
+        readingsmeanings = {}
         for line in file:
             # Match this line
             m = PinyinDictionary.lineregex.match(line)
@@ -51,44 +70,224 @@ def fileSource(dictname):
             
             # Save meanings and readings
             for characters in [lcharacters, rcharacters]:
-                # Update the maximum character length
-                maxcharacterlen = max(maxcharacterlen, len(characters))
-                
                 # Save the readings and meanings for both simplified and traditional keys
-                readingsmeanings[characters].append((raw_pinyin, raw_definition))
+                readingsmeanings.setdefault(characters, []).append((raw_pinyin, raw_definition))
     finally:
         file.close()
     
-    return maxcharacterlen, lambda word: [(reading, parseMeaning(meaning, 0)) for reading, meaning in readingsmeanings[word]]
+    return readingsmeanings
+
+# Bump this whenever the format of the readings and meanings of a file-based dictionary changes
+filesourcecacheversion = 1
+
+def filesourcecachepath(filename):
+    return filename + ".cache"
+
+def filesourcecachestamp(filename):
+    # The compiled form is only good for as long as the dictionary it came from stays the same
+    return (filesourcecacheversion, filestamp(filename))
+
+def loadFileSourceCache(filename):
+    path = filesourcecachepath(filename)
+    if not(os.path.exists(path)):
+        return None
+    
+    try:
+        file = open(path, "rb")
+        try:
+            stamp, readingsmeanings = marshal.load(file)
+        finally:
+            file.close()
+    except (IOError, EOFError, ValueError, TypeError), e:
+        # Most likely written by a different version of Python, but it doesn't really matter
+        log.warn("Could not load the compiled dictionary from %s: %s", path, e)
+        return None
+    
+    if stamp != filesourcecachestamp(filename):
+        log.info("The compiled dictionary at %s is out of date", path)
+        return None
+    
+    log.info("Loaded compiled dictionary from %s", path)
+    return readingsmeanings
+
+def saveFileSourceCache(filename, readingsmeanings):
+    path = filesourcecachepath(filename)
+    try:
+        file = open(path, "wb")
+        try:
+            marshal.dump((filesourcecachestamp(filename), readingsmeanings), file)
+        finally:
+            file.close()
+    except IOError, e:
+        # Not being able to save it just means that we'll have to parse the dictionary again next time
+        log.warn("Could not save the compiled dictionary to %s: %s", path, e)
 
-def databaseDictionarySource(tablename, simptradindex):
+def databaseDictionarySource(tablename, simptradindex, memorylimit=None):
     log.info("Loading full dictionary from database table %s", tablename)
     
     dicttable = Table(tablename, database.metadata, autoload=True)
-    maxcharacterlen = database.selectScalar(sqlalchemy.func.max(sqlalchemy.func.length(dicttable.c.HeadwordSimplified)))
+    
+    # Prefer the definitions that were split up when the database was built, if it is new enough to have them
+    if database.hasTable(compiledtablename(tablename)):
+        compiledtable = Table(compiledtablename(tablename), database.metadata, autoload=True)
+        definitions = (dicttable.outerjoin(compiledtable, compiledtable.c.RowId == sqlalchemy.literal_column(tablename + ".rowid")),
+                       compiledtable.c.Definition, parseCompiledMeaning)
+    else:
+        log.info("The database has no compiled definitions for %s, so they will be parsed as we go", tablename)
+        definitions = (dicttable, dicttable.c.Translation, parseMeaning)
+    
+    fromtable, definitioncolumn, parsedefinition = definitions
+    rowidcolumn = sqlalchemy.literal_column(tablename + ".rowid")
+    
+    # Prefer to answer lookups from memory if the user has allowed us the space to do so
+    if memorylimit:
+        source = indexedDictionarySource(dicttable, definitions, simptradindex, memorylimit)
+        if source is not None:
+            return source
+    
+    # Most words are written the same way in both character sets, so don't keep two copies of those
+    headwords = [headword for simplified, traditional in database.selectRows(sqlalchemy.select([dicttable.c.HeadwordSimplified, dicttable.c.HeadwordTraditional]))
+                          for headword in (simplified == traditional and [simplified] or [simplified, traditional])]
     
     def inner(word):
         for reading, meaning in database.selectRows(sqlalchemy.select(
                 [dicttable.c.Reading,
-                 dicttable.c.Translation],
+                 definitioncolumn],
                 sqlalchemy.or_(dicttable.c.HeadwordSimplified == word,
-                               dicttable.c.HeadwordTraditional == word))):
-            yield (reading, parseMeaning(meaning, simptradindex))
+                               dicttable.c.HeadwordTraditional == word),
+                from_obj=[fromtable])):
+            yield (reading, parsedefinition(meaning, simptradindex))
     
-    return maxcharacterlen, inner
+    def many(words):
+        simplifiedmatches, traditionalmatches = dict([(word, []) for word in words]), dict([(word, []) for word in words])
+        for chunk in chunked(list(words), PinyinDictionary.maxquerywords):
+            chunkwords = set(chunk)
+            for simplified, traditional, reading, meaning in database.selectRows(sqlalchemy.select(
+                    [dicttable.c.HeadwordSimplified,
+                     dicttable.c.HeadwordTraditional,
+                     dicttable.c.Reading,
+                     definitioncolumn],
+                    sqlalchemy.or_(dicttable.c.HeadwordSimplified.in_(chunk),
+                                   dicttable.c.HeadwordTraditional.in_(chunk)),
+                    from_obj=[fromtable]).order_by(rowidcolumn)):
+                # Mimic the order of the single word query: simplified matches come before traditional ones
+                readingmeaning = (reading, parsedefinition(meaning, simptradindex))
+                if simplified in chunkwords:
+                    simplifiedmatches[simplified].append(readingmeaning)
+                if traditional != simplified and traditional in chunkwords:
+                    traditionalmatches[traditional].append(readingmeaning)
+        
+        return dict([(word, simplifiedmatches[word] + traditionalmatches[word]) for word in words])
+    
+    return headwords, inner, many
+
+"""
+Loads an entire dictionary table into memory, so that lookups are just a dictionary hit rather
+than an SQL query. Both the simplified and traditional headwords are mapped to the offsets of
+their rows, in the order the database would have returned them. Returns None without loading
+anything if we estimate that the table would need more than memorylimit bytes.
+"""
+def indexedDictionarySource(dicttable, (fromtable, definitioncolumn, parsedefinition), simptradindex, memorylimit):
+    estimate = estimatedIndexSize(dicttable, fromtable, definitioncolumn)
+    if estimate > memorylimit:
+        log.info("The table %s would need about %d bytes, more than the limit of %d, so it will be queried from the database instead", dicttable.name, estimate, memorylimit)
+        return None
+    
+    # The database answers with the rows matching on the simplified headword first, and only then
+    # those matching on just the traditional one, so we keep a seperate index for each
+    simplifiedindex, traditionalindex, readings, meanings = {}, {}, [], []
+    for offset, (simplified, traditional, reading, meaning) in enumerate(database.iterRows(sqlalchemy.select(
+            [dicttable.c.HeadwordSimplified,
+             dicttable.c.HeadwordTraditional,
+             dicttable.c.Reading,
+             definitioncolumn],
+            from_obj=[fromtable]).order_by(sqlalchemy.literal_column(dicttable.name + ".rowid")))):
+        readings.append(reading)
+        meanings.append(meaning)
+        
+        addoffset(simplifiedindex, simplified, offset)
+        if traditional != simplified:
+            addoffset(traditionalindex, traditional, offset)
+    
+    log.info("Indexed %d rows of %s in memory, using roughly %d bytes", len(readings), dicttable.name, estimate)
+    
+    def inner(word):
+        offsets = getoffsets(simplifiedindex, word) + getoffsets(traditionalindex, word)
+        return [(readings[offset], parsedefinition(meanings[offset], simptradindex)) for offset in offsets]
+    
+    # NB: the traditional index only has the headwords that differ from the simplified ones
+    return simplifiedindex.keys() + traditionalindex.keys(), inner, lookupeach(inner)
+
+"""
+Estimates how many bytes indexedDictionarySource would use for the table, from the number of rows and
+the total length of their text, without loading any of it. Every string and offset is a Python object
+of its own, and every row costs list slots and entries in the indexes and headword set as well.
+"""
+def estimatedIndexSize(dicttable, fromtable, definitioncolumn):
+    rows, headwordchars, readingchars, definitionchars = database.selectRows(sqlalchemy.select(
+            [sqlalchemy.func.count(),
+             sqlalchemy.func.sum(sqlalchemy.func.length(dicttable.c.HeadwordSimplified) + sqlalchemy.func.length(dicttable.c.HeadwordTraditional)),
+             sqlalchemy.func.sum(sqlalchemy.func.length(dicttable.c.Reading)),
+             sqlalchemy.func.sum(sqlalchemy.func.length(definitioncolumn))],
+            from_obj=[fromtable]))[0]
+    
+    pointer = struct.calcsize("P")
+    emptystring = sys.getsizeof(u"")
+    char = sys.getsizeof(u"ab") - sys.getsizeof(u"a")
+    
+    # Both headwords of a row are keys of an index and members of the headword set: dictionaries and sets
+    # are kept at most two thirds full, and entries hold a hash as well as their pointers
+    perrow = 4 * emptystring + 2 * pointer + sys.getsizeof(rows) + 2 * (3 * pointer * 3 / 2 + 2 * pointer * 3 / 2)
+    return rows * perrow + ((headwordchars or 0) + (readingchars or 0) + (definitionchars or 0)) * char
+
+def addoffset(index, headword, offset):
+    # Most headwords have exactly one row, so only pay for a tuple when there is more than one
+    offsets = index.get(headword)
+    if offsets is None:
+        index[headword] = offset
+    elif isinstance(offsets, tuple):
+        index[headword] = offsets + (offset,)
+    else:
+        index[headword] = (offsets, offset)
+
+def getoffsets(index, headword):
+    offsets = index.get(headword, ())
+    if isinstance(offsets, tuple):
+        return offsets
+    else:
+        return (offsets,)
 
 def databaseReadingSource():
     log.info("Loading character reading database")
     
+    # Every lookup is just a read at an offset into the reading table, if we can get hold of it
+    table = db.readingtable.load(database, dbpath)
+    if table is not None:
+        lookup = lambda word: [(reading, None) for reading in table.readings(word)]
+        return table.characters(), lookup, lookupeach(lookup)
+    
     readingtable = sqlalchemy.Table("CharacterPinyin", database.metadata, autoload=True)
+    characters = database.selectScalars(sqlalchemy.select([readingtable.c.ChineseCharacter], distinct=True))
+    
+    def many(words):
+        readings = dict([(word, []) for word in words])
+        for chunk in chunked(list(words), PinyinDictionary.maxquerywords):
+            for character, reading in database.selectRows(sqlalchemy.select(
+                    [readingtable.c.ChineseCharacter, readingtable.c.Reading],
+                    readingtable.c.ChineseCharacter.in_(chunk)).order_by(readingtable.c.ChineseCharacter, readingtable.c.Reading)):
+                readings[character].append((reading, None))
+        
+        return readings
     
-    return 1, lambda word: [(reading[0], None) for reading in database.selectRows(sqlalchemy.select([readingtable.c.Reading], readingtable.c.ChineseCharacter == word))]
+    inner = lambda word: [(reading[0], None) for reading in database.selectRows(sqlalchemy.select([readingtable.c.Reading], readingtable.c.ChineseCharacter == word))]
+    return characters, inner, many
 
-def squelchMeaning(maxlensource):
+def squelchMeaning(headwordssource):
     log.info("Preparing to squelch meanings")
     
-    def inner(word):
-        for reading, meaningfun in maxlensource[1](word):
+    headwords, lookup, lookupmany = headwordssource
+    def squelchall(readingsmeanings):
+        for reading, meaningfun in readingsmeanings:
             if meaningfun is None:
                 yield reading, None
             else:
@@ -98,7 +297,58 @@ def squelchMeaning(maxlensource):
                 
                 yield reading, squelch
     
-    return maxlensource[0], inner
+    return headwords, lambda word: squelchall(lookup(word)), lambda words: dict([(word, list(squelchall(readingsmeanings))) for word, readingsmeanings in lookupmany(words).items()])
+
+# How the headword filter of each source has answered queries so far, by the name of the source
+headwordfilterstatistics = {}
+
+"""
+Reports how the headword filter of each source has answered queries so far.
+"""
+def filterstatistics():
+    return dict([(name, dict(statistics)) for name, statistics in headwordfilterstatistics.items()])
+
+"""
+A source that gets loaded again whenever the data it was loaded from changes. The stamp
+function summarises the state of that data, and must be cheap as it is checked often.
+The loader may return None if the data is not there (yet).
+"""
+class ReloadableSource(object):
+    def __init__(self, name, stamp, load):
+        self.name = name
+        self.stamp = stamp
+        self.load = load
+        
+        self.currentstamp = stamp()
+        self.current = load() or emptysource
+    
+    """
+    Reloads the source if its data has changed, reporting whether it did so.
+    """
+    def refresh(self):
+        stamp = self.stamp()
+        if stamp == self.currentstamp:
+            return False
+        
+        log.info("The data for the %s dictionary source has changed, so reloading it", self.name)
+        self.currentstamp = stamp
+        self.current = self.load() or emptysource
+        return True
+
+emptysource = ([], lambda word: [], lambda words: dict([(word, []) for word in words]))
+
+def fileReloadableSource(dictname):
+    return ReloadableSource(dictname, lambda: filestamp(toolkitdir("pinyin", "dictionaries", dictname)), lambda: fileSource(dictname))
+
+def databaseReloadableSource(name, load):
+    # Rebuilding the database replaces the file, so anything we loaded from it has to go
+    return ReloadableSource(name, lambda: filestamp(dbpath), load)
+
+"""
+Builds the batched lookup for a source that can answer a single lookup cheaply anyway.
+"""
+def lookupeach(lookup):
+    return lambda words: dict([(word, list(lookup(word))) for word in words])
 
 """
 Encapsulates one or more Chinese dictionaries, and provides the ability to transform
@@ -108,24 +358,49 @@ class PinyinDictionary(object):
     # Regular expression used for pulling stuff out of the dictionary
     lineregex = re.compile(r"^([^#\s]+)\s+([^\s]+)\s+\[([^\]]+)\](\s+)?(.*)$")
     
+    # Batched lookups are split up so we stay well clear of SQLite's limit on query parameters
+    maxquerywords = 400
+    
+    # How many words the lookup cache of each source remembers, by default
+    defaultcachesize = 5000
+    
+    # The settings loadall was last asked for and the dictionaries it loaded with them. Only the latest are
+    # kept, so that trying out other settings in the preferences doesn't keep every set we ever loaded alive.
+    lastloaded = None
+    
+    """
+    Returns a function from a language to the dictionary for it. Every caller with the same settings as the last
+    one shares the same dictionaries, so e.g. opening the preferences doesn't mean loading them all over again.
+    """
+    @classmethod
+    def loadall(cls, memorylimit=None, cachesize=None):
+        if cachesize is None:
+            cachesize = PinyinDictionary.defaultcachesize
+        
+        key = (memorylimit, cachesize)
+        if cls.lastloaded is None or cls.lastloaded[0] != key:
+            cls.lastloaded = (key, cls.loadallafresh(memorylimit, cachesize))
+        
+        return cls.lastloaded[1]
+    
     @classmethod
-    def loadall(cls):
+    def loadallafresh(cls, memorylimit, cachesize):
         def buildDictionary(usefallback, table, simptradindex):
             # DEBUG - this means that we will lose measure words for languages other than English - seperate the two
             rawsources = [
                     # User dictionary has absolute priority
-                    fileSource('dict-userdict.txt'),
+                    fileReloadableSource('dict-userdict.txt'),
                     # Pinyin Toolkit specific overrides for system dictionaries
-                    fileSource('pinyin_toolkit_sydict.u8'),
+                    fileReloadableSource('pinyin_toolkit_sydict.u8'),
                     # Main language database
-                    table and databaseDictionarySource(table, simptradindex) or None,
+                    table and databaseReloadableSource(table, lambda: databaseDictionarySource(table, simptradindex, memorylimit)) or None,
                     # Fallback databases for readings only if we have a non-english primary database
-                    usefallback and squelchMeaning(databaseDictionarySource("CEDICT", 1)) or None,
+                    usefallback and databaseReloadableSource("CEDICT (readings only)", lambda: squelchMeaning(databaseDictionarySource("CEDICT", 1, memorylimit))) or None,
                     # Unihan as a last resort - lowest quality data
-                    databaseReadingSource()
+                    databaseReloadableSource("CharacterPinyin", databaseReadingSource)
                 ]
             
-            return PinyinDictionary([source for source in rawsources if source is not None])
+            return PinyinDictionary([source for source in rawsources if source is not None], cachesize)
         
         dictionaries = {}
         for language, table, simptradindex in [('en', "CEDICT", 1), ('de', "HanDeDict", 0), ('fr', "CFDICT", 0), ('default', None, None)]:
@@ -136,16 +411,194 @@ class PinyinDictionary(object):
         
         return inner
     
-    def __init__(self, maxlenssources):
-        maxlens, self.__sources = unzip(maxlenssources)
-        self.__maxcharacterlen = max(maxlens)
+    def __init__(self, headwordssources, cachesize=None):
+        # Sources which can't change underneath us are just never reloaded
+        self.__sources = [isinstance(source, ReloadableSource) and source or ReloadableSource(None, lambda: None, lambda source=source: source) for source in headwordssources]
+        
+        # Each source gets its own cache, so that it can be thrown away when just that source is reloaded.
+        # The cached lists must never be handed out directly, or callers could mutate them!
+        if cachesize is None:
+            cachesize = PinyinDictionary.defaultcachesize
+        self.__caches = [LRUCache(cachesize) for source in self.__sources]
+        
+        # Built the first time we parse something, since a dictionary that is only ever asked for exact words doesn't need it
+        self.__trie = None
+    
+    def buildtrie(self):
+        # One trie over the headwords of every source lets us find all the words starting at
+        # a given position in a single walk, rather than probing every source at every length.
+        # Each headword is tagged with the sources that have it, so the trie also tells us which
+        # sources are worth asking about a word: we needn't keep a set of headwords for that too.
+        trie = Trie()
+        for n, source in enumerate(self.__sources):
+            for headword in source.current[0]:
+                trie.add(headword, 1 << n)
+        
+        self.__trie = trie
+    
+    def headwordtrie(self):
+        if self.__trie is None:
+            self.buildtrie()
+        
+        return self.__trie
+    
+    # Checks whether the nth source has the word as a headword, so that words it doesn't have never reach it
+    def sourcehasheadword(self, n, word):
+        statistics = headwordfilterstatistics.setdefault(self.__sources[n].name, { "hits" : 0, "misses" : 0 })
+        if self.headwordtrie().tags(word) & (1 << n):
+            statistics["hits"] += 1
+            return True
+        else:
+            statistics["misses"] += 1
+            return False
+    
+    """
+    Reloads any sources whose data has changed since we last looked, forgetting what we cached from them.
+    """
+    def refresh(self):
+        anyreloaded = False
+        for source, cache in zip(self.__sources, self.__caches):
+            if source.refresh():
+                cache.clear()
+                anyreloaded = True
+        
+        if anyreloaded:
+            self.__trie = None
+    
+    """
+    Reports how the lookup cache of each source has performed so far.
+    """
+    def cachestatistics(self):
+        return [(source.name, cache.statistics()) for source, cache in zip(self.__sources, self.__caches)]
+
+    """
+    Segment a string of Hanzi against the dictionary once, so that its reading, toned characters and
+    meanings can all be derived from the same result without looking anything up again.
+    """
+    def parseexpression(self, sentence):
+        log.info("Requested parse of %s", sentence)
+        return ParsedExpression(list(self.parse(sentence)), self.tonedchars)
 
     """
     Given a string of Hanzi, return the result rendered into a list of Pinyin and unrecognised tokens (as strings).
     """
     def reading(self, sentence):
-        log.info("Requested reading for %s", sentence)
+        return self.parseexpression(sentence).reading()
+
+    """
+    Given a string of Hanzi, return the result rendered into a list of characters with tone information and unrecognised tokens (as string).
+    """
+    def tonedchars(self, sentence):
+        return self.parseexpression(sentence).tonedchars()
+
+    """
+    Given a string of Hanzi, return meanings and measure words for the first recognisable thing in the string.
+    If there is more than one recognisable thing then assume it is a phrase and don't return a meaning.
+    """
+    def meanings(self, sentence, prefersimptrad):
+        return self.parseexpression(sentence).meanings(prefersimptrad)
+
+    def parse(self, sentence):
+        assert type(sentence)==unicode
+        if sentence == None or len(sentence) == 0:
+            return
+        
+        # Strip HTML
+        sentence = striphtml(sentence)
+        
+        # Pick up any changes to the user dictionary or database before we start
+        self.refresh()
+        trie = self.headwordtrie()
+        
+        # Segment the text without consulting the sources at all: the longest word the trie knows
+        # to start at each position wins, and anything else is a single unrecognised character
+        segments = []
+        i = 0;
+        while i < len(sentence):
+            word_lens = trie.matchlengths(sentence, i)
+            if len(word_lens) > 0:
+                segments.append((True, sentence[i:i + word_lens[-1]]))
+                i += word_lens[-1]
+            else:
+                # Failed to find a single valid word in this text, so let's just yield
+                # a single character token. TODO: yield multi-character tokens for efficiency.
+                segments.append((False, sentence[i:i+1]))
+                i += 1
+        
+        # Now fetch the readings and meanings for all the words at once, in one batch per source
+        readingsmeaningsbyword = self.parseexactmany(set([text for isword, text in segments if isword]))
+        for isword, text in segments:
+            if isword and len(readingsmeaningsbyword[text]) > 0:
+                # A real word! Give every occurrence its own list, because callers may consume it
+                yield (list(readingsmeaningsbyword[text]), text)
+            else:
+                yield (None, text)
+    
+    # The readings and meaning functions returned for a word should correspond to each other,
+    # and be returned in priority order: highest priority first
+    def parseexact(self, word):
+        self.refresh()
+        
+        readingsmeanings = []
+        for n, (source, cache) in enumerate(zip(self.__sources, self.__caches)):
+            if not(self.sourcehasheadword(n, word)):
+                continue
+            
+            sourcereadingsmeanings = cache.get(word)
+            if sourcereadingsmeanings is None:
+                sourcereadingsmeanings = list(source.current[1](word))
+                cache.put(word, sourcereadingsmeanings)
+            
+            readingsmeanings.extend(sourcereadingsmeanings)
+        
+        # TODO: (perhaps) consolidate competing definitions from a single source if
+        # they occur as a result of simplification and we prefer simplified characters
+        
+        # TODO: match up definitions /across/ sources so that we can get measure word
+        # information in German (for example). (#120)
+        
+        return readingsmeanings
+    
+    # As parseexact, but for many words at once: returns a dictionary from each word to its readings and meanings
+    def parseexactmany(self, words):
+        readingsmeaningsbyword = dict([(word, []) for word in words])
+        if len(readingsmeaningsbyword) == 0:
+            return readingsmeaningsbyword
+        
+        for n, (source, cache) in enumerate(zip(self.__sources, self.__caches)):
+            # Only go to the source for the words it has that it hasn't told us about recently
+            uncachedwords = []
+            for word in readingsmeaningsbyword:
+                if not(self.sourcehasheadword(n, word)):
+                    continue
+                
+                sourcereadingsmeanings = cache.get(word)
+                if sourcereadingsmeanings is None:
+                    uncachedwords.append(word)
+                else:
+                    readingsmeaningsbyword[word].extend(sourcereadingsmeanings)
+            
+            if len(uncachedwords) > 0:
+                for word, sourcereadingsmeanings in source.current[2](uncachedwords).items():
+                    cache.put(word, sourcereadingsmeanings)
+                    readingsmeaningsbyword[word].extend(sourcereadingsmeanings)
         
+        return readingsmeaningsbyword
+
+"""
+A string of Hanzi as segmented by a PinyinDictionary. Its reading, toned characters and meanings
+are all views onto the same segmentation, and none of them change it.
+"""
+class ParsedExpression(object):
+    def __init__(self, parsed, tonedcharscallback):
+        self.parsed = parsed
+        self.tonedcharscallback = tonedcharscallback
+    
+    """
+    The result rendered into a list of Pinyin and unrecognised tokens (as strings).
+    """
+    def reading(self):
+        tracker = NeedsSpaceBeforeAppendTracker()
         def addword(words, _text, readingtokens):
             # If we already have some text building up, add a preceding space.
             # However, if the word we got looks like a period, don't do it.
@@ -154,8 +607,8 @@ class PinyinDictionary(object):
             # also important for punctuation consistency, because Western
             # punctuation is typically followed by a space whereas the Chinese
             # equivalents are not.
-            words_need_space = needsspacebeforeappend(words)
-            is_punctuation = ispunctuation(flatten(readingtokens))
+            words_need_space = tracker.needsspacebeforeappend(words)
+            is_punctuation = tokensarepunctuation(readingtokens)
             reading_starts_with_er = len(readingtokens) > 0 and readingtokens[0].iser
             if words_need_space and not(is_punctuation) and not(reading_starts_with_er):
                 words.append(Word(Text(u' ')))
@@ -163,25 +616,23 @@ class PinyinDictionary(object):
             # Add this reading into the token list with nice formatting
             words.append(Word.spacedwordfromunspacedtokens(readingtokens))
         
-        return self.mapparsedtokens(sentence, addword)
-
+        return self.mapparsedtokens(addword)
+    
     """
-    Given a string of Hanzi, return the result rendered into a list of characters with tone information and unrecognised tokens (as string).
+    The result rendered into a list of characters with tone information and unrecognised tokens (as string).
     """
-    def tonedchars(self, sentence):
-        log.info("Requested toned characters for %s", sentence)
-        
+    def tonedchars(self):
         def addword(words, text, readingtokens):
             # Match up the reading data with the characters to produce toned characters
             words.append(Word(*(tonedcharactersfromreading(text, readingtokens))))
         
-        return self.mapparsedtokens(sentence, addword)
-
-    def mapparsedtokens(self, sentence, addword):
+        return self.mapparsedtokens(addword)
+    
+    def mapparsedtokens(self, addword):
         # Represents the resulting stream of words
         words = []
         
-        for readingsmeanings, text in self.parse(sentence):
+        for readingsmeanings, text in self.parsed:
             if readingsmeanings is None:
                 # A single unrecognised character: it's probably just whitespace or punctuation.
                 # Append it directly to the token list.
@@ -192,17 +643,15 @@ class PinyinDictionary(object):
                 addword(words, text, tokenizespaceseperatedtext(readingsmeanings[0][0]))
         
         return words
-
+    
     """
-    Given a string of Hanzi, return meanings and measure words for the first recognisable thing in the string.
-    If there is more than one recognisable thing then assume it is a phrase and don't return a meaning.
+    Meanings and measure words for the first recognisable thing in the string. If there is
+    more than one recognisable thing then assume it is a phrase and don't return a meaning.
     """
-    def meanings(self, sentence, prefersimptrad):
-        log.info("Requested meanings for %s", sentence)
-        
+    def meanings(self, prefersimptrad):
         isfirstparsedthing = True
         foundmeanings, foundmeasurewords = None, None
-        for readingsmeanings, text in self.parse(sentence):
+        for readingsmeanings, text in self.parsed:
             if readingsmeanings is None and (ispunctuation(text.strip()) or text.strip() == u""):
                 # Discard punctuation and whitespace from consideration, or we don't return a reading for e.g. "你好!"
                 continue
@@ -218,68 +667,22 @@ class PinyinDictionary(object):
             isfirstparsedthing = False
             
             if readingsmeanings is not None:
-                # A recognised thing!  Find the definition in the dictionary:
-                while len(readingsmeanings) > 0 and readingsmeanings[0][1] is None:
-                    readingsmeanings.pop(0)
+                # A recognised thing!  Find the first definition in the dictionary, leaving the
+                # readings alone so that the other views of this expression still see them all:
+                meaningfuns = [meaningfun for _reading, meaningfun in readingsmeanings if meaningfun is not None]
                 
                 # Did we actually have a non-null meaning in there?
-                if len(readingsmeanings) == 0:
+                if len(meaningfuns) == 0:
                     # NB: we return None if there is no meaning in the codomain. This case can
                     # occur if the character only comes
                     log.info("We found a reading but no meaning for some text")
                     return None, None
                 else:
                     # Instantiate the raw definition with our particular requirements
-                    foundmeanings, foundmeasurewords = readingsmeanings[0][1](prefersimptrad, self.tonedchars)
+                    foundmeanings, foundmeasurewords = meaningfuns[0](prefersimptrad, self.tonedcharscallback)
                     
         return foundmeanings, foundmeasurewords
 
-    def parse(self, sentence):
-        assert type(sentence)==unicode
-        if sentence == None or len(sentence) == 0:
-            return
-        
-        # Strip HTML
-        sentence = striphtml(sentence)
-        
-        # Iterate through the text
-        i = 0;
-        while i < len(sentence):
-            # Try all possible word lengths (naive, but easy to code)
-            found_something = False
-            for word_len in range(self.__maxcharacterlen, 0, -1):
-                candidate_word = sentence[i:i + word_len]
-                readingmeanings = self.parseexact(candidate_word)
-                if len(readingmeanings) > 0:
-                    # A real word! Let's yield it immediately
-                    yield (readingmeanings, candidate_word)
-                    
-                    # Continue looking for a new word after the end of this one
-                    found_something = True
-                    i += word_len
-                    break
-            
-            if not(found_something):
-                # Failed to find a single valid word in this text, so let's just yield
-                # a single character token. TODO: yield multi-character tokens for efficiency.
-                yield (None, sentence[i:i+1])
-                i += 1
-    
-    # The readings and meaning functions returned for a word should correspond to each other,
-    # and be returned in priority order: highest priority first
-    def parseexact(self, word):
-        readingsmeanings = []
-        for source in self.__sources:
-            readingsmeanings.extend(source(word))
-        
-        # TODO: (perhaps) consolidate competing definitions from a single source if
-        # they occur as a result of simplification and we prefer simplified characters
-        
-        # TODO: match up definitions /across/ sources so that we can get measure word
-        # information in German (for example). (#120)
-        
-        return readingsmeanings
-
 def combinemeaningsmws(dictmeanings, dictmeasurewords):
     if dictmeasurewords is not None and len(dictmeasurewords) > 0:
         return (dictmeanings or []) + [[Word(Text("MW: "))] + flattenmeasurewords(dictmeasurewords)]
@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import base64
+import marshal
 import re
 
 from logger import log
@@ -10,84 +12,161 @@ import utils
 class MeaningFormatter(object):
     embeddedchineseregex = re.compile(r"(?:(?:([^\|\[\s]+)\|([^\|\[\s]+)(?:\s*\[([^\]]*)\])?)|(?:([^\|\[\s]+)\s*\[([^\]]*)\]))")
     
+    # The same definitions get formatted over and over again, so remember how we parsed the
+    # most recent ones. Keyed by the raw definition, simplified character index and simp/trad preference.
+    parsedcache = utils.LRUCache(10000)
+    
     def __init__(self, simplifiedcharindex, prefersimptrad):
         self.simplifiedcharindex = simplifiedcharindex
         self.prefersimptrad = prefersimptrad
     
     def parsedefinition(self, raw_definition, tonedchars_callback=None):
-        log.info("Parsing the raw definition %s", raw_definition)
-        
+        return self.instantiatestructure(self.cachedstructure((raw_definition, False), lambda: self.formatsplitdefinition(splitdefinition(raw_definition, log_parsing=True))), tonedchars_callback)
+    
+    """
+    As parsedefinition, but for a definition that was already split up by compiledefinition.
+    """
+    def parsecompileddefinition(self, compiled_definition, tonedchars_callback=None):
+        return self.instantiatestructure(self.cachedstructure((compiled_definition, True), lambda: self.formatsplitdefinition(decompiledefinition(compiled_definition))), tonedchars_callback)
+    
+    def instantiatestructure(self, structure, tonedchars_callback):
         # Default the toned characters callback to something sensible
         if tonedchars_callback is None:
             tonedchars_callback = lambda characters: [Word(Text(characters))]
         
-        meanings, measurewords = [], []
-        for definition in raw_definition.strip().lstrip("/").rstrip("/").split("/"):
-            # Remove stray spaces
-            definition = definition.strip()
+        # Fill in the characters we had no pinyin for using the callback. Everything else is
+        # copied, so that whoever we give the meanings to can't damage the cached version.
+        meaningspieces, measurewords = structure
+        meanings = []
+        for pieces in meaningspieces:
+            words = []
+            for piece in pieces:
+                if isinstance(piece, Word):
+                    words.append(Word(*piece))
+                else:
+                    # Look up the tone for the character so we can display it more nicely
+                    words.extend(tonedchars_callback(piece))
             
-            # Detect measure-word ness
-            if definition.startswith("CL:"):
-                ismeasureword = True
-                
-                # Measure words are comma-seperated
-                for mw in definition[3:].strip().split(","):
-                    # Attempt to parse the measure words as structured data
-                    match = self.embeddedchineseregex.match(mw)
-                    if match is None:
-                        log.info("Could not parse the apparent measure word %s", mw)
-                        continue
-                    
-                    # They SHOULD have pinyin information
-                    characterswords, pinyinwords = self.formatmatch(match, tonedchars_callback)
-                    if characterswords is None or pinyinwords is None:
-                        log.info("The measure word %s was missing some information in the dictionary", mw)
-                        continue
-                    
-                    measurewords.append((characterswords, pinyinwords))
-            else:
-                words = []
-                for ismatch, thing in utils.regexparse(self.embeddedchineseregex, definition):
-                    if ismatch:
-                        # A match - we can append a representation of the words it contains
-                        (characterwords, pinyinwords) = self.formatmatch(thing, tonedchars_callback)
-                        
-                        # Put the resulting words right into the output in a human-readable format
-                        words.extend(characterwords)
-                        if pinyinwords is not None:
-                            words.append(Word(Text(" - ")))
-                            words.extend(pinyinwords)
+            meanings.append(words)
+        
+        return meanings, [([Word(*word) for word in characterswords], [Word(*word) for word in pinyinwords]) for characterswords, pinyinwords in measurewords]
+    
+    """
+    Finds the formatted structure of a definition: the tokenization is the expensive bit, so we
+    remember the most recent ones. Each meaning is a list of pieces: either Words, or strings of
+    characters which still need turning into Words by the toned characters callback.
+    """
+    def cachedstructure(self, definitionkey, format):
+        key = (definitionkey, self.simplifiedcharindex, self.prefersimptrad)
+        structure = MeaningFormatter.parsedcache.get(key)
+        if structure is None:
+            structure = format()
+            MeaningFormatter.parsedcache.put(key, structure)
+        
+        return structure
+    
+    def formatsplitdefinition(self, (definitions, measurewords)):
+        meaningspieces = []
+        for definition in definitions:
+            pieces = []
+            for thing in definition:
+                if isinstance(thing, tuple):
+                    # A match - we can append a representation of the words it contains
+                    character, pinyintokens = self.matchcharacterpinyin(thing)
+                    if pinyintokens is None:
+                        # We'll have to find out the tones of the characters later on
+                        pieces.append(character)
                     else:
-                        # Just a string: append it as a list of tokens, trying to extract any otherwise-unmarked
-                        # pinyin in the sentence for colorisation etc
-                        words.append(Word(*tokenize(thing, forcenumeric=True)))
-                
-                meanings.append(words)
+                        # Put the resulting words right into the output in a human-readable format
+                        characterwords, pinyinwords = self.formatcharacterpinyin(character, pinyintokens)
+                        pieces.extend(characterwords)
+                        pieces.append(Word(Text(" - ")))
+                        pieces.extend(pinyinwords)
+                else:
+                    # Just a string: append it as a list of tokens, trying to extract any otherwise-unmarked
+                    # pinyin in the sentence for colorisation etc
+                    pieces.append(Word(*tokenize(thing, forcenumeric=True)))
             
-        return meanings, measurewords
+            meaningspieces.append(pieces)
+        
+        formattedmeasurewords = []
+        for mw in measurewords:
+            # They SHOULD have pinyin information
+            character, pinyintokens = self.matchcharacterpinyin(mw)
+            if pinyintokens is None:
+                log.info("The measure word %s was missing some information in the dictionary", character)
+                continue
+            
+            formattedmeasurewords.append(self.formatcharacterpinyin(character, pinyintokens))
+        
+        return meaningspieces, formattedmeasurewords
+    
+    def formatcharacterpinyin(self, character, pinyintokens):
+        return ([Word(*(tonedcharactersfromreading(character, pinyintokens)))], [Word.spacedwordfromunspacedtokens(pinyintokens)])
     
-    def formatmatch(self, match, tonedchars_callback):
-        if match.group(4) != None:
+    # Takes the groups matched by embeddedchineseregex
+    def matchcharacterpinyin(self, (bothfirst, bothsecond, bothpinyin, single, singlepinyin)):
+        if single != None:
             # A single character standing by itself, with no | - just use the character
-            character = match.group(4)
+            character = single
         elif self.prefersimptrad == "simp":
             # A choice of characters, and we want the simplified one
-            character = match.group(1 + self.simplifiedcharindex)
+            character = [bothfirst, bothsecond][self.simplifiedcharindex]
         else:
             # A choice of characters, and we want the traditional one
-            character = match.group(1 + (1 - self.simplifiedcharindex))
+            character = [bothfirst, bothsecond][1 - self.simplifiedcharindex]
         
-        if match.group(4) != None:
+        if single != None:
             # Pinyin tokens (if any) will be present in single-character match case
-            rawpinyin = match.group(5)
+            rawpinyin = singlepinyin
         else:
             # Pinyin tokens (if any) will be present in conjunctive character match case
-            rawpinyin = match.group(3)
+            rawpinyin = bothpinyin
         
         if rawpinyin != None:
-            # There was some pinyin for the character after it - include it
-            pinyintokens = tokenizespaceseperatedtext(rawpinyin)
-            return ([Word(*(tonedcharactersfromreading(character, pinyintokens)))], [Word.spacedwordfromunspacedtokens(pinyintokens)])
+            # There was some pinyin for the character after it
+            return character, tokenizespaceseperatedtext(rawpinyin)
         else:
-            # Look up the tone for the character so we can display it more nicely, as in the other branch
-            return (tonedchars_callback(character), None)
+            return character, None
+
+"""
+Splits a raw definition up into its definitions and measure words, without making any decisions
+about which characters to show or doing any tokenization. Each definition is a list of strings of
+plain text and tuples of the groups matched by MeaningFormatter.embeddedchineseregex, and each
+measure word is such a tuple. Deliberately contains only simple Python values, so that we can
+save the result in the database when we build it.
+"""
+def splitdefinition(raw_definition, log_parsing=False):
+    if log_parsing:
+        log.info("Parsing the raw definition %s", raw_definition)
+    
+    definitions, measurewords = [], []
+    for definition in raw_definition.strip().lstrip("/").rstrip("/").split("/"):
+        # Remove stray spaces
+        definition = definition.strip()
+        
+        # Detect measure-word ness
+        if definition.startswith("CL:"):
+            # Measure words are comma-seperated
+            for mw in definition[3:].strip().split(","):
+                # Attempt to parse the measure words as structured data
+                match = MeaningFormatter.embeddedchineseregex.match(mw)
+                if match is None:
+                    log.info("Could not parse the apparent measure word %s", mw)
+                    continue
+                
+                measurewords.append(match.groups())
+        else:
+            definitions.append([ismatch and thing.groups() or thing for ismatch, thing in utils.regexparse(MeaningFormatter.embeddedchineseregex, definition)])
+    
+    return definitions, measurewords
+
+"""
+Turns a raw definition into a string that can be stored in the database and later handed to
+MeaningFormatter.parsecompileddefinition, saving us from having to split it up at runtime.
+"""
+def compiledefinition(raw_definition):
+    return base64.b64encode(marshal.dumps(splitdefinition(raw_definition)))
+
+def decompiledefinition(compiled_definition):
+    return marshal.loads(base64.b64decode(compiled_definition))
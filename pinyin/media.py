@@ -1,11 +1,13 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import marshal
 import os
 import re
 import urllib
 import shutil
 import tempfile
+import time
 import zipfile
 
 from logger import log
@@ -30,6 +32,9 @@ def downloadAndInstallMandarinSounds(notifier, mediamanager, config):
     except zipfile.BadZipfile, e:
         notifier.exception("The downloaded sound pack appeared to be corrupt")
         return
+    
+    # The new pack should be used straight away, whatever the file system told us about modification times
+    mediamanager.refreshmediapacks()
 
     # Tell the user we are done
     exampleAudioField = config.candidateFieldNamesByKey['audio'][0]
@@ -149,6 +154,185 @@ class MediaPack(object):
         
         return MediaPack(packpath, media)
 
+"""
+Remembers the media packs found in a media directory, so that we only list the packs again when
+one of them has been added, removed or modified since we last did.
+
+The media directory is usually the collection's own, which changes every time Anki imports a file,
+so we don't go by its modification time. Instead we look for new subdirectories among the names in
+it we haven't seen before, and go by the modification time of each pack.
+
+Some file systems only record modification times to the second (or two, for FAT), so a file added
+to a pack just after we listed it can leave its modification time exactly as we recorded it. We
+can't trust a modification time that close to when we listed, so in that case we list the packs
+again next time too, until they have stayed unmodified for long enough that we can.
+"""
+class MediaPackDiscoverer(object):
+    # The coarsest modification time resolution of the file systems we expect to see, in seconds
+    mtimegranularity = 2
+    
+    def __init__(self):
+        self.refresh()
+    
+    def refresh(self):
+        self.mediadir = None
+        self.filenames = set()
+        self.mtimes = None
+        self.mediapacks = None
+        self.settled = False
+    
+    def discover(self, mediadir):
+        if mediadir != self.mediadir:
+            self.refresh()
+            self.mediadir = mediadir
+        
+        # NB: the times are taken before listing the packs, so we notice anything that changes them while we are doing so
+        listed = time.time()
+        packpaths = self.findpacks(mediadir)
+        mtimes = modificationtimes(packpaths)
+        if self.mediapacks is None or not(self.settled) or mtimes != self.mtimes:
+            self.mtimes = mtimes
+            self.mediapacks = []
+            for packpath in packpaths:
+                log.info("Considering %s as a media pack", os.path.basename(packpath))
+                self.mediapacks.append(MediaPack.frompath(packpath))
+            
+            self.settled = mtimes is not None and len([mtime for mtime in mtimes.values() if mtime >= listed - MediaPackDiscoverer.mtimegranularity]) == 0
+        
+        return self.mediapacks
+    
+    def findpacks(self, mediadir):
+        packpaths, filenames = [], set()
+        for name in os.listdir(mediadir):
+            # Skip the download cache directory
+            if name.lower() == "downloads":
+                continue
+            
+            # Only directories are packs. Most of the names are files we have already seen, so don't look at those again.
+            packpath = os.path.join(mediadir, name)
+            if name in self.filenames or not(os.path.isdir(packpath)):
+                if name not in self.filenames:
+                    log.info("Ignoring the file %s in the media directory", name)
+                filenames.add(name)
+            else:
+                packpaths.append(packpath)
+        
+        self.filenames = filenames
+        return packpaths
+
+# Returns the modification times of the paths, or None if any of them can't be found any more
+def modificationtimes(paths):
+    try:
+        return dict([(path, os.path.getmtime(path)) for path in paths])
+    except OSError:
+        return None
+
+"""
+Remembers the name that each media file got when it was imported into a collection, so that importing
+the same unchanged file again doesn't make the collection hash and copy it all over again. What we
+remember is saved to a file, and each entry is only checked against the collection when it is used.
+"""
+class MediaImportCache(object):
+    # Bump this whenever the format of the saved imports changes
+    version = 1
+    
+    def __init__(self, mediadir, path):
+        self.mediadir = mediadir
+        self.path = path
+        
+        # Loaded the first time we need them
+        self.imports = None
+        
+        # Source files whose imported media we have seen in the collection since we started
+        self.verified = set()
+        
+        # Whether we have imported anything since we last saved
+        self.dirty = False
+    
+    @classmethod
+    def forcollection(cls, mediadir):
+        # Keep the imports of different collections apart by naming the file after the media directory
+        if isinstance(mediadir, unicode):
+            mediadirkey = mediadir.encode("utf-8")
+        else:
+            mediadirkey = mediadir
+        
+        return MediaImportCache(mediadir, utils.toolkitdir("pinyin", "db", "imports-%s.cache" % utils.md5(mediadirkey)))
+    
+    """
+    Returns the name of the file in the collection, importing it with the given function if we don't
+    already know that the current version of the file is in there.
+    """
+    def importfile(self, filepath, doimport):
+        filepath = os.path.abspath(filepath)
+        stamp = utils.filestamp(filepath)
+        
+        if self.imports is None:
+            self.imports = self.load()
+        
+        stampname = self.imports.get(filepath)
+        if stamp is not None and stampname is not None and stampname[0] == stamp and self.isimported(filepath, stampname[1]):
+            return stampname[1]
+        
+        name = doimport(filepath)
+        self.imports[filepath] = (stamp, name)
+        self.verified.add(filepath)
+        
+        # Saving rewrites the whole file, so leave it until whoever is importing has finished a batch
+        self.dirty = True
+        
+        return name
+    
+    """
+    Saves whatever has been imported since we last did so.
+    """
+    def flush(self):
+        if self.dirty:
+            self.save()
+            self.dirty = False
+    
+    def isimported(self, filepath, name):
+        if filepath not in self.verified:
+            # The media might have been removed from the collection since we imported it
+            if not(os.path.exists(os.path.join(self.mediadir, name))):
+                log.info("The media %s imported from %s is no longer in the collection", name, filepath)
+                return False
+            
+            self.verified.add(filepath)
+        
+        return True
+    
+    def load(self):
+        if not(os.path.exists(self.path)):
+            return {}
+        
+        try:
+            file = open(self.path, "rb")
+            try:
+                version, imports = marshal.load(file)
+            finally:
+                file.close()
+        except (IOError, EOFError, ValueError, TypeError), e:
+            log.warn("Could not load the media import cache from %s: %s", self.path, e)
+            return {}
+        
+        if version != MediaImportCache.version:
+            log.info("The media import cache at %s is from a different version", self.path)
+            return {}
+        
+        return imports
+    
+    def save(self):
+        try:
+            file = open(self.path, "wb")
+            try:
+                marshal.dump((MediaImportCache.version, self.imports), file)
+            finally:
+                file.close()
+        except IOError, e:
+            # Not being able to save it just means that we'll have to import the files again next time
+            log.warn("Could not save the media import cache to %s: %s", self.path, e)
+
 # Use to discover files in the media directory that are not referenced in the media
 # database. If this is true, the user has just copied them in - and we consider
 # such things "legacy" sounds that should be replaced with a true media pack.
@@ -43,5 +43,11 @@ class MockMediaManager(object):
     def discovermediapacks(self):
         return self.mediapacks
     
+    def refreshmediapacks(self):
+        pass
+    
     def importtocurrentdeck(self, filename):
-        return filename
\ No newline at end of file
+        return filename
+    
+    def flushimports(self):
+        pass
\ No newline at end of file
@@ -4,11 +4,10 @@
 import htmlentitydefs
 import re
 from BeautifulSoup import BeautifulSoup, Tag
-import sqlalchemy
 import unicodedata
 
 import utils
-from db import database
+from db import syllables
 
 from logger import log
 
@@ -16,6 +15,27 @@ from logger import log
 def opt_dict_arg_repr(dict):
     return len(dict) > 0 and ", " + repr(dict) or ""
 
+"""
+An empty dictionary that refuses to be changed. Tokens without any HTML attributes all share
+this one rather than each allocating their own empty dictionary: anything wanting to give a token
+some attributes must build a new token with a copy instead (e.g. by using withhtmlattrs).
+"""
+class FrozenDict(dict):
+    def refuse(self, *args, **kwargs):
+        raise TypeError("The HTML attributes of a token may not be changed in place")
+    
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = refuse
+
+noattrs = FrozenDict()
+
+def mergedattrs(htmlattrs, newattrs):
+    if len(newattrs) == 0:
+        return htmlattrs
+    
+    merged = htmlattrs.copy()
+    merged.update(newattrs)
+    return merged
+
 # Generally helpful pinyin utilities
 
 # Map tones to Unicode combining diacritical marks
@@ -59,17 +79,28 @@ def waysToSubstituteAwayUUmlaut(inwhat):
 
 """
 Represents the spoken and written tones of something in the system.
+
+ToneInfos are immutable, and there are only a handful of interesting ones (one for each pair of
+written and spoken tones) so we just hand out the same instance for every equal ToneInfo.
 """
 class ToneInfo(object):
-    def __init__(self, written=None, spoken=None):
-        object.__init__(self)
-        
+    __slots__ = ("written", "spoken")
+    
+    instances = {}
+    
+    def __new__(cls, written=None, spoken=None):
         if written is None and spoken is None:
             raise ValueError("At least one of the tones supplied to ToneInfo must be non-None")
         
         # Default the written tone to the spoken one and vice-versa
-        self.written = written or spoken
-        self.spoken = spoken or written
+        key = (written or spoken, spoken or written)
+        self = cls.instances.get(key)
+        if self is None:
+            self = object.__new__(cls)
+            self.written, self.spoken = key
+            cls.instances[key] = self
+        
+        return self
 
     def __repr__(self):
         return u"ToneInfo(written=%s, spoken=%s)" % (repr(self.written), repr(self.spoken))
@@ -87,16 +118,21 @@ class ToneInfo(object):
 Represents a purely textual token.
 """
 class Text(unicode):
+    __slots__ = ("htmlattrs",)
+    
     def __new__(cls, text, htmlattrs=None):
         if len(text) == 0:
             raise ValueError("All Text tokens must be non-empty")
         
         self = unicode.__new__(cls, text)
-        self.htmlattrs = htmlattrs or {}
+        self.htmlattrs = htmlattrs or noattrs
         return self
 
     iser = property(lambda self: False)
 
+    def withhtmlattrs(self, htmlattrs):
+        return Text(unicode(self), mergedattrs(self.htmlattrs, htmlattrs))
+
     def __repr__(self):
         return u"Text(%s%s)" % (unicode.__repr__(self), opt_dict_arg_repr(self.htmlattrs))
 
@@ -114,23 +150,68 @@ class Text(unicode):
 
 """
 Represents a single Pinyin character in the system.
+
+Pinyin are immutable. Those without any HTML attributes are interned, so that e.g. every "hen3"
+in a bulk fill is the same object.
 """
 class Pinyin(object):
+    __slots__ = ("word", "toneinfo", "htmlattrs")
+    
+
     # Extract a simple regex of all the possible pinyin.
-    # NB: we have to delay-load  this in order to give the UI a chance to create the database if it is missing
+    # NB: this comes from a frozen copy of the PinyinSyllables table, so parsing pinyin never needs the database
     # NB: we only need to consider the ü versions because the regex is used to check *after* we have normalised to ü
-    validpinyin = utils.Thunk(lambda: set(["r"] + [substituteForUUmlaut(pinyin[0]).lower() for pinyin in database.selectRows(sqlalchemy.select([sqlalchemy.Table("PinyinSyllables", database.metadata, autoload=True).c.Pinyin]))]))
+    validpinyin = frozenset(["r"] + [substituteForUUmlaut(pinyin).lower() for pinyin in syllables.pinyinsyllables])
     
-    def __init__(self, word, toneinfo, htmlattrs=None):
-        self.word = word
-        
+    """
+    Picks up a new version of the pinyin.db.syllables module, such as the one written when the database is
+    rebuilt, forgetting everything we worked out from the old one.
+    """
+    @classmethod
+    def reloadsyllables(cls):
+        reload(syllables)
+        cls.validpinyin = frozenset(["r"] + [substituteForUUmlaut(pinyin).lower() for pinyin in syllables.pinyinsyllables])
+        cls.surfaceforms = None
+        cls.interned.clear()
+        PinyinTonifier.tonifiedsyllables = None
+    
+    # Maps every common spelling of every syllable (numeric, tone marked or toneless, with any way of writing
+    # the umlaut, in lower, upper or title case) to the Pinyin it parses as and whether it was numeric. This
+    # means that parsing the pinyin we usually see is just a dictionary lookup. Built the first time we parse.
+    surfaceforms = None
+    
+    # Only real syllables are interned, and only up to a limit, so arbitrary text can't make this grow without bound
+    interned = {}
+    maxinterned = 10000
+    
+    def __new__(cls, word, toneinfo, htmlattrs=None):
         if isinstance(toneinfo, int):
             # Convenience constructor: build a ToneInfo from a simple number
-            self.toneinfo = ToneInfo(written=toneinfo)
-        else:
-            self.toneinfo = toneinfo
+            toneinfo = ToneInfo(written=toneinfo)
+        
+        if htmlattrs:
+            return cls.create(word, toneinfo, htmlattrs)
+        
+        # NB: the type of the word is part of the key so that we never swap a str for a unicode
+        key = (word, type(word), toneinfo)
+        self = cls.interned.get(key)
+        if self is None:
+            self = cls.create(word, toneinfo, noattrs)
+            if len(cls.interned) < cls.maxinterned and word.lower() in cls.validpinyin:
+                cls.interned[key] = self
         
-        self.htmlattrs = htmlattrs or {}
+        return self
+    
+    @classmethod
+    def create(cls, word, toneinfo, htmlattrs):
+        self = object.__new__(cls)
+        self.word = word
+        self.toneinfo = toneinfo
+        self.htmlattrs = htmlattrs
+        return self
+    
+    def withhtmlattrs(self, htmlattrs):
+        return Pinyin(self.word, self.toneinfo, mergedattrs(self.htmlattrs, htmlattrs))
     
     iser = property(lambda self: self.word.lower() == u"r" and self.toneinfo.written == 5)
 
@@ -162,7 +243,7 @@ class Pinyin(object):
             return self.word + str(getattr(self.toneinfo, tone))
     
     def tonifiedformat(self):
-        return PinyinTonifier().tonify(self.numericformat(hideneutraltone=False))
+        return PinyinTonifier.tonifysyllable(self.numericformat(hideneutraltone=False))
 
     """
     Constructs a Pinyin object from text representing a single character and numeric tone mark
@@ -173,6 +254,37 @@ class Pinyin(object):
     """
     @classmethod
     def parse(cls, text, forcenumeric=False):
+        if cls.surfaceforms is None:
+            cls.surfaceforms = cls.buildsurfaceforms()
+        
+        parsed = cls.surfaceforms.get(text)
+        if parsed is not None and (parsed[1] or not forcenumeric):
+            return parsed[0]
+        
+        # Anything unusual (including things that aren't pinyin at all) takes the slow path, which is
+        # also the one that knows how to complain about bad input
+        return cls.parseslowly(text, forcenumeric=forcenumeric)
+    
+    @classmethod
+    def buildsurfaceforms(cls):
+        tonifier = PinyinTonifier()
+        
+        surfaceforms = {}
+        for syllable in cls.validpinyin:
+            for spelling in set([syllable, syllable.replace(u"ü", u"v"), syllable.replace(u"ü", u"u:")]):
+                forms = [spelling] + [spelling + unicode(tone) for tone in range(1, 6)] + [tonifier.tonify(spelling + unicode(tone)) for tone in range(1, 5)]
+                for form in forms:
+                    for casedform in set([form, form.capitalize(), form.upper()]):
+                        # Let the slow path decide what each form means, so the two can never disagree
+                        try:
+                            surfaceforms[casedform] = (cls.parseslowly(casedform), casedform[-1].isdigit())
+                        except ValueError:
+                            pass
+        
+        return surfaceforms
+    
+    @classmethod
+    def parseslowly(cls, text, forcenumeric=False):
         # Normalise u: and v: into umlauted version:
         # NB: might think about doing lower() here, as some dictionary words have upper case (e.g. proper names)
         text = substituteForUUmlaut(text)
@@ -215,7 +327,7 @@ class Pinyin(object):
             word = unicodedata.normalize('NFC', word)
         
         # Sanity check to catch English/French/whatever that doesn't look like pinyin
-        if word.lower() not in cls.validpinyin():
+        if word.lower() not in cls.validpinyin:
             log.info("Couldn't find %s in the valid pinyin list", word)
             raise ValueError(u"The proposed pinyin '%s' doesn't look like pinyin after all" % text)
         
@@ -226,6 +338,8 @@ class Pinyin(object):
 Represents a Chinese character with tone information in the system.
 """
 class TonedCharacter(unicode):
+    __slots__ = ("toneinfo", "htmlattrs")
+    
     def __new__(cls, character, toneinfo, htmlattrs=None):
         if len(character) == 0:
             raise ValueError("All TonedCharacters tokens must be non-empty")
@@ -238,9 +352,12 @@ class TonedCharacter(unicode):
         else:
             self.toneinfo = toneinfo
         
-        self.htmlattrs = htmlattrs or {}
+        self.htmlattrs = htmlattrs or noattrs
         return self
     
+    def withhtmlattrs(self, htmlattrs):
+        return TonedCharacter(unicode(self), self.toneinfo, mergedattrs(self.htmlattrs, htmlattrs))
+    
     def __repr__(self):
         return u"TonedCharacter(%s, %s%s)" % (unicode.__repr__(self), repr(self.toneinfo), opt_dict_arg_repr(self.htmlattrs))
     
@@ -333,6 +450,130 @@ to seperate pinyin out from normal text, but no guarantees!
 """
 
 def tokenize(html, forcenumeric=False):
+    # Most of what we see has no markup in it at all, so don't go to the trouble of parsing any HTML
+    if isinstance(html, unicode) and u"<" not in html and u"&" not in html:
+        return tokenizetext(soupedtext(html), forcenumeric)
+    
+    tokens = tokenizesimplehtml(html, forcenumeric)
+    if tokens is None:
+        # Not HTML we're sure we understand: leave it to the experts
+        tokens = tokenizehtmlwithbeautifulsoup(html, forcenumeric)
+    
+    return tokens
+
+# ASCII whitespace, as far as BeautifulSoup is concerned
+soupwhitespace = u" \t\n\r\f"
+
+"""
+The text BeautifulSoup would give us for a bit of text found in some HTML, assuming it has no
+entities in it: BeautifulSoup collapses text that is only whitespace and escapes any '>'.
+"""
+def soupedtext(text):
+    if len(text) > 0 and len(text.strip(soupwhitespace)) == 0:
+        if u"\n" in text:
+            return u"\n"
+        else:
+            return u" "
+    
+    return text.replace(u">", u"&gt;")
+
+# Tags with only double quoted attributes, which are the only ones we try to understand ourselves
+simplehtmltagregex = re.compile(u'<(/?)([a-zA-Z]+)((?:\\s+[a-zA-Z][-a-zA-Z0-9]*="[^"<>]*")*)\\s*>')
+simplehtmlattrregex = re.compile(u'([a-zA-Z][-a-zA-Z0-9]*)="([^"<>]*)"')
+
+# Inline tags that BeautifulSoup is happy to see inside themselves, and the ones that it would
+# close if it saw them again. Anything else (such as a block tag that might close its parent)
+# makes the HTML too complicated for us.
+simplehtmlnestabletags = frozenset(["span", "font", "sub", "sup"])
+simplehtmltags = simplehtmlnestabletags | frozenset(["b", "i", "u", "s", "em", "strong", "small", "big", "strike", "tt"])
+
+"""
+Tokenizes HTML in a single pass over it, giving the same tokens as BeautifulSoup would. This only
+works for properly nested inline tags without entities, comments and the like: if we see anything
+else we give up and return None.
+"""
+def tokenizesimplehtml(html, forcenumeric):
+    if not(isinstance(html, unicode)) or u"&" in html:
+        return None
+    
+    tokens = []
+    def addtext(attributesstack, text):
+        if u"<" in text:
+            # Something that isn't a tag we understand
+            return False
+        
+        if len(text) > 0:
+            tokens.extend([contextify(attributesstack, token) for token in tokenizetext(soupedtext(text), forcenumeric)])
+        
+        return True
+    
+    # The open tags, each with the attributes stack from outside of it
+    opentags = []
+    attributesstack = []
+    position = 0
+    for match in simplehtmltagregex.finditer(html):
+        if not(addtext(attributesstack, html[position:match.start()])):
+            return None
+        
+        closing, name, attrstext = match.groups()
+        name = name.lower()
+        if name not in simplehtmltags:
+            return None
+        
+        if closing:
+            if len(attrstext) > 0 or len(opentags) == 0 or opentags[-1][0] != name:
+                return None
+            
+            _name, attributesstack = opentags.pop()
+            tokens.append(Text("</%s>" % name))
+        else:
+            if name not in simplehtmlnestabletags and name in [opentag for opentag, _attributesstack in opentags]:
+                return None
+            
+            opentags.append((name, attributesstack))
+            attributesstack, token = tagtoken(attributesstack, name, [(key.lower(), value) for key, value in simplehtmlattrregex.findall(attrstext)])
+            tokens.append(token)
+        
+        position = match.end()
+    
+    if len(opentags) > 0 or not(addtext(attributesstack, html[position:])):
+        return None
+    
+    return tokens
+
+def tokenizehtmlwithbeautifulsoup(html, forcenumeric):
+    # Stateful recursive algorithm for consuming the parse tree: tokens accumulate in the 'tokens' list
+    tokens = []
+    def recurse(attributesstack, parent):
+        for child in parent.contents:
+            if not isinstance(child, Tag):
+                tokens.extend([contextify(attributesstack, token) for token in tokenizetext(unicode(child), forcenumeric)])
+            elif child.isSelfClosing:
+                tokens.append(Text("<%s />" % child.name))
+            else:
+                thisattributesstack, token = tagtoken(attributesstack, child.name, child.attrs)
+                tokens.append(token)
+                recurse(thisattributesstack, child)
+                tokens.append(Text("</%s>" % child.name))
+    
+    # This is it, chaps: let's munge that HTML!
+    recurse([], BeautifulSoup(html))
+    return tokens
+
+def contextify(attributesstack, what):
+    # Get the most recent attributes to apply at this point in time
+    current_attrs = {}
+    for attrs in attributesstack:
+        current_attrs.update(attrs)
+    
+    # Tokens are shared, so never change them in place
+    return what.withhtmlattrs(current_attrs)
+
+"""
+Makes the token for an opening tag with the given attributes, returning it along with the
+attributes stack that should apply to everything inside the tag.
+"""
+def tagtoken(attributesstack, name, attrs):
     def extract_attr_maybe(attrs, attr, into, extractor):
         if attr not in attrs:
             return {}
@@ -391,49 +632,23 @@ def tokenize(html, forcenumeric=False):
             return (value, unparse_style((intelligible, unintelligible)))
 
         return go
-        
-    def contextify(attributesstack, what):
-        # Get the most recent attributes to apply at this point in time
-        current_attrs = {}
-        for attrs in attributesstack:
-            current_attrs.update(attrs)
-        
-        for k, v in current_attrs.items():
-            what.htmlattrs[k] = v
-        
-        return what
     
-    # Stateful recursive algorithm for consuming the parse tree: tokens accumulate in the 'tokens' list
-    tokens = []
-    def recurse(attributesstack, parent):
-        for child in parent.contents:
-            if not isinstance(child, Tag):
-                tokens.extend([contextify(attributesstack, token) for token in tokenizetext(unicode(child), forcenumeric)])
-            elif child.isSelfClosing:
-                tokens.append(Text("<%s />" % child.name))
-            else:
-                if child.name.lower() == "span":
-                    # It's more convenient if we can see the attributes as a dictionary,
-                    # although we might e.g. drop duplicates
-                    attrsdict = dict([(k.lower(), v) for k, v in child.attrs])
-    
-                    # This is why we're even at this party: we want to grab the style stuff out
-                    thisattributesstack = attributesstack + [extract_attr_maybe(attrsdict, "style", "color", take_style_val("color"))]
-        
-                    # We are still interested in writing out the remainder of the <span> tag, in
-                    # case it had other information in it (apart from the "style" attribute)
-                    thisattrs = attrsdict.items()
-                else:
-                    thisattributesstack = attributesstack
-                    thisattrs = child.attrs
-            
-                tokens.append(Text("<%s%s>" % (child.name, "".join([' %s="%s"' % (key, value) for key, value in thisattrs]))))
-                recurse(thisattributesstack, child)
-                tokens.append(Text("</%s>" % child.name))
+    if name.lower() == "span":
+        # It's more convenient if we can see the attributes as a dictionary,
+        # although we might e.g. drop duplicates
+        attrsdict = dict([(k.lower(), v) for k, v in attrs])
+
+        # This is why we're even at this party: we want to grab the style stuff out
+        thisattributesstack = attributesstack + [extract_attr_maybe(attrsdict, "style", "color", take_style_val("color"))]
+
+        # We are still interested in writing out the remainder of the <span> tag, in
+        # case it had other information in it (apart from the "style" attribute)
+        thisattrs = attrsdict.items()
+    else:
+        thisattributesstack = attributesstack
+        thisattrs = attrs
     
-    # This is it, chaps: let's munge that HTML!
-    recurse([], BeautifulSoup(html))
-    return tokens
+    return thisattributesstack, Text("<%s%s>" % (name, "".join([' %s="%s"' % (key, value) for key, value in thisattrs])))
 
 """
 Represents a word boundary in the system, where the tokens inside represent a complete Chinese word.
@@ -504,33 +719,61 @@ class Word(list):
 """
 Flattens the supplied tokens down into a single string.
 """
-def flatten(words, tonify=False):
+def flatten(words, tonify=False, renderer=None):
     visitor = FlattenTokensVisitor(tonify)
     for word in words:
         word.accept(visitor)
-    return visitor.output
+    return (renderer or htmlrenderer).render(visitor.runs)
 
+"""
+Collects the text of the tokens it visits into runs: lists of fragments of text from adjacent
+tokens that all have the same HTML attributes.
+"""
 class FlattenTokensVisitor(TokenVisitor):
     def __init__(self, tonify):
-        self.output = u""
+        self.runs = []
         self.tonify = tonify
 
     def visitText(self, text):
-        self.wrapHtml(text, unicode(text))
+        self.addfragment(text.htmlattrs, unicode(text))
 
     def visitPinyin(self, pinyin):
-        self.wrapHtml(pinyin, self.tonify and pinyin.tonifiedformat() or unicode(pinyin))
+        self.addfragment(pinyin.htmlattrs, self.tonify and pinyin.tonifiedformat() or unicode(pinyin))
 
     def visitTonedCharacter(self, tonedcharacter):
-        self.wrapHtml(tonedcharacter, unicode(tonedcharacter))
+        self.addfragment(tonedcharacter.htmlattrs, unicode(tonedcharacter))
     
-    def wrapHtml(self, token, text):
-        if "color" in token.htmlattrs:
-            self.output += '<span style="color:%s">' % token.htmlattrs["color"]
-            self.output += text
-            self.output += '</span>'
+    def addfragment(self, htmlattrs, text):
+        if len(self.runs) > 0 and self.runs[-1][0] == htmlattrs:
+            self.runs[-1][1].append(text)
         else:
-            self.output += text
+            self.runs.append((htmlattrs, [text]))
+
+"""
+Renders runs of text as HTML, so e.g. a run of characters in the same color becomes a single <span>.
+"""
+class HtmlRenderer(object):
+    def render(self, runs):
+        output = []
+        for htmlattrs, fragments in runs:
+            if "color" in htmlattrs:
+                output.append('<span style="color:%s">' % htmlattrs["color"])
+                output.extend(fragments)
+                output.append('</span>')
+            else:
+                output.extend(fragments)
+        
+        return u"".join(output)
+
+"""
+Renders runs of text without any of their HTML attributes.
+"""
+class PlainRenderer(object):
+    def render(self, runs):
+        return u"".join([fragment for _htmlattrs, fragments in runs for fragment in fragments])
+
+htmlrenderer = HtmlRenderer()
+plainrenderer = PlainRenderer()
 
 """
 Report whether the supplied list of words ends with a space
@@ -556,6 +799,34 @@ class NeedsSpaceBeforeAppendVisitor(TokenVisitor):
         # Treat it like normal text
         self.visitText(tonedcharacter)
 
+"""
+Answers needsspacebeforeappend for a list of words that only ever grows, by only looking
+at the words added since it was last asked rather than at all of them every time.
+"""
+class NeedsSpaceBeforeAppendTracker(object):
+    def __init__(self):
+        self.visitor = NeedsSpaceBeforeAppendVisitor()
+        self.seen = 0
+    
+    def needsspacebeforeappend(self, words):
+        for word in words[self.seen:]:
+            word.accept(self.visitor)
+        
+        self.seen = len(words)
+        return self.visitor.needsspacebeforeappend
+
+"""
+Whether all the text in the tokens is punctuation, like utils.ispunctuation(flatten(tokens)) but
+without building the flattened string.
+"""
+def tokensarepunctuation(tokens):
+    for token in tokens:
+        # Pinyin is never punctuation, so don't bother rendering it
+        if isinstance(token, Pinyin) or not(utils.ispunctuation(token)):
+            return False
+    
+    return True
+
 """
 Makes some tokens that faithfully represent the given characters
 with tone information attached, if it is possible to extract it
@@ -604,6 +875,14 @@ class PinyinTonifier(object):
         u'([eE])([iI])([1234])'   : ur'\g<1>\g<3>\g<2>',
         u'([oO])([uU])([1234])'   : ur'\g<1>\g<3>\g<2>'
     }
+    
+    # Every tone number, along with the run of letters in front of it. The transforms below never
+    # look any further back than that, so we can tonify each of these seperately.
+    tonenumberregex = re.compile(u"[^\W\d_]*[1-5]", re.UNICODE)
+    
+    # Maps every valid numeric syllable (in lower, upper and title case) to its tonified form.
+    # Built the first time we tonify anything.
+    tonifiedsyllables = None
 
     """
     Convert pinyin text with tone numbers to pinyin with diacritical marks
@@ -619,13 +898,46 @@ class PinyinTonifier(object):
     def tonify(self, line):
         assert type(line)==unicode
         
+        tonified = self.tonenumberregex.sub(lambda match: self.tonifysyllable(match.group(0)), line)
+        
+        # Tone marks we put in might combine with text we didn't touch, so this still has to be done on the whole line
+        return unicodedata.normalize('NFC', tonified)
+
+    """
+    Tonify a single syllable with a tone number, such as "hen3".
+    """
+    @classmethod
+    def tonifysyllable(cls, numeric):
+        if cls.tonifiedsyllables is None:
+            cls.tonifiedsyllables = cls.buildtonifiedsyllables()
+        
+        tonified = cls.tonifiedsyllables.get(numeric)
+        if tonified is None:
+            # Not something we've seen before, so fall back on the transforms
+            tonified = cls.tonifyslowly(numeric)
+        
+        return tonified
+    
+    @classmethod
+    def buildtonifiedsyllables(cls):
+        tonifiedsyllables = {}
+        for syllable in Pinyin.validpinyin:
+            for tone in range(1, 6):
+                numeric = syllable + unicode(tone)
+                for casednumeric in set([numeric, numeric.capitalize(), numeric.upper()]):
+                    tonifiedsyllables[casednumeric] = cls.tonifyslowly(casednumeric)
+        
+        return tonifiedsyllables
+
+    @classmethod
+    def tonifyslowly(cls, line):
         # First transform: commute tone numbers over finals containing only constants
-        for (x,y) in self.constTone2ToneConst.items():
+        for (x,y) in cls.constTone2ToneConst.items():
             line = re.sub(x, y, line)
 
         # Second transform: for runs of two vowels with a following tone mark, move
         # the tone mark so it occurs directly afterwards the first vowel
-        for (x,y) in self.vowelVowelTone2VowelToneVowel.items():
+        for (x,y) in cls.vowelVowelTone2VowelToneVowel.items():
             line = re.sub(x, y, line)
 
         # Third transform: map tones to the Unicode equivalent
@@ -1,3 +1,4 @@
+import bulkfill
 import config
 import dictionary
 import dictionaryonline
@@ -6,6 +7,7 @@ import meanings
 import media
 import model
 import numberutils
+import readingtable
 import model
 import statistics
 import transformations
@@ -1,5 +1,6 @@
 import unittest
 
+from bulkfill import *
 from config import *
 from dictionary import *
 from dictionaryonline import *
@@ -8,6 +9,7 @@ from meanings import *
 from media import *
 from model import *
 from numberutils import *
+from readingtable import *
 from statistics import *
 from transformations import *
 from updater import *
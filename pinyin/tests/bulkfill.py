@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+import os
+import unittest
+
+from pinyin.bulkfill import *
+import pinyin.utils as utils
+
+
+class BulkFillTest(unittest.TestCase):
+    def testStoreOnlyChanges(self):
+        self.assertEquals(self.fill(range(0, 10), self.doubleevens), [[(n, { "value" : n * 2 }) for n in [2, 4, 6, 8]]])
+    
+    def testNothingChanged(self):
+        self.assertEquals(self.fill(range(0, 10), lambda fields: None), [])
+    
+    def testChunksStoredInOrder(self):
+        stored = self.fill(range(0, 100), self.doubleevens, chunksize=7)
+        self.assertEquals(len(stored), 15)
+        self.assertEquals(sum(stored, []), [(n, { "value" : n * 2 }) for n in range(2, 100, 2)])
+    
+    def testProgress(self):
+        progress = []
+        BulkFill(self.load, self.doubleevens, lambda changes: None, chunksize=4, progress=progress.append).run(range(0, 10))
+        self.assertEquals(progress, [4, 8, 10])
+    
+    def testCountChanged(self):
+        self.assertEquals(BulkFill(self.load, self.doubleevens, lambda changes: None, chunksize=3).run(range(0, 10)), 4)
+    
+    def testComputeErrorsReachCaller(self):
+        def compute(fields):
+            if fields["value"] == 5:
+                raise ValueError("five")
+        
+        self.assertRaises(ValueError, lambda: self.fill(range(0, 10), compute, chunksize=2))
+    
+    def testComputeOncePerDistinctFields(self):
+        computed = []
+        def compute(fields):
+            computed.append(fields["value"])
+            fields["value"] = fields["value"] + u"!"
+        
+        stored = []
+        bulkfill = BulkFill(lambda ids: [(id, id, { "value" : u"的" * (id % 3) }) for id in ids], compute, stored.append, chunksize=4)
+        bulkfill.run(range(0, 10))
+        self.assertEquals(computed, [u"", u"的", u"的的"])
+        self.assertEquals(sum(stored, []), [(id, { "value" : u"的" * (id % 3) + u"!" }) for id in range(0, 10)])
+        self.assertEquals(bulkfill.cachestatistics()["hits"], 7)
+        self.assertEquals(bulkfill.cachestatistics()["misses"], 3)
+    
+    def testDistinguishOtherFields(self):
+        computed = []
+        load = lambda ids: [(id, id, { "expression" : u"的", "meaning" : id % 2 and u"of" or u"" }) for id in ids]
+        BulkFill(load, computed.append, lambda changes: None).run(range(0, 10))
+        self.assertEquals(len(computed), 2)
+    
+    def testSkipUnchangedSinceLastFill(self):
+        def do(store):
+            notes = dict([(id, { "value" : id }) for id in range(0, 10)])
+            self.assertEquals(self.fillnotes(notes, self.doubleevens, Fingerprinter(store, "double", [1])), range(0, 10))
+            self.assertEquals(notes[4], { "value" : 8 })
+            self.assertEquals(self.fillnotes(notes, self.doubleevens, Fingerprinter(store, "double", [1])), [])
+        
+        self.withstore(do)
+    
+    def testRefillChangedNotes(self):
+        def do(store):
+            notes = dict([(id, { "value" : id }) for id in range(0, 10)])
+            self.fillnotes(notes, self.doubleevens, Fingerprinter(store, "double", [1]))
+            
+            notes[4] = { "value" : 4 }
+            notes[5] = { "value" : 6 }
+            notes[10] = { "value" : 10 }
+            self.assertEquals(self.fillnotes(notes, self.doubleevens, Fingerprinter(store, "double", [1])), [4, 6, 10])
+            self.assertEquals(notes[5], { "value" : 12 })
+        
+        self.withstore(do)
+    
+    def testRefillEverythingWhenDependenciesChange(self):
+        def do(store):
+            notes = dict([(id, { "value" : id }) for id in range(0, 10)])
+            self.fillnotes(notes, self.doubleevens, Fingerprinter(store, "double", [1]))
+            self.assertEquals(self.fillnotes(notes, self.doubleevens, Fingerprinter(store, "double", [2])), [0, 1, 4, 3, 8, 5, 12, 7, 16, 9])
+        
+        self.withstore(do)
+    
+    def testFillsHaveSeparateFingerprints(self):
+        def do(store):
+            notes = dict([(id, { "value" : id }) for id in range(0, 10)])
+            self.fillnotes(notes, self.doubleevens, Fingerprinter(store, "double", [1]))
+            self.assertEquals(self.fillnotes(notes, self.doubleevens, Fingerprinter(store, "redouble", [1])), [0, 1, 4, 3, 8, 5, 12, 7, 16, 9])
+        
+        self.withstore(do)
+    
+    def testRefillNotesLeftUnfilled(self):
+        def do(store):
+            online = []
+            def compute(fields):
+                if online and fields["meaning"] == u"":
+                    fields["meaning"] = u"meaning of " + fields["value"]
+            
+            notes = dict([(id, { "value" : unicode(id), "meaning" : id % 2 == 0 and u"given" or u"" }) for id in range(0, 6)])
+            fill = lambda: self.fillnotes(notes, compute, Fingerprinter(store, "meanings", [1]), fillable=["meaning"])
+            
+            # While we are offline the notes without a meaning can't get one, so we keep trying them
+            self.assertEquals(fill(), [u"0", u"1", u"2", u"3", u"4", u"5"])
+            self.assertEquals(fill(), [u"1", u"3", u"5"])
+            
+            online.append(True)
+            self.assertEquals(fill(), [u"1", u"3", u"5"])
+            self.assertEquals(notes[3]["meaning"], u"meaning of 3")
+            self.assertEquals(fill(), [])
+        
+        self.withstore(do)
+    
+    def testFingerprintsPersist(self):
+        def do(path):
+            FingerprintStore(os.path.join(path, "fingerprints.db")).remember("fill", [(1, "abc"), (2, "def")])
+            self.assertEquals(FingerprintStore(os.path.join(path, "fingerprints.db")).lookup("fill", [1, 3]), { 1 : "abc" })
+        
+        utils.withtempdir(do)
+    
+    def testLookupManyFingerprints(self):
+        def do(path):
+            store = FingerprintStore(os.path.join(path, "fingerprints.db"))
+            store.remember("fill", [(id, str(id)) for id in range(0, 1000)])
+            self.assertEquals(len(store.lookup("fill", range(0, 1000))), 1000)
+            store.close()
+        
+        utils.withtempdir(do)
+    
+    def testOpenFingerprintStoreFailure(self):
+        def do(path):
+            self.assertEquals(openfingerprintstore(os.path.join(path, "missing", "fingerprints.db")), None)
+        
+        utils.withtempdir(do)
+    
+    # Test helpers
+    def doubleevens(self, fields):
+        if fields["value"] != 0 and fields["value"] % 2 == 0:
+            fields["value"] *= 2
+    
+    def load(self, ids):
+        return [(id, id, { "value" : id }) for id in ids]
+    
+    def fill(self, ids, compute, **kwargs):
+        stored = []
+        BulkFill(self.load, compute, stored.append, **kwargs).run(ids)
+        return stored
+    
+    # Fills the notes, a dictionary from id to fields, returning the values the fill saw
+    def fillnotes(self, notes, compute, fingerprinter, **kwargs):
+        updated = []
+        def recordingcompute(fields):
+            updated.append(fields["value"])
+            compute(fields)
+        
+        def load(ids):
+            return [(id, id, dict(notes[id])) for id in ids]
+        
+        def store(changes):
+            for id, changedfields in changes:
+                notes[id] = utils.updated(notes[id], changedfields)
+        
+        BulkFill(load, recordingcompute, store, chunksize=3, fingerprinter=fingerprinter, **kwargs).run(sorted(notes.keys()))
+        return updated
+    
+    def withstore(self, do):
+        def withpath(path):
+            store = FingerprintStore(os.path.join(path, "fingerprints.db"))
+            try:
+                do(store)
+            finally:
+                store.close()
+        
+        utils.withtempdir(withpath)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -26,6 +26,10 @@ class ConfigTest(unittest.TestCase):
         self.assertEquals(config.tonecolors[0], "hi")
         self.assertEquals(len(config.tonecolors), len(Config({}).tonecolors))
     
+    def testDictionaryMemoryLimit(self):
+        self.assertEquals(Config({}).dictionarymemorylimitbytes, None)
+        self.assertEquals(Config({ "dictionarymemorylimit" : 128 }).dictionarymemorylimitbytes, 128 * 1024 * 1024)
+    
     def testCopiesInput(self):
         inputSettings = {}
         
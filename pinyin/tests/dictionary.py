@@ -1,10 +1,18 @@
 # -*- coding: utf-8 -*-
 
+import codecs
+import os
+import sqlite3
+import sys
 import unittest
 
+import cjklib.dbconnector
+import sqlalchemy
+
 from pinyin.dictionary import *
 from pinyin.db import database
-from pinyin.model import ToneInfo, flatten, tokenizespaceseperatedtext
+from pinyin.db.builder import compiledefinitions
+from pinyin.model import TonedCharacter, ToneInfo, flatten, tokenizespaceseperatedtext
 
 
 dictionaries = PinyinDictionary.loadall()
@@ -53,6 +61,21 @@ class PinyinDictionaryTest(unittest.TestCase):
     def testMeaningless(self):
         self.assertEquals(self.flatmeanings(englishdict, u"English"), None)
 
+    def testShareLoadedDictionaries(self):
+        self.assertTrue(PinyinDictionary.loadall()('en') is englishdict)
+        self.assertTrue(PinyinDictionary.loadall(cachesize=PinyinDictionary.defaultcachesize) is dictionaries)
+    
+    def testOnlyKeepLatestDictionaries(self):
+        # Put back the dictionaries everything else shares afterwards, or the next test to ask for them would load them again
+        lastloaded = PinyinDictionary.lastloaded
+        try:
+            smallcache = PinyinDictionary.loadall(cachesize=10)
+            self.assertTrue(PinyinDictionary.loadall(cachesize=10) is smallcache)
+            self.assertFalse(PinyinDictionary.loadall(cachesize=11) is smallcache)
+            self.assertFalse(PinyinDictionary.loadall(cachesize=10) is smallcache)
+        finally:
+            PinyinDictionary.lastloaded = lastloaded
+    
     def testMissingDictionary(self):
         self.assertEquals(fileSource('idontexist.txt'), None)
     
@@ -138,6 +161,356 @@ class PinyinDictionaryTest(unittest.TestCase):
         else:
             return None
 
+class IndexedDictionarySourceTest(unittest.TestCase):
+    def testAgreesWithDatabase(self):
+        _headwords, sqllookup, _lookupmany = databaseDictionarySource("CEDICT", 1)
+        indexedheadwords, indexedlookup, _lookupmany = databaseDictionarySource("CEDICT", 1, 1024 * 1024 * 1024)
+        for word in [u"书", u"書", u"鼓聲", u"鼓声", u"了", u"一塊兒", u"干", u"乾", u"NotAWord"]:
+            self.assertEquals(self.flatlookup(indexedlookup, word), self.flatlookup(sqllookup, word))
+    
+    def testIndexesSimplifiedAndTraditional(self):
+        headwords, _lookup, _lookupmany = databaseDictionarySource("CEDICT", 1, 1024 * 1024 * 1024)
+        self.assertTrue(u"鼓聲" in headwords)
+        self.assertTrue(u"鼓声" in headwords)
+    
+    def testFallsBackOnDatabaseWhenOverMemoryLimit(self):
+        _headwords, lookup, _lookupmany = databaseDictionarySource("CEDICT", 1, 1)
+        self.assertEquals([reading for reading, _meaning in lookup(u"鼓聲")], [u"gu3 sheng1"])
+    
+    def testEstimateIncludesOverheads(self):
+        dicttable = sqlalchemy.Table("CEDICT", database.metadata, autoload=True)
+        rows = database.selectScalars(sqlalchemy.select([sqlalchemy.func.count()], from_obj=[dicttable]))[0]
+        
+        # Every row has at least a reading and a meaning string, each of which is a whole object
+        self.assertTrue(estimatedIndexSize(dicttable, dicttable, dicttable.c.Translation) > rows * 2 * sys.getsizeof(u""))
+    
+    # Test helpers
+    def flatlookup(self, lookup, word):
+        return [(reading, [flatten(meaning) for meaning in meaningfun("simp", None)[0]]) for reading, meaningfun in lookup(word)]
+
+class PinyinDictionarySegmentationTest(unittest.TestCase):
+    def testLongestMatchWins(self):
+        dictionary, _queries = self.dictionary()
+        self.assertEquals([text for _readingsmeanings, text in dictionary.parse(u"你好吗?")], [u"你好", u"吗", u"?"])
+    
+    def testOnlyWinningWordsAreLookedUp(self):
+        dictionary, queries = self.dictionary()
+        list(dictionary.parse(u"你好吗?"))
+        self.assertEquals(queries, [set([u"你好", u"吗"])])
+    
+    def testUnknownCharactersAreNotLookedUp(self):
+        dictionary, queries = self.dictionary()
+        self.assertEquals(list(dictionary.parse(u"English")), [(None, c) for c in u"English"])
+        self.assertEquals(queries, [])
+    
+    def testRepeatedWordsAreLookedUpOnce(self):
+        dictionary, queries = self.dictionary()
+        self.assertEquals([readingsmeanings for readingsmeanings, _text in dictionary.parse(u"你好你好")], [[(u"ni3 hao3", None)], [(u"ni3 hao3", None)]])
+        self.assertEquals(queries, [set([u"你好"])])
+    
+    def testEachOccurrenceGetsItsOwnReadings(self):
+        dictionary, _queries = self.dictionary()
+        (first, _), (second, _) = list(dictionary.parse(u"你好你好"))
+        first.pop(0)
+        self.assertEquals(second, [(u"ni3 hao3", None)])
+    
+    # Test helpers
+    def dictionary(self):
+        queries = []
+        entries = { u"你" : u"ni3", u"你好" : u"ni3 hao3", u"好" : u"hao3", u"吗" : u"ma5" }
+        def lookup(word):
+            return [(entries[word], None)]
+        
+        def lookupmany(words):
+            queries.append(set(words))
+            return dict([(word, lookup(word)) for word in words])
+        
+        return PinyinDictionary([(entries.keys(), lookup, lookupmany)]), queries
+
+class ParsedExpressionTest(unittest.TestCase):
+    def testViewsShareOneLookup(self):
+        dictionary, queries = self.dictionary()
+        parsedexpression = dictionary.parseexpression(u"你好")
+        self.assertEquals(flatten(parsedexpression.reading()), u"ni3 hao3")
+        self.assertEquals(flatten(parsedexpression.tonedchars()), u"你好")
+        self.assertEquals(parsedexpression.meanings("simp"), ([u"hello"], None))
+        self.assertEquals(queries, [[u"你好"]])
+    
+    def testMeaningsLeaveReadingsAlone(self):
+        dictionary, _queries = self.dictionary()
+        parsedexpression = dictionary.parseexpression(u"你好")
+        parsedexpression.meanings("simp")
+        self.assertEquals(flatten(parsedexpression.reading()), u"ni3 hao3")
+    
+    def testAgreesWithDictionary(self):
+        parsedexpression = englishdict.parseexpression(u"你好，我喜欢学习汉语。")
+        self.assertEquals(flatten(parsedexpression.reading()), flatten(englishdict.reading(u"你好，我喜欢学习汉语。")))
+        self.assertEquals(flatten(parsedexpression.tonedchars()), flatten(englishdict.tonedchars(u"你好，我喜欢学习汉语。")))
+    
+    # Test helpers
+    def dictionary(self):
+        queries = []
+        # The first reading has no meaning, as if it came from the character readings
+        readingsmeanings = [(u"ni3 hao3", None), (u"ni3 hao3", lambda prefersimptrad, tonedcharscallback: ([u"hello"], None))]
+        def lookupmany(words):
+            queries.append(list(words))
+            return dict([(word, readingsmeanings) for word in words])
+        
+        return PinyinDictionary([([u"你好"], lambda word: readingsmeanings, lookupmany)]), queries
+
+class PinyinDictionaryCacheTest(unittest.TestCase):
+    def testRepeatedLookupsAreCached(self):
+        dictionary, queries, _data = self.dictionary()
+        list(dictionary.parse(u"你好"))
+        list(dictionary.parse(u"你好"))
+        dictionary.parseexact(u"你好")
+        self.assertEquals(queries, [[u"你好"]])
+        self.assertEquals(dictionary.cachestatistics()[0][1]["hits"], 2)
+    
+    def testCachedEntriesCannotBeMutated(self):
+        dictionary, _queries, _data = self.dictionary()
+        dictionary.parseexact(u"你好").pop(0)
+        dictionary.meanings(u"你好", "simp")
+        self.assertEquals(dictionary.parseexact(u"你好"), [(u"ni3 hao3", None)])
+    
+    def testReloadsChangedSources(self):
+        dictionary, queries, data = self.dictionary()
+        list(dictionary.parse(u"你好"))
+        data["stamp"] = 2
+        data["entries"] = { u"你好" : u"NI3 HAO3", u"吗" : u"ma5" }
+        self.assertEquals(list(dictionary.parse(u"你好吗")), [([(u"NI3 HAO3", None)], u"你好"), ([(u"ma5", None)], u"吗")])
+        self.assertEquals(len(queries), 2)
+    
+    def testMissingSourcesCanAppearLater(self):
+        data = { "stamp" : None }
+        dictionary = PinyinDictionary([ReloadableSource("Test", lambda: data["stamp"], lambda: data["stamp"] and ([u"你"], lambda word: [(u"ni3", None)], lambda words: dict([(word, [(u"ni3", None)]) for word in words])))])
+        self.assertEquals(list(dictionary.parse(u"你")), [(None, u"你")])
+        data["stamp"] = 1
+        self.assertEquals(list(dictionary.parse(u"你")), [([(u"ni3", None)], u"你")])
+    
+    # Test helpers
+    def dictionary(self):
+        queries = []
+        data = { "stamp" : 1, "entries" : { u"你好" : u"ni3 hao3" } }
+        def load():
+            entries = data["entries"]
+            def lookup(word):
+                queries.append(word)
+                return [(entries[word], None)]
+            
+            def lookupmany(words):
+                queries.append(list(words))
+                return dict([(word, [(entries[word], None)]) for word in words])
+            
+            return entries.keys(), lookup, lookupmany
+        
+        return PinyinDictionary([ReloadableSource("Test", lambda: data["stamp"], load)]), queries, data
+
+class HeadwordFilterTest(unittest.TestCase):
+    def testMissesSkipTheSource(self):
+        dictionary, queries = self.dictionary()
+        self.assertEquals(dictionary.parseexact(u"NotAWord"), [])
+        self.assertEquals(dictionary.parseexactmany([u"NotAWord"]), { u"NotAWord" : [] })
+        self.assertEquals(queries, [])
+    
+    def testHitsReachTheSource(self):
+        dictionary, queries = self.dictionary()
+        self.assertEquals(dictionary.parseexact(u"你好"), [(u"ni3 hao3", None)])
+        self.assertEquals(dictionary.parseexactmany([u"你好", u"NotAWord"]), { u"你好" : [(u"ni3 hao3", None)], u"NotAWord" : [] })
+        # NB: the second lookup is answered from the cache
+        self.assertEquals(queries, [u"你好"])
+    
+    def testOnlyAskSourcesWithTheWord(self):
+        dictionary, queries = self.dictionary(otherheadwords=[u"你"])
+        self.assertEquals(dictionary.parseexactmany([u"你", u"你好"]), { u"你" : [(u"ni3", None)], u"你好" : [(u"ni3 hao3", None)] })
+        self.assertEquals(queries, [[u"你好"]])
+    
+    def testStatisticsSurviveReloading(self):
+        dictionary, _queries = self.dictionary(name="Reloaded")
+        dictionary.parseexact(u"你好")
+        dictionary, _queries = self.dictionary(name="Reloaded")
+        dictionary.parseexact(u"NotAWord")
+        self.assertEquals(filterstatistics()["Reloaded"], { "hits" : 1, "misses" : 1 })
+    
+    # Test helpers
+    def dictionary(self, name="Test", otherheadwords=[]):
+        queries = []
+        def lookup(word):
+            queries.append(word)
+            return [(u"ni3 hao3", None)]
+        
+        def lookupmany(words):
+            queries.append(words)
+            return dict([(word, [(u"ni3 hao3", None)]) for word in words])
+        
+        # Another source that knows some other words, so we can see which words reach which source
+        other = (otherheadwords, lambda word: [(u"ni3", None)], lambda words: dict([(word, [(u"ni3", None)]) for word in words]))
+        return PinyinDictionary([ReloadableSource(name, lambda: None, lambda: ([u"你好"], lookup, lookupmany)), other]), queries
+
+class CompiledDefinitionsTest(unittest.TestCase):
+    def testAgreesWithRawTranslations(self):
+        dicttable = sqlalchemy.Table("CEDICT", database.metadata, autoload=True)
+        for memorylimit in [None, 1024 * 1024 * 1024]:
+            _headwords, lookup, _lookupmany = databaseDictionarySource("CEDICT", 1, memorylimit)
+            for word in [u"书", u"鼓聲", u"了"]:
+                translations = database.selectScalars(sqlalchemy.select([dicttable.c.Translation],
+                    sqlalchemy.or_(dicttable.c.HeadwordSimplified == word, dicttable.c.HeadwordTraditional == word)))
+                self.assertEquals([self.flatmeaning(meaningfun) for _reading, meaningfun in lookup(word)],
+                                  [self.flatmeaning(parseMeaning(translation, 1)) for translation in translations])
+    
+    def testBlankTranslationsAreMissing(self):
+        def go(tempdir):
+            path = os.path.join(tempdir, "blank.db")
+            connection = sqlite3.connect(path)
+            connection.execute("CREATE TABLE Blank (HeadwordTraditional TEXT, HeadwordSimplified TEXT, Reading TEXT, Translation TEXT)")
+            connection.executemany("INSERT INTO Blank VALUES (?, ?, ?, ?)", [(u"書", u"书", u"shu1", translation) for translation in [u"/book/", u"", u"  ", None]])
+            connection.commit()
+            connection.close()
+            
+            blankdatabase = cjklib.dbconnector.getDBConnector({ "url" : sqlalchemy.engine.url.URL("sqlite", database=path) })
+            compiledefinitions(blankdatabase, "Blank")
+            compiledtable = sqlalchemy.Table("BlankCompiled", blankdatabase.metadata, autoload=True)
+            self.assertEquals(blankdatabase.selectScalars(sqlalchemy.select([compiledtable.c.RowId])), [1])
+            
+            # Parsing the raw translations agrees on which ones are missing
+            self.assertEquals([parseMeaning(translation, 1) is None for translation in [u"/book/", u"", u"  ", None]], [False, True, True, True])
+            
+            blankdatabase.connection.close()
+            blankdatabase.engine.dispose()
+        
+        withtempdir(go)
+    
+    # Test helpers
+    def flatmeaning(self, meaningfun):
+        meanings, measurewords = meaningfun("trad", None)
+        return [flatten(meaning) for meaning in meanings], [(flatten(characters), flatten(pinyin)) for characters, pinyin in measurewords]
+
+class FileSourceCacheTest(unittest.TestCase):
+    def testRoundTrip(self):
+        def go(tempdir):
+            filename = self.writedictionary(tempdir, u"書 书 [shu1] /book/\n")
+            saveFileSourceCache(filename, parseFileSource(filename))
+            self.assertEquals(loadFileSourceCache(filename), { u"書" : [(u"shu1", u"/book/")], u"书" : [(u"shu1", u"/book/")] })
+        
+        withtempdir(go)
+    
+    def testEditedDictionaryIsParsedAgain(self):
+        def go(tempdir):
+            filename = self.writedictionary(tempdir, u"書 书 [shu1] /book/\n")
+            saveFileSourceCache(filename, parseFileSource(filename))
+            self.writedictionary(tempdir, u"書 书 [shu1] /book/letter/\n")
+            self.assertEquals(loadFileSourceCache(filename), None)
+        
+        withtempdir(go)
+    
+    def testCorruptCacheIsIgnored(self):
+        def go(tempdir):
+            filename = self.writedictionary(tempdir, u"書 书 [shu1] /book/\n")
+            file = open(filesourcecachepath(filename), "wb")
+            file.write("junk")
+            file.close()
+            self.assertEquals(loadFileSourceCache(filename), None)
+        
+        withtempdir(go)
+    
+    # Test helpers
+    def writedictionary(self, tempdir, contents):
+        filename = os.path.join(tempdir, "dict.txt")
+        file = codecs.open(filename, "w", encoding='utf-8')
+        file.write(contents)
+        file.close()
+        return filename
+
+class BatchedLookupTest(unittest.TestCase):
+    words = [u"书", u"書", u"鼓聲", u"鼓声", u"了", u"一塊兒", u"干", u"乾", u"NotAWord"]
+    
+    def testDictionaryAgreesWithSingleLookups(self):
+        self.assertAgrees(databaseDictionarySource("CEDICT", 0))
+    
+    def testIndexedDictionaryAgreesWithSingleLookups(self):
+        self.assertAgrees(databaseDictionarySource("CEDICT", 0, 1024 * 1024 * 1024))
+    
+    def testReadingsAgreeWithSingleLookups(self):
+        self.assertAgrees(databaseReadingSource())
+    
+    def testBatchesAreSplitUp(self):
+        _headwords, lookup, lookupmany = databaseReadingSource()
+        characters = list(u"一二三四五六七八九十百千万")
+        original = PinyinDictionary.maxquerywords
+        PinyinDictionary.maxquerywords = 5
+        try:
+            self.assertEquals(self.flatten(lookupmany(characters)), self.flatten(dict([(c, lookup(c)) for c in characters])))
+        finally:
+            PinyinDictionary.maxquerywords = original
+    
+    # Test helpers
+    def assertAgrees(self, source):
+        _headwords, lookup, lookupmany = source
+        self.assertEquals(self.flatten(lookupmany(self.words)), self.flatten(dict([(word, lookup(word)) for word in self.words])))
+    
+    def flatten(self, readingsmeaningsbyword):
+        return dict([(word, [(reading, meaningfun and [flatten(meaning) for meaning in meaningfun("simp", None)[0]]) for reading, meaningfun in readingsmeanings]) for word, readingsmeanings in readingsmeaningsbyword.items()])
+
+class ReadingSpacingTest(unittest.TestCase):
+    # The Iowa texts in pinyin/Readings, each with the name of the files in pinyin/tests/golden that hold
+    # the reading and toned characters saved for it. If a change means to alter them, save them afresh.
+    iowatexts = [("Iowa-Beg-2", ["Iowa-Beg-2.u8"], "utf-8"),
+                 # NB: despite what its <meta> tag says, only one of the HTML files is really in GB2312
+                 ("Iowa-Int-3", ["Iowa-Int-3.html"], "gb2312"),
+                 ("Iowa-Intermediate-74", ["Iowa", "Intermediate", "74.htm"], "utf-8")]
+    
+    def testIowaReadings(self):
+        for name, path, encoding in self.iowatexts:
+            parsedexpression = self.parseiowatext(path, encoding)
+            self.assertEquals(flatten(parsedexpression.reading()), self.golden(name + ".reading"))
+            self.assertEquals(self.describetonedchars(parsedexpression.tonedchars()), self.golden(name + ".tonedchars"))
+    
+    def testPunctuation(self):
+        self.assertEquals(self.reading(u"你好, 我喜欢学习汉语. 我的汉语水平很低."), u"ni3 hao3, wo3 xi3 huan xue2 xi2 Han4 yu3. wo3 de Han4 yu3 shui3 ping2 hen3 di1.")
+        self.assertEquals(self.reading(u"你好！！ 再见……"), u"ni3 hao3!! zai4 jian4……")
+        self.assertEquals(self.reading(u"“我们走吧，”他说。"), u"\"wo3 men zou3 ba,\"ta1 shui4.")
+    
+    def testLatinText(self):
+        self.assertEquals(self.reading(u"Hello 你好 world,你好。"), u"Hello ni3 hao3 world, ni3 hao3.")
+        self.assertEquals(self.reading(u"我用iPhone 4S打电话"), u"wo3 yong4i Phone si4S da3 dian4 hua4")
+    
+    def testErhua(self):
+        self.assertEquals(self.reading(u"哪儿有一块儿面包?"), u"na3r you3 yi1 kuai4r mian4 bao1?")
+        self.assertEquals(self.reading(u"「好玩儿！」(他说) -- 一点儿..."), u"「hao3 wan2r!」(ta1 shui4) -- yi1 dian3r...")
+    
+    def testNumbers(self):
+        # Built by hand, because what the dictionary makes of digits depends on which one we have. Digits
+        # are text like any other, so they are not spaced away from the reading before them
+        parsed = [([(u"ta1", None)], u"他"), ([(u"you3", None)], u"有"), (None, u"3"), ([(u"ge4", None)], u"个"), (None, u","), (None, u" "),
+                  (None, u"2"), (None, u"0"), (None, u"1"), (None, u"0"), ([(u"nian2", None)], u"年"), ([(u"lai2", None)], u"来"),
+                  (None, u"1"), (None, u"."), (None, u"5"), ([(u"kuai4", None)], u"块")]
+        self.assertEquals(flatten(ParsedExpression(parsed, None).reading()), u"ta1 you33 ge4, 2010 nian2 lai21.5 kuai4")
+    
+    def testLongSentence(self):
+        self.assertEquals(self.reading(u"我喜欢学习汉语，" * 200), u" ".join([u"wo3 xi3 huan xue2 xi2 Han4 yu3,"] * 200))
+    
+    # Test helpers
+    def reading(self, text):
+        return flatten(englishdict.parseexpression(text).reading())
+    
+    def parseiowatext(self, path, encoding):
+        return englishdict.parseexpression(codecs.open(toolkitdir("pinyin", "Readings", *path), "r", encoding).read())
+    
+    def golden(self, name):
+        return codecs.open(toolkitdir("pinyin", "tests", "golden", name), "r", "utf-8").read()
+    
+    # Writes out each toned character with its tones in braces, e.g. 一{1/4}, so that they can be compared as text
+    def describetonedchars(self, words):
+        def describe(token):
+            if not isinstance(token, TonedCharacter):
+                return unicode(token)
+            elif token.toneinfo.written == token.toneinfo.spoken:
+                return u"%s{%d}" % (token, token.toneinfo.written)
+            else:
+                return u"%s{%d/%d}" % (token, token.toneinfo.written, token.toneinfo.spoken)
+        
+        return u"".join([describe(token) for word in words for token in word])
+
 class PinyinConverterTest(unittest.TestCase):
     # Test data:
     nihao_simp = u'你好，我喜欢学习汉语。我的汉语水平很低。'
@@ -75,7 +75,37 @@ class MeaningFormatterTest(unittest.TestCase):
         self.assertEquals(means[0][0][-1], Pinyin(u"hao", 3))
         self.assertEquals(means[1][0][2], Text(u"hen"))
         
+    def testCallbackAppliedToCachedDefinition(self):
+        self.parse(1, "simp", self.shu_def)
+        means, mws = self.parse(1, "simp", self.shu_def, tonedchars_callback=lambda x: Word(Text(u"JUNK")))
+        self.assertEquals(means, [u'book', u'letter', u'same as JUNK Book of History'])
+        self.assertEquals(mws, self.shu_simp_mws)
+    
+    def testCachedDefinitionsCannotBeMutated(self):
+        means, mws = self.parseunflat(1, "simp", self.shu_def)
+        means[0].append(Word(Text(u"JUNK")))
+        means[1][0].append(Text(u"JUNK"))
+        mws[0][0][0].append(Text(u"JUNK"))
+        self.assertEquals(self.parse(1, "simp", self.shu_def), (self.shu_simp_meanings, self.shu_simp_mws))
+    
+    def testCacheDistinguishesSimpTrad(self):
+        self.assertEquals(self.parse(1, "simp", self.shu_def)[1], self.shu_simp_mws)
+        self.assertEquals(self.parse(1, "trad", self.shu_def)[1], self.shu_trad_mws)
+        self.assertEquals(self.parse(0, "simp", self.shu_def)[1], self.shu_trad_mws)
+    
+    def testCompiledDefinitionsAgree(self):
+        for definition in [self.shangwu_def, self.shu_def, u"/silly hen3 definition hao3/a hen is not pinyin", u"/dictionary/also written 辭典|辞典[ci2 dian3]/CL:部[bu4],本[ben3],X/"]:
+            for simplifiedcharindex, prefersimptrad in [(0, "simp"), (1, "simp"), (1, "trad")]:
+                formatter = MeaningFormatter(simplifiedcharindex, prefersimptrad)
+                self.assertEquals(self.flat(formatter.parsecompileddefinition(compiledefinition(definition))), self.flat(formatter.parsedefinition(definition)))
+    
+    def testCompiledDefinitionsAreText(self):
+        self.assertTrue(type(compiledefinition(self.shu_def)) in [str, unicode])
+    
     # Test helpers
+    def flat(self, (means, mws)):
+        return [flatten(mean) for mean in means], [(flatten(mwcharwords), flatten(mwpinyinwords)) for (mwcharwords, mwpinyinwords) in mws]
+    
     def parse(self, *args, **kwargs):
         means, mws = self.parseunflat(*args, **kwargs)
         return [flatten(mean) for mean in means], [(flatten(mwcharwords), flatten(mwpinyinwords)) for (mwcharwords, mwpinyinwords) in mws]
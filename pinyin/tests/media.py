@@ -161,6 +161,209 @@ class MediaPackTest(unittest.TestCase):
         # Create a temporary directory with which to do our test
         utils.withtempdir(do)
     
+class MediaPackDiscovererTest(unittest.TestCase):
+    def testDiscover(self):
+        def do(path):
+            self.makepack(path, "Pack", ["ni3.mp3"])
+            utils.touch(os.path.join(path, "junk.mp3"))
+            os.mkdir(os.path.join(path, "downloads"))
+            
+            self.assertEquals(MediaPackDiscoverer().discover(path), [MediaPack(os.path.join(path, "Pack"), { "ni3.mp3" : os.path.join(path, "Pack", "ni3.mp3") })])
+        
+        utils.withtempdir(do)
+    
+    def testReuseUnchangedPacks(self):
+        def do(path):
+            self.backdate(self.makepack(path, "Pack", ["ni3.mp3"]))
+            self.backdate(path)
+            
+            discoverer = MediaPackDiscoverer()
+            packs = discoverer.discover(path)
+            self.assertTrue(discoverer.discover(path) is packs)
+        
+        utils.withtempdir(do)
+    
+    def testIgnoreImportsIntoMediaDirectory(self):
+        def do(path):
+            self.backdate(self.makepack(path, "Pack", ["ni3.mp3"]))
+            
+            discoverer = MediaPackDiscoverer()
+            packs = discoverer.discover(path)
+            
+            # Importing media into the collection changes its directory, but none of the packs
+            utils.touch(os.path.join(path, "imported.mp3"))
+            self.assertTrue(discoverer.discover(path) is packs)
+        
+        utils.withtempdir(do)
+    
+    def testNoticeNewPackWithinSameSecond(self):
+        def do(path):
+            # Pretend we have a file system that only records modification times to the second
+            now = int(time.time())
+            self.makepack(path, "Pack", ["ni3.mp3"])
+            os.utime(path, (now, now))
+            
+            discoverer = MediaPackDiscoverer()
+            self.assertEquals(len(discoverer.discover(path)), 1)
+            
+            self.makepack(path, "Another Pack", ["hao3.mp3"])
+            os.utime(path, (now, now))
+            self.assertEquals(len(discoverer.discover(path)), 2)
+        
+        utils.withtempdir(do)
+    
+    def testNoticeChangedPack(self):
+        def do(path):
+            packpath = self.makepack(path, "Pack", ["ni3.mp3"])
+            
+            discoverer = MediaPackDiscoverer()
+            self.assertEquals(discoverer.discover(path)[0].mediafor("hao3", [".mp3"]), None)
+            
+            utils.touch(os.path.join(packpath, "hao3.mp3"))
+            self.backdate(packpath)
+            self.assertEquals(discoverer.discover(path)[0].mediafor("hao3", [".mp3"]), os.path.join(packpath, "hao3.mp3"))
+        
+        utils.withtempdir(do)
+    
+    def testNoticeNewAndRemovedPacks(self):
+        def do(path):
+            self.makepack(path, "Pack", ["ni3.mp3"])
+            
+            discoverer = MediaPackDiscoverer()
+            self.assertEquals(len(discoverer.discover(path)), 1)
+            
+            self.makepack(path, "Another Pack", ["hao3.mp3"])
+            self.backdate(path)
+            self.assertEquals(len(discoverer.discover(path)), 2)
+            
+            shutil.rmtree(os.path.join(path, "Pack"))
+            self.backdate(path, 2000)
+            self.assertEquals([pack.name for pack in discoverer.discover(path)], ["Another Pack"])
+        
+        utils.withtempdir(do)
+    
+    def testRefresh(self):
+        def do(path):
+            self.makepack(path, "Pack", ["ni3.mp3"])
+            
+            discoverer = MediaPackDiscoverer()
+            packs = discoverer.discover(path)
+            discoverer.refresh()
+            self.assertFalse(discoverer.discover(path) is packs)
+        
+        utils.withtempdir(do)
+    
+    # Helpers
+    def makepack(self, path, name, filenames):
+        packpath = os.path.join(path, name)
+        os.mkdir(packpath)
+        for filename in filenames:
+            utils.touch(os.path.join(packpath, filename))
+        
+        return packpath
+    
+    def backdate(self, path, seconds=1000):
+        # Make sure the change is visible even on file systems that only record modification times to the second
+        mtime = os.path.getmtime(path) - seconds
+        os.utime(path, (mtime, mtime))
+
+class MediaImportCacheTest(unittest.TestCase):
+    def testImportOnce(self):
+        def do(path, importer, cache):
+            sourcepath = self.makesource(path, "ni3.mp3", "ni")
+            self.assertEquals(cache.importfile(sourcepath, importer), "imported-ni3.mp3")
+            self.assertEquals(cache.importfile(sourcepath, importer), "imported-ni3.mp3")
+            self.assertEquals(importer.imported, [sourcepath])
+        
+        self.withcache(do)
+    
+    def testReimportChangedFile(self):
+        def do(path, importer, cache):
+            sourcepath = self.makesource(path, "ni3.mp3", "ni")
+            cache.importfile(sourcepath, importer)
+            
+            self.makesource(path, "ni3.mp3", "a different ni")
+            cache.importfile(sourcepath, importer)
+            self.assertEquals(importer.imported, [sourcepath, sourcepath])
+        
+        self.withcache(do)
+    
+    def testReimportMissingMedia(self):
+        def do(path, importer, cache):
+            sourcepath = self.makesource(path, "ni3.mp3", "ni")
+            cache.importfile(sourcepath, importer)
+            
+            # Only noticed when we haven't already seen the media
+            os.remove(os.path.join(cache.mediadir, "imported-ni3.mp3"))
+            cache = MediaImportCache(cache.mediadir, cache.path)
+            cache.importfile(sourcepath, importer)
+            self.assertEquals(importer.imported, [sourcepath, sourcepath])
+        
+        self.withcache(do)
+    
+    def testPersist(self):
+        def do(path, importer, cache):
+            sourcepath = self.makesource(path, "ni3.mp3", "ni")
+            cache.importfile(sourcepath, importer)
+            cache.flush()
+            
+            self.assertEquals(MediaImportCache(cache.mediadir, cache.path).importfile(sourcepath, importer), "imported-ni3.mp3")
+            self.assertEquals(importer.imported, [sourcepath])
+        
+        self.withcache(do)
+    
+    def testSaveOnlyOnFlush(self):
+        def do(path, importer, cache):
+            for name in ["ni3.mp3", "hao3.mp3"]:
+                cache.importfile(self.makesource(path, name, name), importer)
+            self.assertFalse(os.path.exists(cache.path))
+            
+            cache.flush()
+            self.assertTrue(os.path.exists(cache.path))
+            
+            # Nothing new to save
+            os.remove(cache.path)
+            cache.flush()
+            self.assertFalse(os.path.exists(cache.path))
+        
+        self.withcache(do)
+    
+    def testIgnoreCorruptCache(self):
+        def do(path, importer, cache):
+            sourcepath = self.makesource(path, "ni3.mp3", "ni")
+            self.makesource(path, "imports.cache", "junk")
+            
+            self.assertEquals(cache.importfile(sourcepath, importer), "imported-ni3.mp3")
+            self.assertEquals(importer.imported, [sourcepath])
+        
+        self.withcache(do)
+    
+    # Helpers
+    def withcache(self, do):
+        def withpath(path):
+            mediadir = os.path.join(path, "collection.media")
+            os.mkdir(mediadir)
+            
+            # Imports files into the collection the way Anki would, remembering what it was asked to do
+            def importer(filepath):
+                importer.imported.append(filepath)
+                name = "imported-" + os.path.basename(filepath)
+                shutil.copy(filepath, os.path.join(mediadir, name))
+                return name
+            importer.imported = []
+            
+            do(path, importer, MediaImportCache(mediadir, os.path.join(path, "imports.cache")))
+        
+        utils.withtempdir(withpath)
+    
+    def makesource(self, path, name, contents):
+        sourcepath = os.path.join(path, name)
+        file = open(sourcepath, "w")
+        file.write(contents)
+        file.close()
+        
+        return sourcepath
+
 class LegacyMediaTest(unittest.TestCase):
     def testDiscoverNothing(self):
         self.assertEquals(discoverlegacymedia(None, []), None)
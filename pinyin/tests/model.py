@@ -29,6 +29,14 @@ class ToneInfoTest(unittest.TestCase):
 
     def testMustBeNonEmpty(self):
         self.assertRaises(ValueError, lambda: ToneInfo())
+    
+    def testShared(self):
+        self.assertTrue(ToneInfo(written=1) is ToneInfo(written=1, spoken=1))
+        self.assertTrue(ToneInfo(spoken=3) is ToneInfo(written=3, spoken=3))
+        self.assertFalse(ToneInfo(written=1, spoken=3) is ToneInfo(written=1, spoken=1))
+    
+    def testNoDict(self):
+        self.assertRaises(AttributeError, lambda: setattr(ToneInfo(written=1), "moo", "cow"))
 
 class PinyinTest(unittest.TestCase):
     def testConvenienceConstructor(self):
@@ -56,6 +64,30 @@ class PinyinTest(unittest.TestCase):
         self.assertNotEquals(Pinyin(u"hen", 3), "Pinyin(u'hen', 3)")
         self.assertNotEquals("Pinyin(u'hen', 3)", Pinyin(u"hen", 3))
     
+    def testInterned(self):
+        self.assertTrue(Pinyin(u"hen", 3) is Pinyin(u"hen", ToneInfo(written=3)))
+        self.assertTrue(Pinyin.parse(u"hěn") is Pinyin.parse(u"hen3"))
+        self.assertFalse(Pinyin(u"hen", 3, { "color" : "red" }) is Pinyin(u"hen", 3, { "color" : "red" }))
+    
+    def testInternedKeepsWordType(self):
+        self.assertEquals(type(Pinyin(u"hen", 3).word), unicode)
+        self.assertEquals(type(Pinyin("hen", 3).word), str)
+    
+    def testNotInternedIfNotPinyin(self):
+        Pinyin(u"moocow", 3)
+        self.assertFalse((u"moocow", unicode, ToneInfo(written=3)) in Pinyin.interned)
+    
+    def testAttributesAreNotShared(self):
+        self.assertRaises(TypeError, lambda: Pinyin(u"hen", 3).htmlattrs.update({ "color" : "red" }))
+        self.assertEquals(Pinyin(u"hen", 3).htmlattrs, {})
+    
+    def testWithHtmlAttrs(self):
+        plain = Pinyin(u"hen", 3)
+        self.assertEquals(plain.withhtmlattrs({ "color" : "red" }), Pinyin(u"hen", 3, { "color" : "red" }))
+        self.assertEquals(plain.withhtmlattrs({ "color" : "red" }).withhtmlattrs({ "color" : "blue" }), Pinyin(u"hen", 3, { "color" : "blue" }))
+        self.assertTrue(plain.withhtmlattrs({}) is plain)
+        self.assertEquals(plain.htmlattrs, {})
+    
     def testStrNeutralTone(self):
         py = Pinyin(u"ma", 5)
         self.assertEquals(str(py), u"ma")
@@ -142,9 +174,55 @@ class PinyinTest(unittest.TestCase):
     def testRejectsNumbers(self):
         self.assertRaises(ValueError, lambda: Pinyin.parse(u"12345"))
     
+    def testParseSurfaceForms(self):
+        self.assertEquals(Pinyin.parse(u"Lv3"), Pinyin(u"Lü", 3))
+        self.assertEquals(Pinyin.parse(u"LÜE4"), Pinyin(u"LÜE", 4))
+        self.assertEquals(Pinyin.parse(u"Xiǎo"), Pinyin(u"Xiao", 3))
+        self.assertEquals(Pinyin.parse(u"lǜ"), Pinyin(u"lü", 4))
+        self.assertEquals(Pinyin.parse(u"ma"), Pinyin(u"ma", 5))
+    
+    def testParseSurfaceFormsForceNumeric(self):
+        self.assertEquals(Pinyin.parse(u"hen3", forcenumeric=True), Pinyin(u"hen", 3))
+        self.assertRaises(ValueError, lambda: Pinyin.parse(u"hěn", forcenumeric=True))
+    
+    def testParseUnusualForms(self):
+        # Mixed case and decomposed tone marks aren't in the table, but should still work
+        self.assertEquals(Pinyin.parse(u"hEn3"), Pinyin(u"hEn", 3))
+        self.assertEquals(Pinyin.parse(u"he\u030cn"), Pinyin(u"hen", 3))
+    
+    def testSurfaceFormsAgreeWithSlowPath(self):
+        Pinyin.parse(u"hen3")
+        for form, (pinyin, numeric) in Pinyin.surfaceforms.items():
+            self.assertEquals(pinyin, Pinyin.parseslowly(form))
+            self.assertEquals(numeric, form[-1].isdigit())
+    
     def testRejectsPinyinlikeEnglish(self):
         self.assertRaises(ValueError, lambda: Pinyin.parse("USB"))
 
+class PinyinSyllablesTest(unittest.TestCase):
+    def testFrozenSyllablesMatchDatabase(self):
+        import sqlalchemy
+        from pinyin.db import database, syllables
+        syllablestable = sqlalchemy.Table("PinyinSyllables", database.metadata, autoload=True)
+        self.assertEquals(sorted(syllables.pinyinsyllables), sorted(database.selectScalars(sqlalchemy.select([syllablestable.c.Pinyin]))))
+    
+    def testReloadSyllables(self):
+        validpinyin = Pinyin.validpinyin
+        Pinyin.parse(u"hao3")
+        PinyinTonifier().tonify(u"hao3")
+        
+        Pinyin.reloadsyllables()
+        self.assertEquals(Pinyin.surfaceforms, None)
+        self.assertEquals(PinyinTonifier.tonifiedsyllables, None)
+        self.assertEquals(Pinyin.validpinyin, validpinyin)
+        self.assertEquals(Pinyin.parse(u"hao3"), Pinyin(u"hao", 3))
+        self.assertEquals(PinyinTonifier().tonify(u"hao3"), u"hǎo")
+    
+    def testValidPinyinNormalised(self):
+        self.assertTrue(u"lü" in Pinyin.validpinyin)
+        self.assertTrue(u"r" in Pinyin.validpinyin)
+        self.assertFalse(u"lv" in Pinyin.validpinyin)
+
 class TextTest(unittest.TestCase):
     def testNonEmpty(self):
         self.assertRaises(ValueError, lambda: Text(u""))
@@ -171,6 +249,11 @@ class TextTest(unittest.TestCase):
     
     def testIsEr(self):
         self.assertFalse(Text("r5").iser)
+    
+    def testWithHtmlAttrs(self):
+        text = Text(u"hello", { "foo" : "bar" })
+        self.assertEquals(text.withhtmlattrs({ "color" : "red" }), Text(u"hello", { "foo" : "bar", "color" : "red" }))
+        self.assertEquals(text.htmlattrs, { "foo" : "bar" })
 
 class WordTest(unittest.TestCase):
     def testAppendSingleReading(self):
@@ -272,6 +355,9 @@ class TonedCharacterTest(unittest.TestCase):
         self.assertTrue(TonedCharacter(u"兒", 5).iser)
         self.assertFalse(TonedCharacter(u"化", 2).iser)
         self.assertFalse(TonedCharacter(u"儿", 4).iser)
+    
+    def testWithHtmlAttrs(self):
+        self.assertEquals(TonedCharacter(u"儿", 2).withhtmlattrs({ "color" : "red" }), TonedCharacter(u"儿", 2, { "color" : "red" }))
 
 class TokenizeSpaceSeperatedTextTest(unittest.TestCase):
     def testFromSingleSpacedString(self):
@@ -311,6 +397,24 @@ class TokenizeTest(unittest.TestCase):
         self.assertEquals([Text(u'<span style="">'), Pinyin(u'tou', 2, { "color" : "#123456" }), Text(u'</span>'), Text(u' '), Text(u'<span style="">'), Pinyin(u'er', 4, { "color" : "#123456" }), Text(u'</span>')],
                           tokenize(u'<span style="color:#123456">tou2</span> <span style="color:#123456">er4</span>'))
     
+    def testTokenizeLikeBeautifulSoup(self):
+        for html in [u"", u" ", u" \n ", u"hen3 > hao3", u"hen3&amp;hao3", u"<b>hen3</b>  <b>hao3</b>", u"<SPAN STYLE=\"color:red\" Class=\"x\">ni3 <i>hao3</i></SPAN>!",
+                     u'<span style="color:red"><span style="color:blue">ni3</span> hao3</span>', u"<font color=\"red\">wan4r</font>", u"<b><b>hen3</b></b>",
+                     u"<p>hen3<p>hao3", u"<span>hen3", u"hen3</span>", u"<br>hen3", u"<!-- hen3 -->hao3", u"hen3 < hao3", u"<span style='color:red'>hen3</span>"]:
+            self.assertEquals(tokenize(html), tokenizehtmlwithbeautifulsoup(html, False))
+    
+    def testTokenizeSimpleHTML(self):
+        self.assertEquals(tokenizesimplehtml(u'<b class="x">hen3</b>', False), [Text(u'<b class="x">'), Pinyin.parse(u"hen3"), Text(u"</b>")])
+        self.assertEquals(tokenizesimplehtml(u"<span style=\"color:red\">hen3</span>", False), [Text(u'<span style="">'), Pinyin(u"hen", 3, { "color" : "red" }), Text(u"</span>")])
+    
+    def testTokenizeSimpleHTMLGivesUp(self):
+        for html in [u"<p>hen3</p>", u"<b><b>hen3</b></b>", u"<span>hen3", u"hen3</span>", u"<b>hen3</i>", u"<br />", u"hen3 &amp; hao3", u"hen3 < hao3", u"<span style='color:red'>hen3</span>"]:
+            self.assertEquals(tokenizesimplehtml(html, False), None)
+    
+    def testTokenizeHTMLLeavesSharedTokensAlone(self):
+        tokenize(u'<span style="color:#123456">tou2</span>')
+        self.assertEquals(Pinyin(u'tou', 2).htmlattrs, {})
+    
     def testTokenizeUnrecognisedHTML(self):
         # TODO: enable this test and make it pass somehow... SGMLParser doesn't support self-closing tags :-(
         #self.assertEquals([Text(u'<b />')], tokenize(u'<b />'))
@@ -331,6 +435,24 @@ class PinyinTonifierTest(unittest.TestCase):
     def testGreeting(self):
         self.assertEquals(PinyinTonifier().tonify(u"ni3 hao3, wo3 xi3 huan xue2 xi2 Han4 yu3. wo3 de Han4 yu3 shui3 ping2 hen3 di1."),
                           u"nǐ hǎo, wǒ xǐ huan xué xí Hàn yǔ. wǒ de Hàn yǔ shuǐ píng hěn dī.")
+    
+    def testNotPinyin(self):
+        for line in [u"Room 101, floor 5", u"xyzzy3 hen3", u"lu:3 nv4", u"ZHONG1guo2"]:
+            self.assertEquals(PinyinTonifier().tonify(line), PinyinTonifier.tonifyslowly(line))
+    
+    def testSyllable(self):
+        self.assertEquals(PinyinTonifier.tonifysyllable(u"hen3"), u"hěn")
+        self.assertEquals(PinyinTonifier.tonifysyllable(u"Zhuang1"), u"Zhuāng")
+        self.assertEquals(PinyinTonifier.tonifysyllable(u"NÜE4"), u"NÜÈ")
+        self.assertEquals(PinyinTonifier.tonifysyllable(u"ma5"), u"ma")
+    
+    def testSyllableNotInTable(self):
+        self.assertEquals(PinyinTonifier.tonifysyllable(u"hEn3"), u"hĚn")
+    
+    def testTableAgreesWithSlowPath(self):
+        PinyinTonifier.tonifysyllable(u"hen3")
+        for numeric, tonified in PinyinTonifier.tonifiedsyllables.items():
+            self.assertEquals(tonified, PinyinTonifier.tonifyslowly(numeric))
 
 class FlattenTest(unittest.TestCase):
     def testFlatten(self):
@@ -343,6 +465,21 @@ class FlattenTest(unittest.TestCase):
     
     def testUsesWrittenTone(self):
         self.assertEquals(flatten([Word(Pinyin("hen", ToneInfo(written=2,spoken=3)))]), "hen2")
+    
+    def testFlattenColored(self):
+        self.assertEquals(flatten([Word(TonedCharacter(u"一", 1, { "color" : "red" }), TonedCharacter(u"个", 4, { "color" : "blue" }))]),
+                          u'<span style="color:red">一</span><span style="color:blue">个</span>')
+    
+    def testFlattenMergesSameColor(self):
+        self.assertEquals(flatten([Word(Pinyin(u"ni", 3, { "color" : "red" })), Word(Pinyin(u"hao", 3, { "color" : "red" }), Text(u"!"))]),
+                          u'<span style="color:red">ni3hao3</span>!')
+    
+    def testFlattenPlain(self):
+        self.assertEquals(flatten([Word(Pinyin(u"ni", 3, { "color" : "red" }), Text(u" "), Pinyin(u"hao", 3, { "color" : "blue" }))], tonify=True, renderer=plainrenderer),
+                          u"nǐ hǎo")
+    
+    def testFlattenEmpty(self):
+        self.assertEquals(flatten([]), u"")
 
 class NeedsSpaceBeforeAppendTest(unittest.TestCase):
     def testEmptyDoesntNeedSpace(self):
@@ -362,6 +499,25 @@ class NeedsSpaceBeforeAppendTest(unittest.TestCase):
         self.assertFalse(needsspacebeforeappend([Word(Text("("))]))
         self.assertFalse(needsspacebeforeappend([Word(Text(")"))]))
         self.assertFalse(needsspacebeforeappend([Word(Text('"'))]))
+    
+    def testTracker(self):
+        tracker = NeedsSpaceBeforeAppendTracker()
+        words = []
+        self.assertFalse(tracker.needsspacebeforeappend(words))
+        words.append(Word(Pinyin.parse(u"hen3")))
+        self.assertTrue(tracker.needsspacebeforeappend(words))
+        words.append(Word(Text(u"(")))
+        self.assertFalse(tracker.needsspacebeforeappend(words))
+        words.extend([Word(Text(u"hello")), Word()])
+        self.assertTrue(tracker.needsspacebeforeappend(words))
+        self.assertTrue(tracker.needsspacebeforeappend(words))
+
+class TokensArePunctuationTest(unittest.TestCase):
+    def testTokensArePunctuation(self):
+        self.assertTrue(tokensarepunctuation([]))
+        self.assertTrue(tokensarepunctuation([Text(u"。"), Text(u"...")]))
+        self.assertFalse(tokensarepunctuation([Text(u"."), Text(u"a")]))
+        self.assertFalse(tokensarepunctuation([Pinyin.parse(u"hen3")]))
 
 class TonedCharactersFromReadingTest(unittest.TestCase):
     def testTonedTokens(self):
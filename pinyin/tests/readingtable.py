@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+import os
+import unittest
+
+import sqlalchemy
+
+from pinyin.db import database, dbpath
+from pinyin.db.readingtable import *
+from pinyin.utils import withtempdir
+
+
+class ReadingTableTest(unittest.TestCase):
+    def testAgreesWithDatabase(self):
+        readingtable = sqlalchemy.Table("CharacterPinyin", database.metadata, autoload=True)
+        def go(table):
+            for character in [u"一", u"了", u"好", u"〇", u"行", u"㑇"]:
+                self.assertEquals(table.readings(character), database.selectScalars(sqlalchemy.select([readingtable.c.Reading],
+                    readingtable.c.ChineseCharacter == character).order_by(readingtable.c.Reading)))
+        
+        self.withtable(go)
+    
+    def testMissingCharacters(self):
+        def go(table):
+            self.assertEquals(table.readings(u"a"), [])
+            self.assertEquals(table.readings(u"\U0010fffd"), [])
+            self.assertEquals(table.readings(u"你好"), [])
+        
+        self.withtable(go)
+    
+    def testCharacters(self):
+        readingtable = sqlalchemy.Table("CharacterPinyin", database.metadata, autoload=True)
+        def go(table):
+            self.assertEquals(sorted(table.characters()), sorted(database.selectScalars(sqlalchemy.select([readingtable.c.ChineseCharacter], distinct=True))))
+        
+        self.withtable(go)
+    
+    def testRebuildsWhenOlderThanDatabase(self):
+        def go(tempdir):
+            path = os.path.join(tempdir, "readings.tbl")
+            open(path, "wb").close()
+            os.utime(path, (0, 0))
+            self.assertEquals(load(database, dbpath, path).readings(u"一")[:1], [u"yi1"])
+        
+        withtempdir(go)
+    
+    def testFallsBackOnDatabaseWhenUnreadable(self):
+        def go(tempdir):
+            path = os.path.join(tempdir, "readings.tbl")
+            file = open(path, "wb")
+            file.write("junk")
+            file.close()
+            self.assertEquals(load(database, dbpath, path), None)
+        
+        withtempdir(go)
+    
+    def testFallsBackOnDatabaseWhenEmpty(self):
+        def go(tempdir):
+            path = os.path.join(tempdir, "readings.tbl")
+            open(path, "wb").close()
+            self.assertEquals(load(database, dbpath, path), None)
+        
+        withtempdir(go)
+    
+    def testFallsBackOnDatabaseWhenTruncated(self):
+        def go(tempdir):
+            path = os.path.join(tempdir, "readings.tbl")
+            build(database, path)
+            contents = open(path, "rb").read()
+            
+            file = open(path, "wb")
+            file.write(contents[:len(contents) / 2])
+            file.close()
+            self.assertEquals(load(database, dbpath, path), None)
+        
+        withtempdir(go)
+    
+    def testInstallClosesOpenTable(self):
+        def go(tempdir):
+            path, builtpath = os.path.join(tempdir, "readings.tbl"), os.path.join(tempdir, "built.tbl")
+            build(database, path)
+            build(database, builtpath)
+            
+            table = load(database, dbpath, path)
+            install(builtpath, path)
+            self.assertRaises(ValueError, lambda: table.readings(u"一"))
+            self.assertEquals(load(database, dbpath, path).readings(u"一")[:1], [u"yi1"])
+            self.assertFalse(os.path.exists(path + ".tmp"))
+        
+        withtempdir(go)
+    
+    def testClose(self):
+        def go(tempdir):
+            path = os.path.join(tempdir, "readings.tbl")
+            build(database, path)
+            
+            table = ReadingTable(path)
+            table.close()
+            self.assertFalse(table in opentables)
+            
+            # Nothing has the file mapped any more, so it can go
+            os.remove(path)
+        
+        withtempdir(go)
+    
+    def testCodepoints(self):
+        self.assertEquals(codepoint(u"一"), 0x4e00)
+        self.assertEquals(codepoint(u"𠀀"), 0x20000)
+        self.assertEquals(codepoint(character(0x20000)), 0x20000)
+        self.assertEquals(codepoint(u"ab"), None)
+    
+    # Test helpers
+    def withtable(self, action):
+        def go(tempdir):
+            path = os.path.join(tempdir, "readings.tbl")
+            build(database, path)
+            table = ReadingTable(path)
+            try:
+                action(table)
+            finally:
+                table.close()
+        
+        withtempdir(go)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
 
+import cStringIO
+import random
+import re
 import unittest
 
+from pinyin.config import Config
 from pinyin.db import database
 import pinyin.dictionary
 from pinyin.media import MediaPack
@@ -60,7 +64,7 @@ class CharacterColorizerTest(unittest.TestCase):
     
     def testPunctuation(self):
         self.assertEqual(self.colorize(u'小小!'),
-            u'<span style="color:#00aa00">小</span><span style="color:#00aa00">小</span>!')
+            u'<span style="color:#00aa00">小小</span>!')
 
     def testUseSpokenToneRatherThanWrittenOne(self):
         self.assertEqual(flatten(colorize(colorlist, [Word(TonedCharacter(u"小", ToneInfo(written=3, spoken=2)))])),
@@ -70,6 +74,34 @@ class CharacterColorizerTest(unittest.TestCase):
     def colorize(self, what):
         return flatten(colorize(colorlist, englishdict.tonedchars(what)))
 
+class PipelineTest(unittest.TestCase):
+    def testSandhiAndColor(self):
+        self.assertEquals(Pipeline(sandhi=True, colorlist=colorlist).flatten([Word(TonedCharacter(u"很", 3)), Word(TonedCharacter(u"好", 3))]),
+                          u'<span style="color:#66cc66">很</span><span style="color:#00aa00">好</span>')
+    
+    def testKeepsColors(self):
+        self.assertEquals(Pipeline(colorlist=colorlist, tonify=True).flatten([Word(Pinyin(u"hen", 3, { "color" : "red" }), Text(u" "), Pinyin(u"hao", 3))]),
+                          u'<span style="color:red">hěn</span> <span style="color:#00aa00">hǎo</span>')
+    
+    def testFromConfig(self):
+        words = [Word(Pinyin(u"ni", 3), Pinyin(u"hao", 3))]
+        self.assertEquals(Pipeline.fromconfig(Config({ "colorizedpinyingeneration" : False, "tonedisplay" : "tonified" })).flatten(words), u"nǐhǎo")
+        self.assertEquals(Pipeline.fromconfig(Config({ "colorizedpinyingeneration" : True, "tonecolors" : colorlist, "tonedisplay" : "numeric" }), sandhi=True).flatten(words),
+                          u'<span style="color:#66cc66">ni3</span><span style="color:#00aa00">hao3</span>')
+    
+    def testAgreesWithSeperateStages(self):
+        random.seed(4321)
+        tokens = [Pinyin(u"ma", tone) for tone in range(1, 6)] + [Pinyin(u"ma", 3)] * 3 + [TonedCharacter(u"好", 3), TonedCharacter(u"吗", 5),
+                  Pinyin(u"ma", 3, { "color" : "red" }), TonedCharacter(u"好", 2, { "color" : "red", "moo" : "cow" }), Text(u" "), Text(u"!"), Text(u"?", { "color" : "blue" })]
+        for _ in range(300):
+            words = [Word(*[random.choice(tokens) for _ in range(random.randint(0, 4))]) for _ in range(random.randint(0, 6))]
+            for sandhi in [False, True]:
+                for tonify in [False, True]:
+                    for usecolors in [False, True]:
+                        staged = sandhi and tonesandhi(words) or words
+                        staged = usecolors and colorize(colorlist, staged) or staged
+                        self.assertEquals(Pipeline(sandhi=sandhi, colorlist=usecolors and colorlist or None, tonify=tonify).flatten(words), flatten(staged, tonify=tonify))
+
 class PinyinAudioReadingsTest(unittest.TestCase):
     default_raw_available_media = ["na3.mp3", "ma4.mp3", "xiao3.mp3", "ma3.mp3", "ci2.mp3", "dian3.mp3",
                                    "wu3.mp3", "nin2.mp3", "ni3.ogg", "hao3.ogg", "gen1.ogg", "gen1.mp3"]
@@ -155,6 +187,12 @@ class PinyinAudioReadingsTest(unittest.TestCase):
         self.assertFalse(mediamissing)
         self.assertEquals(output, ["ma3.mp3"])
 
+    def testReuseIndexForSamePacks(self):
+        mediapacks = [MediaPack("Foo", { "ma3.mp3" : "ma3.mp3" })]
+        self.assertTrue(PinyinAudioReadings(mediapacks, [".mp3"]).index is PinyinAudioReadings(mediapacks, [".mp3"]).index)
+        self.assertFalse(PinyinAudioReadings(mediapacks, [".mp3"]).index is PinyinAudioReadings(mediapacks, [".ogg"]).index)
+        self.assertFalse(PinyinAudioReadings(mediapacks, [".mp3"]).index is PinyinAudioReadings([MediaPack("Bar", {})], [".mp3"]).index)
+
     # Test helpers
     def assertHasReading(self, what, shouldbe, **kwargs):
         bestpackshouldbe, mediapack, output, mediamissing = self.audioreading(what, **kwargs)
@@ -187,6 +225,30 @@ class PinyinAudioReadingsTest(unittest.TestCase):
             pack = MediaPack("Test", dict([(filename, filename) for filename in raw_available_media]))
             return pack, [pack]
 
+class MediaIndexTest(unittest.TestCase):
+    def testPerPackMedia(self):
+        index = MediaIndex([MediaPack("Foo", { "ma3.mp3" : "foo/ma3.mp3" }), MediaPack("Bar", { "ma3.ogg" : "bar/ma3.ogg", "ni3.mp3" : "bar/ni3.mp3" })], [".mp3", ".ogg"])
+        self.assertEquals(index.mediafor(u"ma", 3), ("foo/ma3.mp3", "bar/ma3.ogg"))
+        self.assertEquals(index.mediafor(u"ni", 3), (None, "bar/ni3.mp3"))
+        self.assertEquals(index.mediafor(u"ni", 2), (None, None))
+    
+    def testCapitalization(self):
+        index = MediaIndex([MediaPack("Foo", { "Shang4.MP3" : "Shang4.MP3" })], [".mp3"])
+        self.assertEquals(index.mediafor(u"Shang", 4), ("Shang4.MP3",))
+        self.assertEquals(index.mediafor(u"shang", 4), ("Shang4.MP3",))
+    
+    def testFifthToneFallbacks(self):
+        index = MediaIndex([MediaPack("Foo", { "de.mp3" : "de.mp3" }), MediaPack("Bar", { "de4.mp3" : "de4.mp3" }), MediaPack("Baz", { "de5.mp3" : "de5.mp3", "de4.mp3" : "de4.mp3" })], [".mp3"])
+        self.assertEquals(index.mediafor(u"de", 5), ("de.mp3", "de4.mp3", "de5.mp3"))
+    
+    def testUUmlautFallbacks(self):
+        index = MediaIndex([MediaPack("Foo", { "nv3.mp3" : "nv3.mp3" }), MediaPack("Bar", { "nu:3.mp3" : "nu:3.mp3" }), MediaPack("Baz", { "nu3.mp3" : "nu3.mp3" })], [".mp3"])
+        self.assertEquals(index.mediafor(u"nü", 3), ("nv3.mp3", "nu:3.mp3", None))
+    
+    def testSyllablesOutsideTheIndex(self):
+        index = MediaIndex([MediaPack("Foo", { "zzz1.mp3" : "zzz1.mp3" })], [".mp3"])
+        self.assertEquals(index.mediafor(u"zzz", 1), ("zzz1.mp3",))
+
 class ToneSandhiTest(unittest.TestCase):
     def testDoesntAffectWrittenTones(self):
         self.assertEquals(flatten(tonesandhi([Word(Pinyin.parse("hen3")), Word(Pinyin.parse("hao3"))])), "hen3hao3")
@@ -220,6 +282,23 @@ class ToneSandhiTest(unittest.TestCase):
         # compound 饮料 - modified to take the new information into account:
         self.assertSandhi(*(englishdict.reading(u"酒水饮料") + ["jiu2 shui2 yin3 liao4"]))
     
+    def testMany(self):
+        self.assertEquals([flatten(self.copySpokenToWritten(words)) for words in tonesandhimany([[Word(Pinyin.parse("hen3"))], [], [Word(Pinyin.parse("hao3"), Pinyin.parse("hao3"))]])],
+                          ["hen3", "", "hao2hao3"])
+    
+    def testManyDoesntCrossReadings(self):
+        self.assertEquals([flatten(self.copySpokenToWritten(words)) for words in tonesandhimany([[Word(Pinyin.parse("hen3"))], [Word(Pinyin.parse("hao3"))]])],
+                          ["hen3", "hao3"])
+    
+    def testAgreesWithContourRewriting(self):
+        random.seed(1234)
+        tokens = [Pinyin(u"ma", tone) for tone in range(1, 6)] + [Pinyin(u"ma", 3)] * 5 + [TonedCharacter(u"好", 3), Text(u" "), Text(u"!")]
+        for _ in range(300):
+            wordss = [[Word(*[random.choice(tokens) for _ in range(random.randint(0, 4))]) for _ in range(random.randint(0, 6))] for _ in range(random.randint(1, 4))]
+            expected = [self.contoursandhi(words) for words in wordss]
+            self.assertEquals([tonesandhi(words) for words in wordss], expected)
+            self.assertEquals(tonesandhimany(wordss), expected)
+    
     # TODO: improve tone sandhi such that the following tests pass:
     #
     # def testYiFollowedByFour(self):
@@ -258,6 +337,60 @@ class ToneSandhiTest(unittest.TestCase):
                 return TonedCharacter(unicode(tonedcharacter), ToneInfo(written=tonedcharacter.toneinfo.spoken))
         
         return [word.map(CopySpokenToWrittenVisitor()) for word in words]
+    
+    # How tone sandhi used to be done, by rewriting a string representing the tone contour
+    def contoursandhi(self, words):
+        class GatherToneContourVisitor(TokenVisitor):
+            def __init__(self, tonecontourio):
+                self.tonecontourio = tonecontourio
+            
+            def visitText(self, text):
+                if len(text.strip()) != 0:
+                    self.tonecontourio.write("_")
+            
+            def visitPinyin(self, pinyin):
+                self.tonecontourio.write(str(pinyin.toneinfo.written))
+            
+            def visitTonedCharacter(self, tonedcharacter):
+                self.tonecontourio.write(str(tonedcharacter.toneinfo.written))
+        
+        class ApplyToneContourVisitor(TokenVisitor):
+            def __init__(self, tonecontourqueue):
+                self.tonecontourqueue = tonecontourqueue
+            
+            def visitText(self, text):
+                if len(text.strip()) != 0:
+                    self.tonecontourqueue.pop()
+                return text
+            
+            def visitPinyin(self, pinyin):
+                return Pinyin(pinyin.word, ToneInfo(written=pinyin.toneinfo.written, spoken=int(self.tonecontourqueue.pop())))
+            
+            def visitTonedCharacter(self, tonedcharacter):
+                return TonedCharacter(unicode(tonedcharacter), ToneInfo(written=tonedcharacter.toneinfo.written, spoken=int(self.tonecontourqueue.pop())))
+        
+        tonecontourio = cStringIO.StringIO()
+        gathervisitor = GatherToneContourVisitor(tonecontourio)
+        for word in words:
+            word.accept(gathervisitor)
+            tonecontourio.write("~")
+        tonecontour = tonecontourio.getvalue()
+        
+        def dealWithThrees(match):
+            wordcontours = (match.group(1) or "").split("~")[:-1] + [match.group(2)]
+            maketwosifpoly = lambda what: len(what) == 1 and what or '2' * len(what)
+            makeprefixtwos = lambda what: '2' * (len(what) - 1) + '3'
+            return "~".join([maketwosifpoly(wordcontour) for wordcontour in wordcontours[:-1]] + [makeprefixtwos(wordcontours[-1])])
+        tonecontour = re.sub(r"((?:3+\~+)*)(3+)", dealWithThrees, tonecontour)
+        tonecontour = re.sub(r"3(\~*)3", r"2\g<1>3", tonecontour)
+        
+        finalwords = []
+        tonecontourqueue = list(tonecontour[::-1])
+        applyvisitor = ApplyToneContourVisitor(tonecontourqueue)
+        for word in words:
+            finalwords.append(word.map(applyvisitor))
+            tonecontourqueue.pop()
+        return finalwords
 
 class TrimErhuaTest(unittest.TestCase):
     def testTrimErhuaEmpty(self):
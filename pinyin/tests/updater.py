@@ -146,7 +146,7 @@ class FieldUpdaterFromExpressionTest(unittest.TestCase):
                 audiogeneration = True, audioextensions = [".mp3"], tonecolors = [u"#ff0000", u"#ffaa00", u"#00aa00", u"#0000ff", u"#545454"], weblinkgeneration = False, hanzimasking = False,
                 tradgeneration = True, simpgeneration = True, forceexpressiontobesimptrad = False), {
                     "reading" : u'<span style="color:#ff0000">shū</span>',
-                    "meaning" : u'㊀ book<br />㊁ letter<br />㊂ see also <span style="color:#ff0000">\u4e66</span><span style="color:#ff0000">\u7ecf</span> Book of History',
+                    "meaning" : u'㊀ book<br />㊁ letter<br />㊂ see also <span style="color:#ff0000">\u4e66\u7ecf</span> Book of History',
                     "mw" : u'<span style="color:#00aa00">本</span> - <span style="color:#00aa00">běn</span>, <span style="color:#0000ff">册</span> - <span style="color:#0000ff">cè</span>, <span style="color:#0000ff">部</span> - <span style="color:#0000ff">bù</span>',
                     "audio" : u"[sound:" + os.path.join("Test", "shu1.mp3") + "]",
                     "color" : u'<span style="color:#ff0000">书</span>',
@@ -367,7 +367,7 @@ class FieldUpdaterFromExpressionTest(unittest.TestCase):
         self.assertEquals(
             self.updatefact(u"个個", { "expression" : "I'm Filled!", "color" : "dummy" },
                             forceexpressiontobesimptrad = True, prefersimptrad = "trad", tonecolors = [u"#111111", u"#222222", u"#333333", u"#444444", u"#555555"]),
-                            { "expression"  : u"個個", "color" : u'<span style="color:#444444">個</span><span style="color:#444444">個</span>' })
+                            { "expression"  : u"個個", "color" : u'<span style="color:#444444">個個</span>' })
 
     def testDontOverwriteFilledColoredCharactersIfSimpTradDoesntChange(self):
         self.assertEquals(
@@ -166,6 +166,72 @@ class FactoryDictTest(unittest.TestCase):
         self.assertEquals(dict[2], "Hello")
         self.assertEquals(dict[3], "Bye")
 
+class TrieTest(unittest.TestCase):
+    def testContains(self):
+        trie = Trie(["ab", "abcd"])
+        self.assertTrue("ab" in trie)
+        self.assertTrue("abcd" in trie)
+        self.assertFalse("abc" in trie)
+        self.assertFalse("b" in trie)
+    
+    def testTags(self):
+        trie = Trie()
+        trie.add("ab", 1)
+        trie.add("ab", 4)
+        trie.add("abcd", 2)
+        self.assertEquals(trie.tags("ab"), 5)
+        self.assertEquals(trie.tags("abcd"), 2)
+        self.assertEquals(trie.tags("abc"), 0)
+        self.assertEquals(trie.tags("x"), 0)
+    
+    def testMatchLengths(self):
+        trie = Trie(["a", "abc", "abcde", "bc"])
+        self.assertEquals(trie.matchlengths("abcdef"), [1, 3, 5])
+        self.assertEquals(trie.matchlengths("abcdef", 1), [2])
+        self.assertEquals(trie.matchlengths("abcdef", 2), [])
+    
+    def testMatchLengthsAtEndOfText(self):
+        trie = Trie(["abc"])
+        self.assertEquals(trie.matchlengths("xab", 1), [])
+        self.assertEquals(trie.matchlengths("xabc", 1), [3])
+        self.assertEquals(trie.matchlengths("", 0), [])
+
+class LRUCacheTest(unittest.TestCase):
+    def testGetAndPut(self):
+        cache = LRUCache(2)
+        cache.put("a", 1)
+        self.assertEquals(cache.get("a"), 1)
+        self.assertEquals(cache.get("b"), None)
+        self.assertEquals(cache.get("b", 2), 2)
+    
+    def testEvictsLeastRecentlyUsed(self):
+        cache = LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+        self.assertEquals([cache.get(key) for key in ["a", "b", "c"]], [1, None, 3])
+        self.assertEquals(len(cache), 2)
+    
+    def testStatistics(self):
+        cache = LRUCache(1)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.get("b")
+        self.assertEquals(cache.statistics(), { "size" : 1, "hits" : 1, "misses" : 1, "evictions" : 1 })
+    
+    def testZeroSizeRemembersNothing(self):
+        cache = LRUCache(0)
+        cache.put("a", 1)
+        self.assertEquals(cache.get("a"), None)
+    
+    def testClear(self):
+        cache = LRUCache(2)
+        cache.put("a", 1)
+        cache.clear()
+        self.assertEquals(cache.get("a"), None)
+
 class isMandarinModelTest(unittest.TestCase):
     def testCheck(self):
         self.assertTrue(ismandarinmodel("Mandarin"))
@@ -2,9 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import copy
-import cStringIO
 import random
-import re
 
 from logger import log
 from model import *
@@ -21,88 +19,136 @@ see: <http://en.wikipedia.org/wiki/Standard_Mandarin#Tone_sandhi>
 NB: we don't implement this very well yet. Give it time..
 """
 def tonesandhi(words):
-    # 1) Gather the tone contour into a string
-    tonecontourio = cStringIO.StringIO()
-    gathervisitor = GatherToneContourVisitor(tonecontourio)
-    for word in words:
-        word.accept(gathervisitor)
-        tonecontourio.write("~")
-    tonecontour = tonecontourio.getvalue()
-    tonecontourio.close()
-    
-    
-    # 2) Rewrite it (ewww!)
+    return tonesandhimany([words])[0]
+
+"""
+Apply tone sandhi to each of a list of readings (such as all the meanings of an expression)
+at once. Sandhi never crosses from one reading to the next.
+"""
+def tonesandhimany(wordss):
+    # 1) Gather the written tones into one compact array and rewrite them
+    tones = sandhitones(wordss)
     
-    log.info("Rewriting tone sandhi for contour %s", tonecontour)
+    # 2) Apply the new tones to the words
+    applyvisitor = ApplyTonesVisitor(tones)
+    finalwordss = []
+    for words in wordss:
+        finalwordss.append([word.map(applyvisitor) for word in words])
+        applyvisitor.skip()
     
-    # NB: must match strings of ~ in the following in order to ignore words
-    # which consist entirely of blank space. Tian'a, this is unbelievably horrible!
+    return finalwordss
+
+# Stands in for any text that isn't whitespace in the tone array: it stops sandhi happening across it
+notone = 0
+
+"""
+The spoken tones of every Pinyin and TonedCharacter in the readings, in order. The text that isn't
+whitespace and the end of each reading are also in there, as notone.
+"""
+def sandhitones(wordss):
+    # Gather the written tones, noting the word each came from
+    gathervisitor = GatherTonesVisitor()
+    for words in wordss:
+        for word in words:
+            word.accept(gathervisitor)
+            gathervisitor.wordid += 1
+        
+        # Seperate the readings as if there was some text between them
+        gathervisitor.tones.append(notone)
+        gathervisitor.wordids.append(gathervisitor.wordid)
     
-    # Top priority:
-    #  33~3 -> 22~3
-    #  3~33 -> 3~23
-    # (and the more general sandhi effect with strings of length > 3)
-    def dealWithThrees(match):
-        # a) Split the match into a list of strings of 3 per word
-        wordcontours = (match.group(1) or "").split("~")[:-1] + [match.group(2)]
+    rewritethirdtones(gathervisitor.tones, gathervisitor.wordids)
+    return gathervisitor.tones
+
+"""
+Rewrites runs of third tones in the tone array in place. Whitespace and word boundaries don't stop
+a run, but anything else does, and the rules depend on how the run is split up into words:
+ * Every word in the run except the last keeps a monosyllabic third tone, but turns longer
+   ones into second tones: 3~33~3 -> 3~22~3
+ * The last word becomes second tones followed by a single third tone: 3~333 -> 3~223
+ * Finally, going from left to right, a third tone followed directly by another (ignoring word
+   boundaries) becomes a second tone, if it isn't itself the second of such a pair: 3~3~3 -> 2~3~3
+"""
+def rewritethirdtones(tones, wordids):
+    start = 0
+    while start < len(tones):
+        if tones[start] != 3:
+            start += 1
+            continue
         
-        # b) Build the result
-        #   i) For everything but the last word, turn the tone into 2 if it is monosyllabic
-        maketwosifpoly = lambda what: len(what) == 1 and what or '2' * len(what)
-        #   ii) For the last word, always end with a sequence of 2s followed by a 3
-        makeprefixtwos = lambda what: '2' * (len(what) - 1) + '3'
-        replacement = "~".join([maketwosifpoly(wordcontour) for wordcontour in wordcontours[:-1]] + [makeprefixtwos(wordcontours[-1])])
+        # Find the end of the run of third tones, and deal with each word in it as we go
+        end, wordstart = start, start
+        while end < len(tones) and tones[end] == 3:
+            end += 1
+            if end == len(tones) or tones[end] != 3 or wordids[end] != wordids[wordstart]:
+                if end == len(tones) or tones[end] != 3:
+                    # The last word in the run
+                    twos = range(wordstart, end - 1)
+                elif end - wordstart > 1:
+                    twos = range(wordstart, end)
+                else:
+                    twos = []
+                
+                for n in twos:
+                    tones[n] = 2
+                
+                wordstart = end
         
-        log.debug("Rewrote complex tone sandhi %s into %s", match.group(0), replacement)
-        return replacement
-    tonecontour = re.sub(r"((?:3+\~+)*)(3+)", dealWithThrees, tonecontour)
-    
-    # Low priority (let others take effect first):
-    #  33  -> 23 (though this is already caught by the code above, actually)
-    #  3~3 -> 2~3
-    tonecontour = re.sub(r"3(\~*)3", r"2\g<1>3", tonecontour)
-    
-    log.info("Final contour computed as %s", tonecontour)
-    
-    # 3) Apply the new contour to the words
-    finalwords = []
-    tonecontourqueue = list(tonecontour[::-1])
-    applyvisitor = ApplyToneContourVisitor(tonecontourqueue)
-    for word in words:
-        finalwords.append(word.map(applyvisitor))
-        p = tonecontourqueue.pop()
-        assert p == "~"
-    return finalwords
-
-class GatherToneContourVisitor(TokenVisitor):
-    def __init__(self, tonecontourio):
-        self.tonecontourio = tonecontourio
+        # Pair up the third tones that are left
+        paired = False
+        for n in range(start + 1, end):
+            if tones[n] == 3 and tones[n - 1] == 3 and not(paired):
+                tones[n - 1] = 2
+                paired = True
+            else:
+                paired = False
+        
+        start = end
+
+class GatherTonesVisitor(TokenVisitor):
+    def __init__(self):
+        self.tones = []
+        self.wordids = []
+        self.wordid = 0
 
     def visitText(self, text):
         if len(text.strip()) != 0:
-            self.tonecontourio.write("_")
+            self.addtone(notone)
 
     def visitPinyin(self, pinyin):
-        self.tonecontourio.write(str(pinyin.toneinfo.written))
+        self.addtone(pinyin.toneinfo.written)
         
     def visitTonedCharacter(self, tonedcharacter):
-        self.tonecontourio.write(str(tonedcharacter.toneinfo.written))
+        self.addtone(tonedcharacter.toneinfo.written)
+    
+    def addtone(self, tone):
+        self.tones.append(tone)
+        self.wordids.append(self.wordid)
 
-class ApplyToneContourVisitor(TokenVisitor):
-    def __init__(self, tonecontourqueue):
-        self.tonecontourqueue = tonecontourqueue
+class ApplyTonesVisitor(TokenVisitor):
+    def __init__(self, tones):
+        self.tones = tones
+        self.position = 0
+    
+    def nexttone(self):
+        tone = self.tones[self.position]
+        self.position += 1
+        return tone
+    
+    # Steps over the seperator between two readings
+    def skip(self):
+        assert self.nexttone() == notone
     
     def visitText(self, text):
         if len(text.strip()) != 0:
-            p = self.tonecontourqueue.pop()
-            assert p in "_"
+            assert self.nexttone() == notone
         return text
 
     def visitPinyin(self, pinyin):
-        return Pinyin(pinyin.word, ToneInfo(written=pinyin.toneinfo.written, spoken=int(self.tonecontourqueue.pop())))
+        return Pinyin(pinyin.word, ToneInfo(written=pinyin.toneinfo.written, spoken=self.nexttone()))
     
     def visitTonedCharacter(self, tonedcharacter):
-        return TonedCharacter(unicode(tonedcharacter), ToneInfo(written=tonedcharacter.toneinfo.written, spoken=int(self.tonecontourqueue.pop())))
+        return TonedCharacter(unicode(tonedcharacter), ToneInfo(written=tonedcharacter.toneinfo.written, spoken=self.nexttone()))
 
 """
 Remove all r5 characters from the supplied words.
@@ -167,6 +213,79 @@ class ColorizerVisitor(TokenVisitor):
         else:
             return token
 
+"""
+Does the same as some combination of tonesandhi, colorize and flatten, in that order, but in a
+single pass over the tokens and without building any new ones.
+"""
+class Pipeline(object):
+    def __init__(self, sandhi=False, colorlist=None, tonify=False, renderer=None):
+        self.sandhi = sandhi
+        self.colorlist = colorlist
+        self.tonify = tonify
+        self.renderer = renderer or htmlrenderer
+    
+    """
+    The pipeline for Pinyin the user will see, configured as they asked.
+    """
+    @classmethod
+    def fromconfig(cls, config, sandhi=False):
+        return cls(sandhi=sandhi, colorlist=config.colorizedpinyingeneration and config.tonecolors or None, tonify=config.shouldtonify)
+    
+    def flatten(self, words):
+        visitor = PipelineVisitor(self, self.sandhi and sandhitones([words]) or None)
+        for word in words:
+            word.accept(visitor)
+        
+        return self.renderer.render(visitor.runs)
+
+class PipelineVisitor(FlattenTokensVisitor):
+    # The attributes of uncolored tokens once they are colored, shared between all pipelines
+    colorattrs = {}
+    
+    # NB: sandhifycolor is slow, and there are only a few colors that it will be asked about
+    sandhifiedcolors = {}
+    
+    def __init__(self, pipeline, tones):
+        FlattenTokensVisitor.__init__(self, pipeline.tonify)
+        self.colorlist = pipeline.colorlist
+        self.tones = tones
+        self.position = 0
+    
+    def visitText(self, text):
+        if self.tones is not None and len(text.strip()) != 0:
+            # Skip over the tone array's notone for this text
+            self.position += 1
+        
+        FlattenTokensVisitor.visitText(self, text)
+    
+    def visitPinyin(self, pinyin):
+        self.addfragment(self.htmlattrs(pinyin), self.tonify and pinyin.tonifiedformat() or unicode(pinyin))
+    
+    def visitTonedCharacter(self, tonedcharacter):
+        self.addfragment(self.htmlattrs(tonedcharacter), unicode(tonedcharacter))
+    
+    def htmlattrs(self, token):
+        written, spoken = token.toneinfo.written, token.toneinfo.spoken
+        htmlattrs = token.htmlattrs
+        if self.tones is not None:
+            # Sandhi rebuilds the tokens, forgetting their attributes
+            spoken = self.tones[self.position]
+            self.position += 1
+            htmlattrs = noattrs
+        
+        # Just like ColorizerVisitor, don't overwrite any colors that are already there
+        if self.colorlist is None or "color" in htmlattrs:
+            return htmlattrs
+        
+        color = self.colorlist[written - 1]
+        if spoken != written:
+            color = self.sandhifiedcolors.get(color) or self.sandhifiedcolors.setdefault(color, sandhifycolor(color))
+        
+        if len(htmlattrs) == 0:
+            return self.colorattrs.get(color) or self.colorattrs.setdefault(color, { "color" : color })
+        else:
+            return mergedattrs(htmlattrs, { "color" : color })
+
 def sandhifycolor(color):
     # Lighten up the color by halving saturation and increasing value
     # by 20%. This was chosen to match Nicks choice of how to change green
@@ -190,77 +309,109 @@ class PinyinAudioReadings(object):
     def __init__(self, mediapacks, audioextensions):
         self.mediapacks = mediapacks
         self.audioextensions = audioextensions
+        self.index = MediaIndex.forpacks(mediapacks, audioextensions)
     
     def audioreading(self, tokens):
         log.info("Requested audio reading for %d tokens", len(tokens))
         
-        # Try possible packs to format the tokens. Basically, we
-        # don't want to use a mix of sounds from different packs
-        bestmediapacksoutputs, bestmediamissingcount = [], len(tokens) + 1
-        for mediapack in self.mediapacks:
-            log.info("Checking for reading in pack %s", mediapack.name)
-            output, mediamissingcount = audioreadingforpack(mediapack, self.audioextensions, trimerhua(tokens))
-            
-            # We will end up choosing one of the packs that minimizes the number of errors:
-            if mediamissingcount == bestmediamissingcount:
-                # Just as good as a previous pack, so this is an alternative
-                bestmediapacksoutputs.append((mediapack, output))
-            elif mediamissingcount < bestmediamissingcount:
-                # Strictly better than the previous ones, so this is the new best option
-                bestmediapacksoutputs = [(mediapack, output)]
-                bestmediamissingcount = mediamissingcount
+        # Look up what every pack has for each syllable, ignoring erhua
+        visitor = AudioSyllablesVisitor()
+        [word.accept(visitor) for word in trimerhua(tokens)]
+        syllablesmedia = [self.index.mediafor(pinyin.word, pinyin.toneinfo.spoken) for pinyin in visitor.syllables]
         
-        # Did we get any result at all?
-        if len(bestmediapacksoutputs) != 0:
-            bestmediapack, bestoutput = random.choice(bestmediapacksoutputs)
-            return bestmediapack, bestoutput, (bestmediamissingcount != 0)
+        # Try possible packs to format the tokens. Basically, we don't want to use a mix of sounds from
+        # different packs, so count how much each pack is missing and choose one that minimizes that.
+        # NB: a pack that misses more media than there are words is never any good
+        if len(syllablesmedia) > 0:
+            mediamissingcounts = [packmedia.count(None) for packmedia in zip(*syllablesmedia)]
         else:
+            mediamissingcounts = [0 for _mediapack in self.index.mediapacks]
+        
+        bestmediamissingcount = min(mediamissingcounts + [len(tokens) + 1])
+        bestpacks = [n for n, mediamissingcount in enumerate(mediamissingcounts) if mediamissingcount == bestmediamissingcount]
+        
+        # Did we get any result at all?
+        if len(bestpacks) == 0:
             return None, [], True
-
-# Simple wrapper around the PinyinAudioReadingsVisitor
-def audioreadingforpack(mediapack, audioextensions, words):
-    visitor = PinyinAudioReadingsVisitor(mediapack, audioextensions)
-    [word.accept(visitor) for word in trimerhua(words)]
-    return (visitor.output, visitor.mediamissingcount)
-
-class PinyinAudioReadingsVisitor(TokenVisitor):
-    def __init__(self, mediapack, audioextensions):
-        self.mediapack = mediapack
-        self.audioextensions = audioextensions
         
-        self.output = []
-        self.mediamissingcount = 0
+        # Choose randomly between the packs that are equally good
+        bestpack = random.choice(bestpacks)
+        for pinyin, syllablemedia in zip(visitor.syllables, syllablesmedia):
+            if syllablemedia[bestpack] is None:
+                log.warning("Couldn't find media for %s (%s) in %s", pinyin, pinyin.numericformat(tone="spoken"), self.index.mediapacks[bestpack])
+        
+        bestoutput = [syllablemedia[bestpack] for syllablemedia in syllablesmedia if syllablemedia[bestpack] is not None]
+        return self.index.mediapacks[bestpack], bestoutput, (bestmediamissingcount != 0)
+
+class AudioSyllablesVisitor(TokenVisitor):
+    def __init__(self):
+        self.syllables = []
     
     def visitText(self, text):
         pass
 
     def visitPinyin(self, pinyin):
+        self.syllables.append(pinyin)
+
+    def visitTonedCharacter(self, tonedcharacter):
+        pass
+
+"""
+Knows the media that each of some packs has for each syllable and spoken tone, having already
+taken into account the different names the packs might use for it. Every syllable we know about
+is indexed up front, and anything else the first time it is asked for.
+"""
+class MediaIndex(object):
+    # The index for the packs we were asked about last time, which are normally the ones we'll be asked about next
+    last = None
+    
+    @classmethod
+    def forpacks(cls, mediapacks, audioextensions):
+        index = cls.last
+        if index is None or index.mediapacks != list(mediapacks) or index.audioextensions != list(audioextensions):
+            index = cls.last = MediaIndex(mediapacks, audioextensions)
+        
+        return index
+    
+    def __init__(self, mediapacks, audioextensions):
+        self.mediapacks = list(mediapacks)
+        self.audioextensions = list(audioextensions)
+        
+        self.index = {}
+        for syllable in Pinyin.validpinyin:
+            for tone in range(1, 6):
+                self.mediafor(syllable, tone)
+    
+    """
+    The media for the syllable in each pack, in the same order as the packs. Packs without any suitable
+    media have None instead.
+    """
+    def mediafor(self, word, spoken):
+        key = (word.lower(), spoken)
+        media = self.index.get(key)
+        if media is None:
+            media = self.index[key] = tuple([self.packmediafor(mediapack, key[0], spoken) for mediapack in self.mediapacks])
+        
+        return media
+    
+    def packmediafor(self, mediapack, word, spoken):
         # Find possible base sounds we could accept
-        possiblebases = [pinyin.numericformat(hideneutraltone=False, tone="spoken")]
-        substitutions = waysToSubstituteAwayUUmlaut(pinyin.word)
-        if pinyin.toneinfo.spoken == 5:
+        possiblebases = [word + str(spoken)]
+        substitutions = waysToSubstituteAwayUUmlaut(word)
+        if spoken == 5:
             # Sometimes we can replace tone 5 with 4 in order to deal with lack of '[xx]5.ogg's
-            possiblebases.extend([pinyin.word, pinyin.word + '4'])
+            possiblebases.extend([word, word + '4'])
         elif substitutions is not None:
             # Typically u: is written as v in filenames
-            possiblebases.extend([substitution + str(pinyin.toneinfo.spoken) for substitution in substitutions])
-    
+            possiblebases.extend([substitution + str(spoken) for substitution in substitutions])
+        
         # Find path to first suitable media in the possibilty list
         for possiblebase in possiblebases:
-            media = self.mediapack.mediafor(possiblebase, self.audioextensions)
+            media = mediapack.mediafor(possiblebase, self.audioextensions)
             if media:
-                break
-    
-        if media:
-            # If we've managed to find some media, we can put it into the output:
-            self.output.append(media)
-        else:
-            # Otherwise, increment the count of missing media we use to determine optimality
-            log.warning("Couldn't find media for %s (%s) in %s", pinyin, pinyin.numericformat(tone="spoken"), self.mediapack)
-            self.mediamissingcount += 1
-
-    def visitTonedCharacter(self, tonedcharacter):
-        pass
+                return media
+        
+        return None
 
 """
 Replace occurences of the expression in the words with the masking character.
@@ -20,10 +20,7 @@ from logger import log
 
 
 def preparetokens(config, tokens):
-    if config.colorizedpinyingeneration:
-        tokens = transformations.colorize(config.tonecolors, tokens)
-
-    return model.flatten(tokens, tonify=config.shouldtonify)
+    return transformations.Pipeline.fromconfig(config).flatten(tokens)
 
 def generateaudio(notifier, mediamanager, config, dictreading):
     mediapacks = mediamanager.discovermediapacks()
@@ -122,7 +119,7 @@ class FieldUpdaterFromExpression(object):
     def __init__(self, notifier, mediamanager, config=getconfig()):
         self.notifier = notifier
         self.mediamanager = mediamanager
-        self.dictionaries = dictionary.PinyinDictionary.loadall()
+        self.dictionaries = dictionary.PinyinDictionary.loadall(config.dictionarymemorylimitbytes, config.dictionarycachesize)
         self.config = config
     
     dictionary = property(lambda self: self.dictionaries(self.config.dictlanguage))
@@ -145,7 +142,7 @@ class FieldUpdaterFromExpression(object):
             return None
         
         # Consider sandhi in meanings - you never know, there might be some!
-        dictmeanings = [transformations.tonesandhi(dictmeaning) for dictmeaning in dictmeanings]
+        dictmeanings = transformations.tonesandhimany(dictmeanings)
         
         if self.config.hanzimasking:
             # Hanzi masking is on: scan through the meanings and remove the expression itself
@@ -195,8 +192,8 @@ class FieldUpdaterFromExpression(object):
         # with the current implementation, but better safe than sorry.
         return generateaudio(self.notifier, self.mediamanager, self.config, transformations.tonesandhi(dictreading))
     
-    def generatecoloredcharacters(self, expression):
-        return model.flatten(transformations.colorize(self.config.tonecolors, transformations.tonesandhi(self.dictionary.tonedchars(expression))))
+    def generatecoloredcharacters(self, parsedexpression):
+        return transformations.Pipeline(sandhi=True, colorlist=self.config.tonecolors).flatten(parsedexpression.tonedchars())
 
     # Future support will need to be dictionary-based and will require a lot more work
     # Will need to be a bit complex:
@@ -236,12 +233,12 @@ class FieldUpdaterFromExpression(object):
     # Core updater routines
     #
     
-    def getdictreading(self, expression):
+    def getdictreading(self, expression, parsedexpression):
         dictreadingsources = [
                 # Get the reading by considering the text as a (Western) number
                 lambda: numberutils.readingfromnumberlike(expression, self.dictionary),
                 # Use CEDICT to get reading (always succeeds)
-                lambda: self.dictionary.reading(expression)
+                lambda: parsedexpression.reading()
             ]
         
         # Find the first source that returns a sensible reading
@@ -279,9 +276,12 @@ class FieldUpdaterFromExpression(object):
             # delay, but I'm not sure where the delay originates from, which worries me:
             return
         
+        # Segment the expression just once: the reading, meanings and colored characters are all derived from this
+        parsedexpression = self.dictionary.parseexpression(expression)
+        
         # Apply tone sandhi: this information is needed both by the sound generation
         # and the colorisation, so we can't do it in generatereading
-        dictreading = self.getdictreading(expression)
+        dictreading = self.getdictreading(expression, parsedexpression)
         dictreadingsandhi = transformations.tonesandhi(dictreading)
   
         # Preload the meaning, but only if we absolutely must
@@ -289,7 +289,7 @@ class FieldUpdaterFromExpression(object):
             dictmeaningssources = [
                     # Use CEDICT to get meanings
                     (None,
-                     lambda: self.dictionary.meanings(expression, self.config.prefersimptrad)),
+                     lambda: parsedexpression.meanings(self.config.prefersimptrad)),
                     # Interpret Hanzi as numbers. NB: only consult after CEDICT so that we
                     # handle curious numbers such as 'liang' using the dictionary
                     (None,
@@ -330,6 +330,9 @@ class FieldUpdaterFromExpression(object):
         if self.config.forceexpressiontobesimptrad and (expression != expressionviews[self.config.prefersimptrad]):
             expression = expressionviews[self.config.prefersimptrad]
             expressionupdated = True
+            
+            # The colored characters are made from the new expression, so it has to be segmented afresh
+            parsedexpression = self.dictionary.parseexpression(expression)
 
         # Do the updates on the fields the user has requested:
         # NB: when adding an updater to this list, make sure that you have
@@ -341,7 +344,7 @@ class FieldUpdaterFromExpression(object):
                 'mw'         : lambda: self.generatemeasureword(self.config.detectmeasurewords and dictmeasurewords or None),
                 'audio'      : lambda: self.generateaudio(dictreadingsandhi),
                 'mwaudio'    : lambda: self.generatemwaudio(dictreading, dictmeasurewords),
-                'color'      : lambda: self.generatecoloredcharacters(expression),
+                'color'      : lambda: self.generatecoloredcharacters(parsedexpression),
                 'trad'       : lambda: (expressionviews["trad"] != expressionviews["simp"]) and expressionviews["trad"] or None,
                 'simp'       : lambda: (expressionviews["trad"] != expressionviews["simp"]) and expressionviews["simp"] or None,
                 'weblinks'   : lambda: self.weblinkgeneration(expression)
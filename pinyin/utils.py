@@ -67,10 +67,10 @@ def ispostspacedpunctuation(text):
     return text == u"。" or text == "." or text == u"，" or text == ","
 
 """
-Turns the empty string into None and leaves everything else alone.
+Turns the empty string (or one of nothing but whitespace) into None and leaves everything else alone.
 """
 def zapempty(what):
-    if what == "":
+    if what is not None and what.strip() == "":
         return None
     else:
         return what
@@ -235,6 +235,18 @@ def filecontents(filepath):
     
     return contents
 
+"""
+Summarises the state of a file, such that the summary changes whenever the file is
+modified, created or deleted.
+"""
+def filestamp(filepath):
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return None
+    
+    return (stat.st_mtime, stat.st_size)
+
 """
 Is the model a Mandarin model. Look for tags in the name.
 """
@@ -402,6 +414,9 @@ def intersperse(what, things):
     
     return result
 
+def chunked(what, size):
+    return [what[i:i + size] for i in range(0, len(what), size)]
+
 def substrings(text):
     for length in range(len(text), -1, -1):
         for i in range(0, len(text) - length):
@@ -521,6 +536,92 @@ class FactoryDict(dict):
             self[key] = value
             return value
 
+"""
+A prefix trie over a set of words, where each word carries some tags: bits recording e.g. which
+of several word lists it came from. Rather than nesting one dictionary per node, the nodes are
+stored flat: every prefix of every word maps to the tags of that prefix as a complete word, or
+to 0 if it is only a prefix. That avoids a dictionary per node, but every distinct prefix still
+costs a string and a dictionary entry, so the trie is several times the size of the words in it.
+"""
+class Trie(object):
+    def __init__(self, words=[]):
+        self.nodes = {}
+        for word in words:
+            self.add(word)
+
+    def add(self, word, tags=1):
+        for end in range(1, len(word)):
+            self.nodes.setdefault(word[:end], 0)
+
+        self.nodes[word] = self.nodes.get(word, 0) | tags
+
+    def __contains__(self, word):
+        return self.nodes.get(word, 0) != 0
+
+    def tags(self, word):
+        return self.nodes.get(word, 0)
+
+    """
+    Walk the trie along the text starting at the given position, returning the lengths
+    of all the words that begin there in ascending order.
+    """
+    def matchlengths(self, text, start=0):
+        lengths = []
+        for end in range(start + 1, len(text) + 1):
+            isword = self.nodes.get(text[start:end])
+            if isword is None:
+                # Fell off the trie: no longer words can start here
+                break
+            elif isword:
+                lengths.append(end - start)
+
+        return lengths
+
+"""
+A dictionary holding at most maxsize entries, which forgets the least recently used
+entry to make room for a new one.
+"""
+class LRUCache(object):
+    def __init__(self, maxsize):
+        import collections
+
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def get(self, key, default=None):
+        if key not in self.entries:
+            self.misses += 1
+            return default
+
+        # Move the entry to the most recently used end
+        value = self.entries.pop(key)
+        self.entries[key] = value
+
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+
+        self.entries.pop(key, None)
+        self.entries[key] = value
+
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def statistics(self):
+        return { "size" : len(self.entries), "hits" : self.hits, "misses" : self.misses, "evictions" : self.evictions }
+
 """
 Monadic bind in the Maybe monad (embedded into Python 'None's)
 """